@@ -1,12 +1,25 @@
 #!/usr/bin/env python
 from __future__ import unicode_literals, print_function
+import sys
+from collections import Counter
+from celery import maybe_patch_concurrency
+# gevent and eventlet have to patch the standard library before anything else
+# is imported, so this can't wait until the `worker` command runs.
+maybe_patch_concurrency(sys.argv, ["-P"], ["--pool"])
+
 import flask
 from flask.ext.script import Manager, prompt_bool
 import sqlalchemy
-from webhookdb import create_app, db, celery
+from iso8601 import parse_date
+from webhookdb import create_app, db, celery, profiler
+from webhookdb.export import KINDS as export_kinds, export_records, ndjson, gzipped
+from webhookdb.replay import replay as replay_events
+from webhookdb.archive import ingest
+from webhookdb.upgrade import move_patches_out_of_line, add_filename_to_file_key
 from webhookdb.models import (
     OAuth, User, Repository, UserRepoAssociation, RepositoryHook, Milestone,
-    PullRequest, PullRequestFile, IssueLabel, Issue, Mutex
+    PullRequest, PullRequestFile, PullRequestPatch, IssueLabel, Issue, Mutex,
+    PendingTask, WebhookEvent
 )
 
 manager = Manager(create_app)
@@ -37,13 +50,167 @@ def sql():
     db.metadata.create_all(engine, checkfirst=False)
 
 
-@manager.command
-def worker():
+@manager.option('-q', '--queue', dest='queue', default=None,
+                help="Only consume this queue: webhook, interactive, or bulk")
+@manager.option('-P', '--pool', dest='pool', default=None,
+                help="prefork (the default), gevent, or eventlet")
+@manager.option('-C', '--concurrency', dest='concurrency', type=int, default=None)
+def worker(queue=None, pool=None, concurrency=None):
     "Start a Celery worker"
-    worker = celery.Worker()
+    config = flask.current_app.config
+    kwargs = {}
+    if queue:
+        kwargs["queues"] = [queue]
+        kwargs["concurrency"] = config.get("WORKER_QUEUE_CONCURRENCY", {}).get(queue)
+    if pool:
+        kwargs["pool_cls"] = pool
+        if pool in ("gevent", "eventlet"):
+            # let other greenlets run while waiting on Postgres
+            if pool == "gevent":
+                from psycogreen.gevent import patch_psycopg
+            else:
+                from psycogreen.eventlet import patch_psycopg
+            patch_psycopg()
+            kwargs["concurrency"] = config.get("GREEN_WORKER_CONCURRENCY")
+    if concurrency:
+        kwargs["concurrency"] = concurrency
+    worker = celery.Worker(optimization="fair", **kwargs)
     worker.start()
 
 
+@manager.command
+def beat():
+    "Start the Celery beat scheduler for periodic tasks"
+    celery.Beat().run()
+
+
+@manager.option('-s', '--seconds', dest='seconds', type=int, default=60)
+@manager.option('-m', '--match', dest='match', default=None)
+@manager.option('--disable', dest='disable', action='store_true', default=False)
+def profile(seconds=60, match=None, disable=False):
+    "Turn the sampling profiler on or off for all Celery workers"
+    arguments = {
+        "action": "disable" if disable else "enable",
+        "seconds": seconds,
+        "match": match,
+    }
+    if disable:
+        profiler.disable()
+    else:
+        profiler.enable(seconds=seconds, match=match)
+    replies = celery.control.broadcast(
+        "profiler_control", arguments=arguments, reply=True,
+    )
+    for reply in replies:
+        print(reply)
+
+
+@manager.option('owner', help="the user or organization that owns the repositories")
+@manager.option('-r', '--repo', dest='repo', default=None,
+                help="only export this repository")
+@manager.option('-k', '--kinds', dest='kinds', default=None,
+                help="comma-separated kinds of objects to export")
+@manager.option('-o', '--output', dest='output', default="-")
+@manager.option('--gzip', dest='gzip', action='store_true', default=False)
+@manager.option('--cursor', dest='cursor', default=None,
+                help="resume after the line with this cursor")
+def export(owner, repo=None, kinds=None, output="-", gzip=False, cursor=None):
+    "Export repositories as newline-delimited JSON"
+    query = Repository.query.filter(Repository.owner_login == owner)
+    if repo:
+        query = query.filter(Repository.name == repo)
+    kinds = kinds.split(",") if kinds else export_kinds
+    chunks = ndjson(export_records(query, kinds=kinds, cursor=cursor))
+    if gzip:
+        chunks = gzipped(chunks)
+    if output == "-":
+        # write bytes, underneath the UTF-8 writer that webhookdb sets up
+        out = getattr(sys.stdout, "stream", sys.stdout)
+    else:
+        out = open(output, "wb")
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode("utf-8")
+            out.write(chunk)
+    finally:
+        if out is not getattr(sys.stdout, "stream", sys.stdout):
+            out.close()
+
+
+@manager.option('-o', '--owner', dest='owner', default=None,
+                help="only replay events for this owner's repositories")
+@manager.option('-r', '--repo', dest='repo', default=None,
+                help="only replay events for this repository (needs --owner)")
+@manager.option('-s', '--since', dest='since', default=None,
+                help="only replay events received at or after this ISO 8601 time")
+@manager.option('-p', '--processes', dest='processes', type=int, default=4)
+def replay(owner=None, repo=None, since=None, processes=4):
+    "Rebuild or catch up the database from the webhook event log"
+    if since:
+        since = parse_date(since).replace(tzinfo=None)
+    totals = Counter()
+    for repo_id, counts in replay_events(
+            owner=owner, repo=repo, since=since, processes=processes):
+        totals.update(counts)
+        print("repo {repo_id}: {counts}".format(
+            repo_id=repo_id, counts=dict(counts),
+        ))
+    print("total: {counts}".format(counts=dict(totals)))
+
+
+@manager.option('paths', nargs='+', help="GH Archive-style .json.gz files")
+@manager.option('-o', '--owners', dest='owners', default=None,
+                help="comma-separated owners whose repositories to load")
+@manager.option('-r', '--repos', dest='repos', default=None,
+                help="comma-separated repositories to load, as owner/name")
+@manager.option('-p', '--processes', dest='processes', type=int, default=4)
+def ingest_archive(paths, owners=None, repos=None, processes=4):
+    """
+    Load issue, pull request and repository events from event dump files.
+    By default, only events for repositories already in the database are loaded.
+    """
+    owners = owners.split(",") if owners else []
+    repos = repos.split(",") if repos else []
+    if not (owners or repos):
+        repos = [
+            "{owner}/{name}".format(owner=owner, name=name)
+            for owner, name in
+            Repository.query.with_entities(Repository.owner_login, Repository.name)
+        ]
+        if not repos:
+            print("No repositories to load: use --owners or --repos")
+            return
+    totals = Counter()
+    for path, counts in ingest(paths, owners=owners, repos=repos, processes=processes):
+        totals.update(counts)
+        print("{path}: {counts}".format(path=path, counts=dict(counts)))
+    print("total: {counts}".format(counts=dict(totals)))
+
+
+@manager.option('--drop', dest='drop', action='store_true', default=False,
+                help="drop the old patch column once every patch is moved")
+def move_patches(drop=False):
+    "Upgrade pull request files from before patches were stored out of line"
+    if add_filename_to_file_key():
+        print("Added filenames to the pull request file key")
+    moved = move_patches_out_of_line(drop=drop)
+    print("Moved {num} patches".format(num=moved))
+
+
+@manager.option('--reset', dest='reset', action='store_true', default=False)
+def metrics(reset=False):
+    "Show the counters of every Celery worker's main process"
+    replies = celery.control.broadcast(
+        "metrics_report", arguments={"reset": reset}, reply=True,
+    )
+    for reply in replies:
+        for worker, counters in reply.items():
+            print(worker)
+            for key, value in sorted(counters.items()):
+                print("  {key}: {value}".format(key=key, value=value))
+
+
 @manager.shell
 def make_shell_context():
     return dict(
@@ -52,8 +219,9 @@ def make_shell_context():
         User=User, Repository=Repository, UserRepoAssociation=UserRepoAssociation,
         RepositoryHook=RepositoryHook, Milestone=Milestone,
         PullRequest=PullRequest, PullRequestFile=PullRequestFile,
+        PullRequestPatch=PullRequestPatch,
         IssueLabel=IssueLabel, Issue=Issue,
-        Mutex=Mutex,
+        Mutex=Mutex, PendingTask=PendingTask, WebhookEvent=WebhookEvent,
     )
 
 
@@ -99,8 +99,10 @@ class PullRequestFactory(BaseFactory):
     updated_at = FuzzyNaiveDateTime(start_dt=yesterday, end_dt=now)
     base_repo = factory.SubFactory(RepoFactory)
     base_ref = "master"
+    base_sha = FuzzyText(length=40, chars="0123456789abcdef")
     head_repo = factory.SubFactory(RepoFactory)
     head_ref = FuzzyText(length=10)
+    head_sha = FuzzyText(length=40, chars="0123456789abcdef")
     merged = False
     comments_count = FuzzyInteger(10)
     review_comments_count = FuzzyInteger(15)
@@ -0,0 +1,92 @@
+import gzip
+import json
+from sqlalchemy.exc import IntegrityError
+from webhookdb import db, archive
+from webhookdb.models import Issue
+from webhookdb.archive import iter_archive_events, wanted, ingest_file
+
+
+def write_archive(path, events):
+    f = gzip.open(path, "wb")
+    for event in events:
+        f.write(json.dumps(event).encode("utf-8") + b"\n")
+    f.close()
+
+
+def test_archive_events_are_filtered_by_repo(tmpdir):
+    events = [
+        {"type": "IssuesEvent", "repo": {"name": "octocat/Hello-World"}},
+        {"type": "PullRequestEvent", "repo": {"name": "hubot/robot"}},
+        {"type": "WatchEvent", "repo": {"name": "octocat/Hello-World"}},
+    ]
+    path = str(tmpdir.join("2015-01-01-15.json.gz"))
+    write_archive(path, events)
+
+    loaded = list(iter_archive_events(path))
+    assert loaded == events
+    assert [wanted(event) for event in loaded] == [True, True, False]
+    assert [
+        wanted(event, owners={"octocat"}) for event in loaded
+    ] == [True, False, False]
+    assert [
+        wanted(event, repos={"hubot/robot"}) for event in loaded
+    ] == [False, True, False]
+
+
+def test_ingest_file(app, repo_factory, tmpdir):
+    def issue_event(title, created_at):
+        return {
+            "type": "IssuesEvent", "created_at": created_at,
+            "repo": {"id": repo_id, "name": full_name},
+            "payload": {"action": "edited", "issue": {
+                "id": 1001, "number": 7, "state": "open", "title": title,
+                "labels": [], "milestone": None,
+            }},
+        }
+
+    with app.test_request_context('/'):
+        repo = repo_factory()
+        db.session.commit()
+        repo_id = repo.id
+        full_name = "{}/{}".format(repo.owner_login, repo.name)
+        path = str(tmpdir.join("2015-01-01-15.json.gz"))
+        write_archive(path, [
+            issue_event("Newer", "2015-01-01T15:30:00Z"),
+            issue_event("Older", "2015-01-01T15:10:00Z"),
+            {"type": "IssuesEvent", "repo": {"id": 1, "name": "hubot/robot"}},
+        ])
+
+        result_path, counts = ingest_file((path, {repo.owner_login.lower()}, None))
+        assert result_path == path
+        assert counts == {"processed": 1, "stale": 1, "skipped": 1}
+        issue = Issue.query.get(1001)
+        assert issue.title == "Newer"
+        # the payload doesn't say which repository the issue is in
+        assert issue.repo_id == repo_id
+
+
+def test_ingest_file_processes_conflicting_events_again(app, tmpdir, monkeypatch):
+    conflicts = []
+    real_process_event = archive.process_event
+    def process_event(*args, **kwargs):
+        result = real_process_event(*args, **kwargs)
+        if not conflicts:
+            # another worker inserted the same issue first
+            conflicts.append(True)
+            raise IntegrityError("INSERT", {}, Exception("duplicate key"))
+        return result
+    monkeypatch.setattr(archive, "process_event", process_event)
+
+    path = str(tmpdir.join("2015-01-01-15.json.gz"))
+    write_archive(path, [{
+        "type": "IssuesEvent", "created_at": "2015-01-01T15:30:00Z",
+        "repo": {"id": 1, "name": "octocat/Hello-World"},
+        "payload": {"action": "opened", "issue": {
+            "id": 1001, "number": 7, "state": "open", "title": "Broken",
+            "labels": [], "milestone": None,
+        }},
+    }])
+    with app.test_request_context('/'):
+        result_path, counts = ingest_file((path, None, None))
+        assert counts == {"processed": 1}
+        assert Issue.query.get(1001).title == "Broken"
@@ -0,0 +1,224 @@
+from __future__ import unicode_literals
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from webhookdb import db
+from webhookdb.models import Issue, IssueLabel, PullRequest, User
+from webhookdb.models.github import label_association_table
+from webhookdb.process import bulk
+from webhookdb.process.bulk import (
+    copy_value, copy_rows, bulk_load_available,
+    bulk_process_issues, bulk_process_pull_requests,
+)
+from webhookdb.tasks import issue as issue_tasks
+from webhookdb.tasks import pull_request as pr_tasks
+
+
+def test_copy_value():
+    assert copy_value(None) == "\\N"
+    assert copy_value(True) == "t"
+    assert copy_value(42) == "42"
+    assert copy_value(datetime(2015, 1, 2, 3, 4, 5)) == "2015-01-02T03:04:05"
+    assert copy_value("tab\there\nback\\slash") == "tab\\there\\nback\\\\slash"
+    assert copy_value(b"\x01\xff") == "\\\\x01ff"
+
+
+def issue_payload(issue_id, number, labels=()):
+    return {
+        "id": issue_id, "number": number, "state": "open", "title": "Broken",
+        "body": "", "comments": 2, "milestone": None,
+        "user": {"id": 501, "login": "octocat"}, "assignee": None,
+        "labels": [{"name": name, "color": "ff0000"} for name in labels],
+        "created_at": "2015-01-01T00:00:00Z",
+        "updated_at": "2015-01-01T00:00:00Z",
+    }
+
+
+def test_bulk_load_available(app, repo_factory, monkeypatch):
+    with app.test_request_context('/'):
+        repo = repo_factory()
+        db.session.commit()
+        query = Issue.query.filter_by(repo_id=repo.id)
+        # there's no COPY on sqlite
+        assert not bulk_load_available(query)
+        monkeypatch.setattr(db.engine.dialect, "name", "postgresql")
+        assert bulk_load_available(query)
+        app.config["BULK_LOAD_ENABLED"] = False
+        assert not bulk_load_available(query)
+        app.config["BULK_LOAD_ENABLED"] = True
+        db.session.add(Issue(id=1, number=1, repo_id=repo.id))
+        db.session.commit()
+        assert not bulk_load_available(query)
+
+
+class FakeResult(object):
+    rowcount = 1
+
+
+class FakeCursor(object):
+    def __init__(self, copied):
+        self.copied = copied
+
+    def copy_expert(self, sql, data):
+        self.copied.append((sql, data.read().decode("utf-8")))
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.statements = []
+        self.copied = []
+        self.connection = self
+
+    def cursor(self):
+        return FakeCursor(self.copied)
+
+    def execute(self, sql):
+        self.statements.append(sql)
+        return FakeResult()
+
+
+def test_copy_rows(app, monkeypatch):
+    connection = FakeConnection()
+    with app.test_request_context('/'):
+        monkeypatch.setattr(db.session, "connection", lambda: connection)
+        rows = [
+            {"issue_id": 1, "label_name": "bug"},
+            {"issue_id": 1, "label_name": "bug"},
+            {"issue_id": 2, "label_name": None},
+        ]
+        assert copy_rows(label_association_table, rows) == 1
+        assert copy_rows(label_association_table, []) == 0
+
+    create, truncate, insert = connection.statements
+    assert "CREATE TEMPORARY TABLE IF NOT EXISTS staging_github_issue_label_association" in create
+    assert truncate == "TRUNCATE staging_github_issue_label_association"
+    # no primary key, so every column is matched
+    assert "t.issue_id = s.issue_id AND t.label_name = s.label_name" in insert
+    [(sql, data)] = connection.copied
+    assert sql == "COPY staging_github_issue_label_association (issue_id, label_name) FROM STDIN"
+    # duplicates are dropped before they're copied
+    assert data == "1\tbug\n2\t\\N\n"
+
+
+def test_bulk_process_issues(app, repo_factory, monkeypatch):
+    copied = {}
+    def fake_copy_rows(table, rows):
+        copied[table.name] = rows
+        return len(rows)
+    monkeypatch.setattr(bulk, "copy_rows", fake_copy_rows)
+
+    with app.test_request_context('/'):
+        repo = repo_factory()
+        db.session.add(Issue(id=2, number=2, repo_id=repo.id, title="Old"))
+        db.session.commit()
+        issues_data = [
+            issue_payload(1, 1, labels=["bug"]),
+            issue_payload(2, 2),
+        ]
+        assert bulk_process_issues(issues_data, repo.id) == [1, 2]
+
+        [row] = copied[Issue.__tablename__]
+        assert row["id"] == 1
+        assert row["repo_id"] == repo.id
+        assert row["comments_count"] == 2
+        assert row["user_id"] == 501
+        assert row["created_at"] == datetime(2015, 1, 1)
+        assert copied[label_association_table.name] == [{"issue_id": 1, "label_name": "bug"}]
+        # the referenced objects go through the normal path
+        assert User.query.get(501).login == "octocat"
+        assert IssueLabel.get(repo.owner_login, repo.name, "bug")
+        # and so does the issue that was already there
+        assert Issue.query.get(2).title == "Broken"
+
+
+def test_bulk_process_pull_requests(app, repo_factory, monkeypatch):
+    copied = {}
+    monkeypatch.setattr(bulk, "copy_rows",
+                        lambda table, rows: copied.setdefault(table.name, rows))
+
+    with app.test_request_context('/'):
+        repository = repo_factory()
+        db.session.commit()
+        repo_data = {
+            "id": repository.id, "name": repository.name,
+            "owner": {"id": repository.owner_id, "login": repository.owner_login},
+        }
+        pr_data = {
+            "id": 3, "number": 3, "state": "open", "title": "Fix",
+            "comments": 0, "review_comments": 1, "commits": 2,
+            "user": {"id": 501, "login": "octocat"},
+            "base": {"ref": "master", "sha": "a" * 40, "repo": repo_data},
+            "head": {"ref": "fix", "sha": "b" * 40, "repo": None},
+            "created_at": "2015-01-01T00:00:00Z",
+        }
+        assert bulk_process_pull_requests([pr_data]) == [3]
+
+        [row] = copied[PullRequest.__tablename__]
+        assert row["base_repo_id"] == repository.id
+        assert row["head_repo_id"] is None
+        assert row["head_sha"] == "b" * 40
+        assert row["review_comments_count"] == 1
+        assert row["commits_count"] == 2
+        assert row["merged_at"] is None
+        assert User.query.get(501).login == "octocat"
+
+
+class FakePage(object):
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def conflicting_bulk_load(*args, **kwargs):
+    raise IntegrityError("INSERT", {}, Exception("duplicate key"))
+
+
+def test_sync_page_of_issues_falls_back_after_a_conflict(
+        app, repo_factory, monkeypatch):
+    pages = [[issue_payload(1, 1), issue_payload(2, 2)], [issue_payload(3, 3)]]
+    monkeypatch.setattr(
+        issue_tasks, "fetch_pages_from_github",
+        lambda url, **kwargs: (FakePage(page) for page in pages),
+    )
+    monkeypatch.setattr(issue_tasks, "bulk_process_issues", conflicting_bulk_load)
+
+    with app.test_request_context('/'):
+        repo = repo_factory()
+        db.session.commit()
+        result = issue_tasks.sync_page_of_issues.run(
+            repo.owner_login, repo.name, bulk=True,
+        )
+        assert sorted(result) == [1, 2, 3]
+        assert sorted(issue.id for issue in Issue.query) == [1, 2, 3]
+
+
+def test_sync_page_of_pull_requests_falls_back_after_a_conflict(
+        app, repo_factory, monkeypatch):
+    def pr_payload(number):
+        return {
+            "id": number, "number": number, "state": "open", "title": "Fix",
+            "user": {"id": 501, "login": "octocat"},
+            "created_at": "2015-01-01T00:00:00Z",
+        }
+    pages = [[pr_payload(1), pr_payload(2)], [pr_payload(3)]]
+    monkeypatch.setattr(
+        pr_tasks, "fetch_pages_from_github",
+        lambda url, **kwargs: (FakePage(page) for page in pages),
+    )
+    monkeypatch.setattr(pr_tasks, "bulk_process_pull_requests", conflicting_bulk_load)
+    spawned = []
+    monkeypatch.setattr(
+        pr_tasks.spawn_page_tasks_for_pull_request_files, "delay",
+        lambda owner, repo, number, **kwargs: spawned.append(number),
+    )
+
+    with app.test_request_context('/'):
+        repo = repo_factory()
+        db.session.commit()
+        result = pr_tasks.sync_page_of_pull_requests.run(
+            repo.owner_login, repo.name, children=True, bulk=True,
+        )
+        assert sorted(result) == [1, 2, 3]
+        assert sorted(pr.id for pr in PullRequest.query) == [1, 2, 3]
+        assert sorted(spawned) == [1, 2, 3]
@@ -0,0 +1,34 @@
+from webhookdb import metrics
+from webhookdb.cache import TokenCache
+from webhookdb.oauth import github_bp
+
+
+def test_token_cache_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("time.time", lambda: now[0])
+    cache = TokenCache(ttl=60)
+    cache.set("key", {"access_token": "abc"})
+    assert cache.get("key") == {"access_token": "abc"}
+    now[0] += 61
+    assert cache.get("key") is None
+
+
+def test_token_cache_invalidate_matches_backend_key():
+    cache = TokenCache(ttl=60)
+    key = github_bp.backend.make_cache_key(github_bp, user_id=42)
+    cache.set(key, {"access_token": "abc"})
+    cache.invalidate(42)
+    assert cache.get(key) is None
+
+
+def test_token_cache_hit_rate():
+    metrics.reset()
+    cache = TokenCache(ttl=60)
+    cache.get("key")
+    cache.set("key", {"access_token": "abc"})
+    cache.get("key")
+    cache.get("key")
+    counters = metrics.snapshot()
+    assert counters["token_cache.hit"] == 2
+    assert counters["token_cache.miss"] == 1
+    assert counters["token_cache.hit_rate"] == 0.667
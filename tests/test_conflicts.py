@@ -0,0 +1,53 @@
+import pytest
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from webhookdb import db, metrics, known_ids
+from webhookdb.known_ids import BloomFilter
+from webhookdb.models import Issue, User
+from webhookdb.process import process_issue
+from webhookdb.process.save import resolve_conflicts, CONFLICT_ATTEMPTS
+
+
+def test_resolve_conflicts(app, user_factory, repo_factory, monkeypatch):
+    # filters that don't know about anything, like ones that were loaded
+    # before another worker inserted the user
+    filters = {}
+    monkeypatch.setattr(known_ids, "get_filter", lambda model: filters.setdefault(
+        model.__tablename__, BloomFilter(capacity=100),
+    ))
+    with app.test_request_context('/'):
+        user = user_factory(login="octocat")
+        repo = repo_factory()
+        db.session.commit()
+        user_id = user.id
+        db.session.expunge_all()
+        metrics.reset()
+        issue_data = {
+            "id": 1001, "number": 7, "state": "open", "title": "Broken",
+            "user": {"id": user_id, "login": "octocat2"},
+        }
+        with known_ids.skip_lookups():
+            issue = resolve_conflicts(
+                process_issue, issue_data, via="api", fetched_at=datetime.now(),
+            )
+        assert issue.id == 1001
+        assert Issue.query.get(1001).user_id == user_id
+        # the existing user was updated instead
+        assert User.query.get(user_id).login == "octocat2"
+        counters = metrics.snapshot()
+        assert counters["conflict.resolved"] == 1
+        assert "conflict.unresolved" not in counters
+
+
+def test_resolve_conflicts_gives_up(app):
+    calls = []
+    def process(obj_data, commit=False):
+        calls.append(commit)
+        raise IntegrityError("INSERT", {}, Exception("duplicate key"))
+
+    with app.test_request_context('/'):
+        metrics.reset()
+        with pytest.raises(IntegrityError):
+            resolve_conflicts(process, {"id": 1})
+    assert calls == [True] * CONFLICT_ATTEMPTS
+    assert metrics.snapshot()["conflict.unresolved"] == 1
@@ -0,0 +1,145 @@
+import time
+import pytest
+from multiprocessing.pool import ThreadPool
+from flask import Flask
+from requests import Response
+from requests.adapters import BaseAdapter
+from urlobject import URLObject
+from webhookdb.tasks import fetch, token_pool
+from webhookdb.tasks.fetch import page_chunks, pages_per_task, page_latency
+from webhookdb.exceptions import RateLimited
+
+
+class FakeResponse(object):
+    status_code = 200
+    ok = True
+
+    def __init__(self, url, last_page=5, remaining=5000):
+        self.url = url
+        last_url = URLObject(url).set_query_param("page", str(last_page))
+        self.links = {"last": {"url": last_url}}
+        self.headers = {"X-RateLimit-Remaining": str(remaining)}
+
+    @property
+    def page(self):
+        return int(URLObject(self.url).query.dict["page"])
+
+
+@pytest.fixture
+def config_app():
+    return Flask(__name__)
+
+
+def test_page_chunks_cover_all_pages():
+    chunks = list(page_chunks(23, chunk_size=10))
+    assert chunks == [(1, 10), (11, 10), (21, 3)]
+
+
+def test_page_chunks_single_page():
+    assert list(page_chunks(1, chunk_size=10)) == [(1, 1)]
+
+
+def test_pages_per_task_fixed(config_app):
+    config_app.config["PAGES_PER_TASK"] = 7
+    with config_app.app_context():
+        assert pages_per_task() == 7
+
+
+def test_pages_per_task_adaptive(config_app, monkeypatch):
+    config_app.config["PAGE_TASK_TARGET_SECONDS"] = 10
+    config_app.config["MAX_PAGES_PER_TASK"] = 20
+    with config_app.app_context():
+        monkeypatch.setattr(page_latency, "value", 0.5)
+        assert pages_per_task() == 20
+        monkeypatch.setattr(page_latency, "value", 2.0)
+        assert pages_per_task() == 5
+        monkeypatch.setattr(page_latency, "value", 30.0)
+        assert pages_per_task() == 1
+
+
+def test_fetch_pages_concurrently(config_app, monkeypatch):
+    monkeypatch.setattr(fetch, "request_github", lambda url, **kw: FakeResponse(url))
+    first = FakeResponse("https://api.github.com/repos/a/b/issues?page=1")
+    with config_app.app_context():
+        responses = fetch.fetch_pages_concurrently(first, 10, concurrency=3)
+        assert sorted(resp.page for resp in responses) == [2, 3, 4, 5]
+
+
+def test_fetch_pages_concurrently_within_rate_budget(config_app, monkeypatch):
+    config_app.config["PAGE_FETCH_RATE_RESERVE"] = 50
+    concurrent = []
+    def request_github(url, **kwargs):
+        resp = FakeResponse(url)
+        if resp.page == 3:
+            raise RateLimited(None)
+        concurrent.append(resp.page)
+        return resp
+    monkeypatch.setattr(fetch, "request_github", request_github)
+    monkeypatch.setattr(fetch, "fetch_url_from_github", lambda url, **kw: FakeResponse(url))
+    first = FakeResponse(
+        "https://api.github.com/repos/a/b/issues?page=1", remaining=52,
+    )
+    with config_app.app_context():
+        responses = list(fetch.fetch_pages_concurrently(first, 4, concurrency=2))
+    # two pages within budget, one of which was rate limited
+    assert concurrent == [2]
+    assert [resp.page for resp in responses] == [2, 3, 4, 5]
+
+
+class RecordingAdapter(BaseAdapter):
+    "Answers every request with 200 OK, after a short wait."
+    def send(self, request, **kwargs):
+        time.sleep(0.01)
+        resp = Response()
+        resp.status_code = 200
+        resp.request = request
+        resp.url = request.url
+        return resp
+
+    def close(self):
+        pass
+
+
+def test_concurrent_requests_use_their_own_token(config_app, monkeypatch):
+    monkeypatch.setitem(fetch.github.adapters, "https://", RecordingAdapter())
+    monkeypatch.setattr(fetch, "token_for", lambda user_id: {
+        "access_token": "token-for-{}".format(user_id),
+    })
+    def request_as(requestor_id):
+        with config_app.app_context():
+            resp = fetch.request_github("/user", requestor_id=requestor_id)
+        return requestor_id, resp.request.headers.get("Authorization")
+
+    pool = ThreadPool(10)
+    try:
+        results = pool.map(request_as, range(1, 51))
+    finally:
+        pool.terminate()
+    for requestor_id, authorization in results:
+        assert authorization == "token token-for-{}".format(requestor_id)
+
+
+def test_token_pool_picks_token_with_most_calls_left(monkeypatch):
+    monkeypatch.setattr(token_pool, "member_ids", lambda: [2, 3])
+    monkeypatch.setattr(token_pool, "_rate_state", {})
+    reset = time.time() + 600
+    for user_id, remaining in ((1, 10), (2, 4000), (3, 200)):
+        resp = Response()
+        resp.headers["X-RateLimit-Remaining"] = str(remaining)
+        resp.headers["X-RateLimit-Reset"] = str(int(reset))
+        token_pool.record_response(user_id, resp)
+    assert token_pool.choose_user_id(requestor_id="1") == 2
+    # once the reset time passes, the requestor's own token is full again
+    monkeypatch.setattr(time, "time", lambda: reset + 1)
+    assert token_pool.choose_user_id(requestor_id="1") == 1
+
+
+def test_token_pool_never_fetches_repository_itself(config_app, monkeypatch):
+    monkeypatch.setattr(token_pool, "_public_repos", {
+        ("octocat", "hello-world"): (True, time.time()),
+    })
+    with config_app.app_context():
+        assert token_pool.is_public("/repos/octocat/Hello-World/issues?page=2")
+        # its permissions would be the pooled user's, not the requestor's
+        assert not token_pool.is_public("/repos/octocat/Hello-World")
+        assert not token_pool.is_public("/repos/octocat/Hello-World/hooks")
@@ -0,0 +1,153 @@
+from datetime import datetime
+from webhookdb import db
+from webhookdb.models import Issue
+from webhookdb.process import process_issue
+from webhookdb.tasks import graphql
+from webhookdb.tasks.graphql import rest_issue, rest_pull_request
+
+
+def actor(login, database_id):
+    return {"login": login, "databaseId": database_id}
+
+
+def test_rest_pull_request():
+    node = {
+        "databaseId": 1234, "number": 7, "state": "MERGED", "locked": False,
+        "title": "Fix it", "body": "", "merged": True,
+        "mergeable": "CONFLICTING",
+        "additions": 10, "deletions": 2, "changedFiles": 3,
+        "createdAt": "2015-01-01T00:00:00Z",
+        "updatedAt": "2015-01-02T00:00:00Z",
+        "closedAt": "2015-01-02T00:00:00Z",
+        "mergedAt": "2015-01-02T00:00:00Z",
+        "author": actor("octocat", 1),
+        "mergedBy": actor("hubot", 2),
+        "assignees": {"nodes": []},
+        "comments": {"totalCount": 4},
+        "commits": {"totalCount": 5},
+        "baseRefName": "master", "baseRefOid": "a" * 40,
+        "baseRepository": {
+            "databaseId": 99, "name": "Hello-World",
+            "owner": actor("octocat", 1),
+        },
+        "headRefName": "fix", "headRefOid": "b" * 40,
+        "headRepository": None,
+    }
+    pr = rest_pull_request(node, "octocat", "Hello-World")
+    assert pr["id"] == 1234
+    assert pr["state"] == "closed"
+    assert pr["mergeable"] is False
+    assert pr["changed_files"] == 3
+    assert pr["comments"] == 4
+    assert pr["commits"] == 5
+    assert pr["user"] == {"id": 1, "login": "octocat"}
+    assert pr["merged_by"] == {"id": 2, "login": "hubot"}
+    assert pr["assignee"] is None
+    assert pr["base"]["repo"]["owner"]["login"] == "octocat"
+    assert pr["base"]["sha"] == "a" * 40
+    assert pr["head"] == {"ref": "fix", "sha": "b" * 40, "repo": None}
+
+
+def test_rest_issue_links_labels_and_milestone_to_repo():
+    node = {
+        "databaseId": 5678, "number": 8, "state": "OPEN",
+        "title": "Broken", "body": "it's broken",
+        "createdAt": "2015-01-01T00:00:00Z",
+        "updatedAt": "2015-01-02T00:00:00Z",
+        "closedAt": None,
+        "author": {"login": "ghost"},
+        "assignees": {"nodes": [actor("hubot", 2)]},
+        "comments": {"totalCount": 0},
+        "labels": {"nodes": [{"name": "bug", "color": "fc2929"}]},
+        "milestone": {
+            "number": 1, "state": "OPEN", "title": "v1", "description": "",
+            "dueOn": None, "createdAt": "2015-01-01T00:00:00Z",
+            "updatedAt": "2015-01-01T00:00:00Z", "closedAt": None,
+            "creator": actor("octocat", 1),
+            "openIssues": {"totalCount": 1},
+            "closedIssues": {"totalCount": 0},
+        },
+    }
+    issue = rest_issue(node, "octocat", "Hello-World")
+    assert issue["state"] == "open"
+    # deleted users don't have a database ID
+    assert issue["user"] is None
+    assert issue["assignee"] == {"id": 2, "login": "hubot"}
+    assert issue["labels"][0]["url"] == (
+        "https://api.github.com/repos/octocat/Hello-World/labels/bug"
+    )
+    assert issue["milestone"]["url"] == (
+        "https://api.github.com/repos/octocat/Hello-World/milestones/1"
+    )
+    assert issue["milestone"]["open_issues"] == 1
+
+
+def test_graphql_sync_repository_links_issues_to_repo(app, repo_factory,
+                                                      monkeypatch):
+    issue_node = {
+        "databaseId": 5678, "number": 8, "state": "OPEN",
+        "title": "Broken", "body": "",
+        "createdAt": "2015-01-01T00:00:00Z",
+        "updatedAt": "2015-01-02T00:00:00Z",
+        "closedAt": None,
+        "author": actor("octocat", 1),
+        "assignees": {"nodes": []},
+        "comments": {"totalCount": 0},
+        "labels": {"nodes": []},
+        "milestone": None,
+    }
+    with app.test_request_context('/'):
+        repo = repo_factory()
+        db.session.commit()
+        owner, name, repo_id = repo.owner_login, repo.name, repo.id
+        monkeypatch.setattr(graphql, "fetch_graphql", lambda *args, **kwargs: {
+            "repository": {"databaseId": repo_id, "issues": {
+                "pageInfo": {"hasNextPage": False, "endCursor": None},
+                "nodes": [issue_node],
+            }},
+        })
+        monkeypatch.setattr(
+            graphql.issue.dispatch_pending_tasks, "delay", lambda: None,
+        )
+
+        assert graphql.graphql_sync_repository.run(
+            owner, name, kinds=["issues"],
+        ) == ["issues"]
+        # there are no labels or milestone to say which repository it's in
+        assert Issue.query.get(5678).repo_id == repo_id
+
+
+def test_graphql_data_is_not_stored_as_raw_payload(app, repo_factory):
+    app.config["STORE_RAW_PAYLOADS"] = True
+    node = {
+        "databaseId": 5678, "number": 8, "state": "CLOSED",
+        "title": "Fixed", "body": "",
+        "createdAt": "2015-01-01T00:00:00Z",
+        "updatedAt": "2015-01-03T00:00:00Z",
+        "closedAt": "2015-01-03T00:00:00Z",
+        "author": actor("octocat", 1),
+        "assignees": {"nodes": []},
+        "comments": {"totalCount": 0},
+        "labels": {"nodes": []},
+        "milestone": None,
+    }
+    with app.test_request_context('/'):
+        repo = repo_factory()
+        db.session.commit()
+        owner, name, repo_id = repo.owner_login, repo.name, repo.id
+        issue_url = "https://api.github.com/repos/{}/{}/issues/8".format(owner, name)
+        process_issue({
+            "id": 5678, "number": 8, "state": "open", "title": "Broken",
+            "url": issue_url, "user": {"id": 1, "login": "octocat"},
+        }, via="api", fetched_at=datetime(2015, 1, 2), repo_id=repo_id)
+        assert Issue.query.get(5678).raw_payload is not None
+
+        graphql.process_node(
+            "issues", node, owner, name, datetime(2015, 1, 3), repo_id=repo_id,
+        )
+        issue = Issue.query.get(5678)
+        # the payload that Github sent is out of date, and the GraphQL data
+        # doesn't have everything, so github_json is rebuilt instead
+        assert issue.raw_payload is None
+        assert issue.github_json["title"] == "Fixed"
+        assert issue.github_json["url"] == issue_url
@@ -51,3 +51,7 @@ def test_happy_path(app, user_factory, repo_factory, pull_request_factory):
         assert pr.body == "Please pull these awesome changes"
         assert pr.user.login == "unoju"
 
+        assert pr.head_sha and pr.head_sha != pr.base_sha
+
+        # a new head commit means the files were fetched
+        assert PullRequestFile.query.filter_by(pull_request_id=pr.id).count() == 1
@@ -0,0 +1,254 @@
+import pytest
+from datetime import datetime
+from webhookdb import db
+from webhookdb.models import PullRequest, PullRequestFile, PullRequestPatch, Mutex
+from webhookdb.process import process_pull_request_files
+from webhookdb.tasks import pull_request_file
+from webhookdb import upgrade
+from webhookdb.upgrade import move_patches_out_of_line, add_filename_to_file_key
+
+
+def file_data(filename, sha, patch="@@ -1 +1 @@"):
+    return {
+        "filename": filename, "sha": sha, "status": "modified",
+        "additions": 1, "deletions": 1, "changes": 2, "patch": patch,
+    }
+
+
+def test_process_pull_request_files_diffs_by_filename_and_sha(app):
+    with app.test_request_context('/'):
+        db.session.add(PullRequest(id=1, number=1))
+        db.session.commit()
+        saved, removed = process_pull_request_files(
+            [file_data("a.txt", "a1"), file_data("b.txt", "b1")],
+            via="api", fetched_at=datetime(2015, 1, 1), pull_request_id=1,
+        )
+        assert (saved, removed) == (2, 0)
+
+        saved, removed = process_pull_request_files(
+            [file_data("a.txt", "a1"), file_data("c.txt", "c1")],
+            via="api", fetched_at=datetime(2015, 1, 2), pull_request_id=1,
+        )
+        # a.txt didn't change, so it wasn't written again
+        assert (saved, removed) == (1, 1)
+        a = PullRequestFile.query.get((1, "a.txt", "a1"))
+        assert a.last_replicated_via_api_at == datetime(2015, 1, 1)
+        files = PullRequestFile.query.filter_by(pull_request_id=1)
+        assert sorted(prf.filename for prf in files) == ["a.txt", "c.txt"]
+
+
+def test_patches_are_compressed_and_deduplicated(app):
+    with app.test_request_context('/'):
+        db.session.add(PullRequest(id=2, number=2))
+        db.session.commit()
+        patch = "@@ -1,3 +1,3 @@\n" + "-old line\n+new line\n" * 100
+        process_pull_request_files(
+            [file_data("a.txt", "a1", patch), file_data("b.txt", "b1", patch)],
+            via="api", pull_request_id=2,
+        )
+        assert PullRequestPatch.query.count() == 1
+        stored = PullRequestPatch.query.one()
+        assert stored.size == len(patch)
+        assert len(stored.data) < len(patch)
+        assert PullRequestFile.query.get((2, "b.txt", "b1")).patch == patch
+
+
+def test_shared_patches_are_collected_with_their_last_file(app):
+    with app.test_request_context('/'):
+        db.session.add(PullRequest(id=3, number=3))
+        db.session.add(PullRequest(id=4, number=4))
+        db.session.commit()
+        patch = "@@ -1 +1 @@\n-backport\n+backported\n"
+        for pr_id in (3, 4):
+            process_pull_request_files(
+                [file_data("a.txt", "a1", patch)], pull_request_id=pr_id,
+            )
+        assert PullRequestPatch.query.count() == 1
+
+        process_pull_request_files([], pull_request_id=3)
+        assert PullRequestPatch.query.count() == 1
+        process_pull_request_files(
+            [file_data("a.txt", "a1", "@@ -1 +1 @@\n-a\n+b\n")],
+            pull_request_id=4,
+        )
+        assert PullRequestPatch.query.count() == 1
+        assert PullRequestPatch.query.one().text == "@@ -1 +1 @@\n-a\n+b\n"
+
+
+def test_files_with_the_same_contents_are_kept_apart(app):
+    with app.test_request_context('/'):
+        db.session.add(PullRequest(id=5, number=5))
+        db.session.commit()
+        empty = "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391"
+        process_pull_request_files(
+            [file_data("a/__init__.py", empty), file_data("b/__init__.py", empty)],
+            pull_request_id=5,
+        )
+        assert PullRequestFile.query.filter_by(pull_request_id=5).count() == 2
+
+        # renamed, without changing its contents
+        saved, removed = process_pull_request_files(
+            [file_data("a/__init__.py", empty), file_data("c/__init__.py", empty)],
+            pull_request_id=5,
+        )
+        assert (saved, removed) == (1, 1)
+        files = PullRequestFile.query.filter_by(pull_request_id=5)
+        assert sorted(prf.filename for prf in files) == [
+            "a/__init__.py", "c/__init__.py",
+        ]
+
+
+class FakeResponse(object):
+    def __init__(self, page, files, last_page):
+        self.url = "https://api.github.com/files?page={}".format(page)
+        self.files = files
+        self.links = {}
+        if page < last_page:
+            self.links["next"] = {"url": "/files?page={}".format(page + 1)}
+
+    def json(self):
+        return self.files
+
+
+def test_file_scan_follows_pages_past_changed_files(app, monkeypatch):
+    # changed_files said one page, but there are two
+    monkeypatch.setattr(
+        pull_request_file, "fetch_pages_from_github",
+        lambda url, pages, requestor_id: [
+            FakeResponse(1, [file_data("a.txt", "a1")], last_page=2),
+        ],
+    )
+    monkeypatch.setattr(
+        pull_request_file, "fetch_url_from_github",
+        lambda url, requestor_id: FakeResponse(
+            2, [file_data("b.txt", "b1")], last_page=2,
+        ),
+    )
+    monkeypatch.setattr(pull_request_file.dispatch_pending_tasks, "delay", lambda: None)
+    with app.test_request_context('/'):
+        db.session.add(PullRequest(id=6, number=6))
+        db.session.commit()
+        process_pull_request_files(
+            [file_data("a.txt", "a1"), file_data("b.txt", "b1")],
+            pull_request_id=6,
+        )
+        result = pull_request_file.sync_pages_of_pull_request_files.run(
+            "octocat", "Hello-World", 6, pull_request_id=6, pages=1,
+        )
+        assert result == {"saved": 0, "removed": 0}
+        assert PullRequestFile.query.filter_by(pull_request_id=6).count() == 2
+
+
+def test_failed_file_scan_releases_its_lock(app, monkeypatch):
+    def fail(url, pages, requestor_id):
+        raise IOError("connection reset")
+    monkeypatch.setattr(pull_request_file, "fetch_pages_from_github", fail)
+    with app.test_request_context('/'):
+        db.session.add(PullRequest(id=7, number=7))
+        lock_name = pull_request_file.LOCK_TEMPLATE.format(
+            owner="octocat", repo="Hello-World", number=7,
+        )
+        db.session.add(Mutex(name=lock_name))
+        db.session.commit()
+        with pytest.raises(IOError):
+            pull_request_file.sync_pages_of_pull_request_files.run(
+                "octocat", "Hello-World", 7, pull_request_id=7,
+            )
+        assert Mutex.query.get(lock_name) is None
+
+
+def test_file_scan_survives_a_concurrent_insert_of_the_same_patch(app, monkeypatch):
+    patch = "@@ -1 +1 @@\n-a\n+b\n"
+    calls = []
+    def process_racing_another_scan(*args, **kwargs):
+        result = process_pull_request_files(*args, **kwargs)
+        if not calls:
+            # another scan stores the same patch before we commit
+            db.session.execute(PullRequestPatch.__table__.insert().values(
+                hash=PullRequestPatch.hash_text(patch), data=b"", size=0,
+            ))
+        calls.append(result)
+        return result
+    monkeypatch.setattr(
+        pull_request_file, "process_pull_request_files", process_racing_another_scan,
+    )
+    monkeypatch.setattr(
+        pull_request_file, "fetch_pages_from_github",
+        lambda url, pages, requestor_id: [
+            FakeResponse(1, [file_data("a.txt", "a1", patch)], last_page=1),
+        ],
+    )
+    monkeypatch.setattr(pull_request_file.dispatch_pending_tasks, "delay", lambda: None)
+    with app.test_request_context('/'):
+        db.session.add(PullRequest(id=8, number=8))
+        db.session.commit()
+        result = pull_request_file.sync_pages_of_pull_request_files.run(
+            "octocat", "Hello-World", 8, pull_request_id=8,
+        )
+        assert len(calls) == 2
+        assert result == {"saved": 1, "removed": 0}
+        assert PullRequestFile.query.get((8, "a.txt", "a1")).patch == patch
+
+
+def test_move_patches_out_of_line(app):
+    with app.test_request_context('/'):
+        db.session.add(PullRequest(id=9, number=9))
+        db.session.commit()
+        # a table from before patches were stored out of line
+        db.session.execute(
+            "ALTER TABLE github_pull_request_file ADD COLUMN patch TEXT"
+        )
+        for filename, sha in (("a.txt", "a1"), ("b.txt", "b1"), ("c.txt", "c1")):
+            db.session.execute(
+                "INSERT INTO github_pull_request_file "
+                "(pull_request_id, filename, sha, patch) "
+                "VALUES (9, :filename, :sha, :patch)",
+                {"filename": filename, "sha": sha,
+                 "patch": None if sha == "c1" else "@@ -1 +1 @@\n-old\n+new\n"},
+            )
+        db.session.commit()
+
+        assert move_patches_out_of_line(batch_size=1, drop=True) == 2
+        assert PullRequestPatch.query.count() == 1
+        moved = PullRequestFile.query.get((9, "b.txt", "b1"))
+        assert moved.patch == "@@ -1 +1 @@\n-old\n+new\n"
+        assert PullRequestFile.query.get((9, "c.txt", "c1")).patch is None
+        # nothing left to move
+        assert move_patches_out_of_line() == 0
+
+
+class OldInspector(object):
+    "Describes a pull request file table from before filenames were in its key."
+    def get_pk_constraint(self, table_name):
+        return {
+            "name": "github_pull_request_file_pkey",
+            "constrained_columns": ["pull_request_id", "sha"],
+        }
+
+
+def test_add_filename_to_file_key(app, monkeypatch):
+    with app.test_request_context('/'):
+        # tables created now have it already
+        assert add_filename_to_file_key() is False
+
+        statements = []
+        monkeypatch.setattr(upgrade, "inspect", lambda engine: OldInspector())
+        monkeypatch.setattr(db.session, "execute", statements.append)
+        assert add_filename_to_file_key() is True
+    assert statements == [
+        "ALTER TABLE github_pull_request_file "
+        "DROP CONSTRAINT github_pull_request_file_pkey",
+        "ALTER TABLE github_pull_request_file "
+        "ADD PRIMARY KEY (pull_request_id, filename, sha)",
+    ]
+
+
+def test_serializing_files_whose_fork_was_deleted(app):
+    with app.test_request_context('/'):
+        db.session.add(PullRequest(id=10, number=10))
+        db.session.commit()
+        process_pull_request_files([file_data("a.txt", "a1")], pull_request_id=10)
+        serialized = PullRequestFile.query.get((10, "a.txt", "a1")).github_json
+        assert serialized["filename"] == "a.txt"
+        assert serialized["blob_url"] is None
+        assert serialized["contents_url"] is None
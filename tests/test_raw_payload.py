@@ -0,0 +1,21 @@
+from datetime import datetime
+from webhookdb.models import User
+from webhookdb.process import process_user
+
+
+def test_github_json_is_served_from_merged_raw_payload(app):
+    app.config["STORE_RAW_PAYLOADS"] = True
+    with app.test_request_context('/'):
+        process_user({
+            "id": 1, "login": "octocat", "bio": "There once was...",
+            "avatar_url": "https://example.com/octocat.png",
+        }, via="api", fetched_at=datetime(2015, 1, 1))
+        # payloads often include an abbreviated version of a user
+        process_user({
+            "id": 1, "login": "octocat2",
+        }, via="webhook", fetched_at=datetime(2015, 1, 2))
+
+        serialized = User.query.get(1).github_json
+        assert serialized["login"] == "octocat2"
+        assert serialized["bio"] == "There once was..."
+        assert serialized["avatar_url"] == "https://example.com/octocat.png"
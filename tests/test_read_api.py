@@ -0,0 +1,114 @@
+import json
+import zlib
+from datetime import datetime
+from webhookdb import db
+from webhookdb.models import Issue
+from webhookdb.tasks import issue as issue_tasks
+
+
+def test_issues_are_paginated_by_number(app, user_factory, repo_factory):
+    with app.test_request_context('/'):
+        octocat = user_factory(login="octocat")
+        repo = repo_factory(name="Hello-World", owner=octocat)
+        for number in range(1, 6):
+            db.session.add(Issue(
+                id=number, repo_id=repo.id, number=number, state="open",
+                user=octocat, user_login="octocat",
+                created_at=datetime(2015, 1, number),
+                updated_at=datetime(2015, 1, number),
+            ))
+        db.session.commit()
+
+    client = app.test_client()
+    url = "/api/repos/octocat/Hello-World/issues?per_page=2&since=2015-01-02T00:00:00Z"
+    numbers = []
+    while url:
+        resp = client.get(url, base_url="https://localhost/")
+        assert resp.status_code == 200
+        numbers.extend(issue["number"] for issue in json.loads(resp.data))
+        link = resp.headers.get("Link")
+        if link:
+            assert link.startswith("<https://localhost/api/")
+            url = link[len("<https://localhost"):link.index(">")]
+        else:
+            url = None
+    assert numbers == [2, 3, 4, 5]
+
+
+def test_private_repositories_are_hidden(app, user_factory, repo_factory):
+    with app.test_request_context('/'):
+        octocat = user_factory(login="octocat")
+        repo_factory(name="secret", owner=octocat, private=True)
+        db.session.commit()
+
+    client = app.test_client()
+    assert client.get("/api/repos/octocat/secret", base_url="https://localhost/").status_code == 404
+    assert json.loads(client.get("/api/repos?owner=octocat", base_url="https://localhost/").data) == []
+
+
+def test_export_resumes_from_cursor(app, user_factory, repo_factory):
+    with app.test_request_context('/'):
+        octocat = user_factory(login="octocat")
+        repo = repo_factory(name="Hello-World", owner=octocat)
+        for number in range(1, 4):
+            db.session.add(Issue(
+                id=number, repo_id=repo.id, number=number, state="open",
+                user=octocat, user_login="octocat",
+            ))
+        db.session.commit()
+
+    client = app.test_client()
+    url = "/api/export/octocat/Hello-World?kinds=repository,issue&gzip=1"
+    resp = client.get(url, base_url="https://localhost/")
+    assert resp.headers["Content-Encoding"] == "gzip"
+    lines = zlib.decompress(resp.data, 16 + zlib.MAX_WBITS).splitlines()
+    records = [json.loads(line) for line in lines]
+    assert [r["type"] for r in records] == ["repository", "issue", "issue", "issue"]
+    assert records[1]["data"]["number"] == 1
+
+    resp = client.get(
+        "/api/export/octocat/Hello-World?kinds=repository,issue&cursor=" +
+        records[1]["cursor"],
+        base_url="https://localhost/",
+    )
+    resumed = [json.loads(line) for line in resp.data.splitlines()]
+    assert [r["data"]["number"] for r in resumed] == [2, 3]
+
+
+class FakeResponse(object):
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def test_synced_issues_without_labels_are_listed(app, user_factory, repo_factory,
+                                                 monkeypatch):
+    def issue_payload(number):
+        return {
+            "id": number, "number": number, "state": "open", "title": "Broken",
+            "labels": [], "milestone": None,
+            "user": {"id": 501, "login": "hubot"},
+            "updated_at": "2015-01-01T00:00:00Z",
+        }
+    monkeypatch.setattr(
+        issue_tasks, "fetch_url_from_github",
+        lambda url, **kwargs: FakeResponse(issue_payload(1)),
+    )
+    monkeypatch.setattr(
+        issue_tasks, "fetch_pages_from_github",
+        lambda url, **kwargs: iter([FakeResponse([issue_payload(2)])]),
+    )
+    with app.test_request_context('/'):
+        octocat = user_factory(login="octocat")
+        repo_factory(name="Hello-World", owner=octocat)
+        db.session.commit()
+        issue_tasks.sync_issue.run("octocat", "Hello-World", 1)
+        issue_tasks.sync_page_of_issues.run("octocat", "Hello-World")
+
+    client = app.test_client()
+    resp = client.get(
+        "/api/repos/octocat/Hello-World/issues", base_url="https://localhost/",
+    )
+    assert [issue["number"] for issue in json.loads(resp.data)] == [1, 2]
@@ -0,0 +1,102 @@
+import json
+from colour import Color
+from sqlalchemy.exc import IntegrityError
+from webhookdb import db, metrics, replay
+from webhookdb.models import IssueLabel, PullRequest, User, WebhookEvent
+from webhookdb.process import log_event
+from webhookdb.replay import replay_events
+from webhookdb.serialize import GithubJSONEncoder
+
+
+def test_replay_rebuilds_from_event_log(app, pull_request_factory):
+    with app.test_request_context('/'):
+        pr = pull_request_factory(title="From the log")
+        db.session.commit()
+        pr_id = pr.id
+        payload = json.loads(json.dumps({
+            "action": "opened",
+            "pull_request": pr.github_json,
+            "repository": pr.base_repo.github_json,
+        }, cls=GithubJSONEncoder))
+        headers = {
+            "X-Github-Event": "pull_request",
+            "X-Github-Delivery": "72d3162e-cc78-11e3-81ab-4c9367dc0958",
+            "Authorization": "not logged",
+        }
+        logged = log_event("pull_request", headers, payload)
+        assert logged.repo_id == pr.base_repo.id
+        assert "Authorization" not in logged.headers
+        # redeliveries aren't logged again
+        assert log_event("pull_request", headers, payload) is None
+
+        PullRequest.query.delete()
+        db.session.commit()
+
+        counts = replay_events(WebhookEvent.query)
+        assert counts["processed"] == 1
+        assert PullRequest.query.get(pr_id).title == "From the log"
+
+
+def test_replay_uses_the_webhook_handlers(app, pull_request_factory):
+    with app.test_request_context('/'):
+        pr = pull_request_factory()
+        pr.review_comments_count = 2
+        db.session.commit()
+        pr_id, repo_id = pr.id, pr.base_repo_id
+        db.session.add(IssueLabel(repo_id=repo_id, name="bug", color=Color("#ff0000")))
+        db.session.commit()
+        events = [
+            ("label", {
+                "action": "edited",
+                "label": {"name": "defect", "color": "ff0000"},
+                "changes": {"name": {"from": "bug"}},
+                "repository": {"id": repo_id},
+            }),
+            ("pull_request_review_comment", {
+                "action": "created",
+                "pull_request": {"id": pr_id},
+                "repository": {"id": repo_id},
+            }),
+            ("watch", {"action": "started", "repository": {"id": repo_id}}),
+        ]
+        for number, (event, payload) in enumerate(events):
+            log_event(event, {"X-Github-Delivery": str(number)}, payload)
+
+        counts = replay_events(WebhookEvent.query)
+        assert counts == {"processed": 2, "ignored": 1}
+        assert IssueLabel.query.get((repo_id, "bug")) is None
+        assert IssueLabel.query.get((repo_id, "defect")) is not None
+        assert PullRequest.query.get(pr_id).review_comments_count == 3
+
+        # replaying again doesn't count the review comment twice
+        replay_events(WebhookEvent.query)
+        assert PullRequest.query.get(pr_id).review_comments_count == 3
+
+
+def test_replay_processes_conflicting_events_again(app, user_factory, monkeypatch):
+    conflicts = []
+    real_process_event = replay.process_event
+    def process_event(*args, **kwargs):
+        result = real_process_event(*args, **kwargs)
+        if not conflicts:
+            # another process inserted the same user first
+            conflicts.append(True)
+            raise IntegrityError("INSERT", {}, Exception("duplicate key"))
+        return result
+    monkeypatch.setattr(replay, "process_event", process_event)
+
+    with app.test_request_context('/'):
+        payload = {
+            "action": "edited",
+            "member": {"id": 501, "login": "octocat"},
+            "changes": {"permission": {"to": "admin"}},
+            "repository": {"id": 1},
+        }
+        log_event("member", {"X-Github-Delivery": "1"}, payload)
+        metrics.reset()
+
+        counts = replay_events(WebhookEvent.query)
+        assert counts == {"processed": 1}
+        assert User.query.get(501).login == "octocat"
+        assert metrics.snapshot()["conflict.resolved"] == 1
+        assert WebhookEvent.query.one().processed_at is not None
@@ -0,0 +1,330 @@
+import json
+import pytest
+from colour import Color
+from webhookdb import db
+from webhookdb.models import (
+    Issue, IssueLabel, Milestone, PullRequest, UserRepoAssociation, WebhookEvent,
+    OAuth,
+)
+from webhookdb.models.github import label_association_table
+from webhookdb.process import event as event_module
+from webhookdb.tasks import repository as repository_tasks
+
+
+def post_event(client, event, payload, delivery_id=None):
+    headers = {"X-Github-Event": event, "Content-Type": "application/json"}
+    if delivery_id:
+        headers["X-Github-Delivery"] = delivery_id
+    return client.post(
+        "/replication",
+        base_url="https://webhookdb.herokuapp.com/",
+        headers=headers,
+        data=json.dumps(payload),
+    )
+
+
+def test_label_renamed_and_deleted(app, repo_factory):
+    with app.test_request_context('/'):
+        repo = repo_factory()
+        db.session.add(IssueLabel(repo_id=repo.id, name="bug", color=Color("#ff0000")))
+        db.session.commit()
+        repo_id = repo.id
+    client = app.test_client()
+    repo_json = {"id": repo_id}
+
+    resp = post_event(client, "label", {
+        "action": "edited",
+        "label": {"name": "defect", "color": "ff0000"},
+        "changes": {"name": {"from": "bug"}},
+        "repository": repo_json,
+    })
+    assert resp.status_code == 200
+    with app.test_request_context('/'):
+        assert IssueLabel.query.get((repo_id, "bug")) is None
+        assert IssueLabel.query.get((repo_id, "defect")) is not None
+
+    resp = post_event(client, "label", {
+        "action": "deleted",
+        "label": {"name": "defect", "color": "ff0000"},
+        "repository": repo_json,
+    })
+    assert resp.status_code == 200
+    with app.test_request_context('/'):
+        assert IssueLabel.query.filter_by(repo_id=repo_id).count() == 0
+
+
+def test_milestone_deleted(app, pull_request_factory, milestone_factory):
+    with app.test_request_context('/'):
+        pr = pull_request_factory()
+        milestone = milestone_factory(repo=pr.base_repo)
+        db.session.commit()
+        pr.milestone_number = milestone.number
+        pr.review_comments_count = 2
+        pr.raw_payload = b"stale"
+        db.session.commit()
+        pr_id, repo_id, number = pr.id, pr.base_repo_id, milestone.number
+    client = app.test_client()
+
+    resp = post_event(client, "milestone", {
+        "action": "deleted",
+        "milestone": {"number": number},
+        "repository": {"id": repo_id},
+    })
+    assert resp.status_code == 200
+    resp = post_event(client, "pull_request_review_comment", {
+        "action": "created",
+        "pull_request": {"id": pr_id},
+        "repository": {"id": repo_id},
+    })
+    assert resp.status_code == 200
+    with app.test_request_context('/'):
+        assert Milestone.query.get((repo_id, number)) is None
+        pr = PullRequest.query.get(pr_id)
+        assert pr.milestone_number is None
+        assert pr.raw_payload is None
+        assert pr.review_comments_count == 3
+
+
+def test_redelivery_of_failed_delivery(app, pull_request_factory, monkeypatch):
+    with app.test_request_context('/'):
+        pr = pull_request_factory()
+        pr.review_comments_count = 2
+        db.session.commit()
+        pr_id, repo_id = pr.id, pr.base_repo_id
+    client = app.test_client()
+    payload = {
+        "action": "created",
+        "pull_request": {"id": pr_id},
+        "repository": {"id": repo_id},
+    }
+    delivery_id = "72d3162e-cc78-11e3-81ab-4c9367dc0958"
+
+    adjust = event_module.adjust_review_comments_count
+    def crash(*args, **kwargs):
+        raise RuntimeError("database went away")
+    monkeypatch.setattr(event_module, "adjust_review_comments_count", crash)
+    with pytest.raises(RuntimeError):
+        post_event(client, "pull_request_review_comment", payload, delivery_id)
+    with app.test_request_context('/'):
+        assert WebhookEvent.query.one().processed_at is None
+
+    # Github redelivers it, and this time it's counted
+    monkeypatch.setattr(event_module, "adjust_review_comments_count", adjust)
+    resp = post_event(client, "pull_request_review_comment", payload, delivery_id)
+    assert resp.status_code == 200
+    with app.test_request_context('/'):
+        assert PullRequest.query.get(pr_id).review_comments_count == 3
+        assert WebhookEvent.query.one().processed_at is not None
+
+    # but not twice
+    resp = post_event(client, "pull_request_review_comment", payload, delivery_id)
+    assert resp.status_code == 200
+    with app.test_request_context('/'):
+        assert PullRequest.query.get(pr_id).review_comments_count == 3
+
+
+def test_label_renamed_to_existing_label(app, pull_request_factory):
+    with app.test_request_context('/'):
+        pr = pull_request_factory(number=1)
+        db.session.commit()
+        repo_id = pr.base_repo_id
+        for name in ("bug", "defect"):
+            db.session.add(IssueLabel(repo_id=repo_id, name=name, color=Color("#ff0000")))
+        db.session.add(Issue(id=1, repo_id=repo_id, number=1, raw_payload=b"stale"))
+        db.session.add(Issue(id=2, repo_id=repo_id, number=2, raw_payload=b"stale"))
+        db.session.execute(label_association_table.insert(), [
+            {"issue_id": 1, "label_name": "bug"},
+            {"issue_id": 1, "label_name": "defect"},
+            {"issue_id": 2, "label_name": "bug"},
+        ])
+        pr.raw_payload = b"stale"
+        db.session.commit()
+        pr_id = pr.id
+    client = app.test_client()
+
+    resp = post_event(client, "label", {
+        "action": "edited",
+        "label": {"name": "defect", "color": "ff0000"},
+        "changes": {"name": {"from": "bug"}},
+        "repository": {"id": repo_id},
+    })
+    assert resp.status_code == 200
+    with app.test_request_context('/'):
+        associations = db.session.query(
+            label_association_table.c.issue_id, label_association_table.c.label_name,
+        ).order_by(label_association_table.c.issue_id).all()
+        assert associations == [(1, "defect"), (2, "defect")]
+        # the stored payloads still show the old label
+        assert Issue.query.get(1).raw_payload is None
+        assert Issue.query.get(2).raw_payload is None
+        assert PullRequest.query.get(pr_id).raw_payload is None
+
+
+class FakeResult(object):
+    id = "4bc5ee5d-0fdc-4ab1-b0b2-86c25e0ec3a2"
+
+
+def test_member(app, user_factory, repo_factory, monkeypatch):
+    queued = []
+    def fake_delay(*args):
+        queued.append(args)
+        return FakeResult()
+    monkeypatch.setattr(
+        repository_tasks.sync_user_repository_permissions, "delay", fake_delay,
+    )
+    with app.test_request_context('/'):
+        user = user_factory()
+        repo = repo_factory()
+        db.session.commit()
+        user_json = {"id": user.id, "login": user.login}
+        repo_id = repo.id
+        repo_json = {
+            "id": repo_id, "name": repo.name,
+            "owner": {"id": repo.owner_id, "login": repo.owner_login},
+        }
+    client = app.test_client()
+
+    resp = post_event(client, "member", {
+        "action": "edited",
+        "member": user_json,
+        "changes": {"permission": {"from": "write", "to": "admin"}},
+        "repository": {"id": repo_id},
+    })
+    assert resp.status_code == 200
+    with app.test_request_context('/'):
+        assoc = UserRepoAssociation.query.get((user_json["id"], repo_id))
+        assert assoc.can_admin and assoc.can_push and assoc.can_pull
+
+    resp = post_event(client, "member", {
+        "action": "removed",
+        "member": user_json,
+        "repository": repo_json,
+    })
+    # they may still have access through a team, so Github is asked
+    assert resp.status_code == 202
+    assert queued == [
+        (repo_json["owner"]["login"], repo_json["name"], user_json["login"]),
+    ]
+    with app.test_request_context('/'):
+        assoc = UserRepoAssociation.query.get((user_json["id"], repo_id))
+        assert assoc.can_admin
+
+    resp = post_event(client, "member", {"action": "added", "member": user_json})
+    assert resp.status_code == 400
+
+
+def test_team_add(app, monkeypatch):
+    queued = []
+    def fake_delay(*args):
+        queued.append(args)
+        return FakeResult()
+    monkeypatch.setattr(
+        repository_tasks.sync_team_repository_permissions, "delay", fake_delay,
+    )
+    client = app.test_client()
+
+    resp = post_event(client, "team_add", {
+        "team": {"id": 42, "permission": "push"},
+        "repository": {
+            "id": 1296269, "name": "Hello-World",
+            "owner": {"id": 1, "login": "octocat"},
+        },
+    })
+    assert resp.status_code == 202
+    assert resp.headers["Location"].endswith(FakeResult.id)
+    assert queued == [(42, "octocat", "Hello-World", "push")]
+    with app.test_request_context('/'):
+        # the task needs the repository
+        assert repository_tasks.Repository.get("octocat", "Hello-World")
+
+
+class FakeResponse(object):
+    def __init__(self, data, next_url=None):
+        self.data = data
+        self.links = {"next": {"url": next_url}} if next_url else {}
+
+    def json(self):
+        return self.data
+
+
+def test_sync_team_repository_permissions(app, user_factory, repo_factory,
+                                          monkeypatch):
+    with app.test_request_context('/'):
+        admin = user_factory()
+        member = user_factory()
+        repo = repo_factory()
+        db.session.add(UserRepoAssociation(
+            user=admin, repo=repo, can_pull=True, can_push=True, can_admin=True,
+        ))
+        db.session.commit()
+        admin_id, member_id, repo_id = admin.id, member.id, repo.id
+        owner, name = repo.owner_login, repo.name
+        pages = {
+            "/teams/42/members?per_page=100": FakeResponse(
+                [{"id": admin_id, "login": admin.login}],
+                next_url="/teams/42/members?per_page=100&page=2",
+            ),
+            "/teams/42/members?per_page=100&page=2": FakeResponse(
+                [{"id": member_id, "login": member.login}],
+            ),
+        }
+        requests = []
+        def fake_fetch(url, requestor_id=None):
+            requests.append((url, requestor_id))
+            return pages[url]
+        monkeypatch.setattr(repository_tasks, "fetch_url_from_github", fake_fetch)
+
+        result = repository_tasks.sync_team_repository_permissions.run(
+            42, owner, name, "push", requestor_id=admin_id,
+        )
+        assert result == [admin_id, member_id]
+        assert [requestor_id for url, requestor_id in requests] == [admin_id] * 2
+        assoc = UserRepoAssociation.query.get((member_id, repo_id))
+        assert assoc.can_push and not assoc.can_admin
+        # the team doesn't take away what the admin could already do
+        assert UserRepoAssociation.query.get((admin_id, repo_id)).can_admin
+
+
+def test_sync_user_repository_permissions(app, user_factory, repo_factory,
+                                          monkeypatch):
+    with app.test_request_context('/'):
+        admin = user_factory()
+        member = user_factory()
+        repo = repo_factory()
+        db.session.add(UserRepoAssociation(
+            user=admin, repo=repo, can_pull=True, can_push=True, can_admin=True,
+        ))
+        db.session.add(UserRepoAssociation(
+            user=member, repo=repo, can_pull=True, can_push=False, can_admin=False,
+        ))
+        # the admin's token is used to ask
+        db.session.add(OAuth(user_id=admin.id, provider="github", token={}))
+        db.session.commit()
+        admin_id, member_id, repo_id = admin.id, member.id, repo.id
+        owner, name, login = repo.owner_login, repo.name, member.login
+        github = {"permission": "write"}
+        requests = []
+        def fake_fetch(url, requestor_id=None):
+            requests.append((url, requestor_id))
+            return FakeResponse({
+                "permission": github["permission"],
+                "user": {"id": member_id, "login": login},
+            })
+        monkeypatch.setattr(repository_tasks, "fetch_url_from_github", fake_fetch)
+
+        # still on a team that can push, and a new one at that
+        result = repository_tasks.sync_user_repository_permissions.run(
+            owner, name, login,
+        )
+        assert result == "write"
+        assert requests == [(
+            "/repos/{}/{}/collaborators/{}/permission".format(owner, name, login),
+            admin_id,
+        )]
+        assoc = UserRepoAssociation.query.get((member_id, repo_id))
+        assert assoc.can_push and not assoc.can_admin
+
+        # no access left
+        github["permission"] = "none"
+        repository_tasks.sync_user_repository_permissions.run(owner, name, login)
+        assert UserRepoAssociation.query.get((member_id, repo_id)) is None
@@ -0,0 +1,101 @@
+import pytest
+from webhookdb import db
+from webhookdb.models import Issue, Repository
+from webhookdb.tasks import events
+
+
+class FakeResponse(object):
+    ok = True
+    links = {}
+
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.headers = {"ETag": '"abc"', "X-Poll-Interval": "120"}
+
+    def json(self):
+        return self.data
+
+
+def test_poll_repository_events(app, repo_factory, monkeypatch):
+    issue_data = {
+        "id": 1001, "number": 7, "state": "open", "title": "Broken",
+        "body": "", "comments": 0, "labels": [], "milestone": None,
+        "user": None, "assignee": None,
+        "created_at": "2015-01-01T00:00:00Z",
+        "updated_at": "2015-01-01T00:00:00Z",
+    }
+    # newest first, like the events API
+    event_list = [
+        {"id": "12", "type": "IssueCommentEvent",
+         "created_at": "2015-01-01T00:02:00Z",
+         "payload": {"issue": {"number": 8}}},
+        {"id": "11", "type": "IssuesEvent",
+         "created_at": "2015-01-01T00:01:00Z",
+         "payload": {"action": "opened", "issue": issue_data}},
+    ]
+    requests = []
+    def fake_fetch(url, requestor_id=None, headers=None):
+        requests.append(headers)
+        if headers and headers.get("If-None-Match") == '"abc"':
+            return FakeResponse(None, status_code=304)
+        return FakeResponse(event_list)
+    synced = []
+    monkeypatch.setattr(events, "fetch_url_from_github", fake_fetch)
+    monkeypatch.setattr(events.sync_issue, "delay",
+                        lambda owner, repo, number, **kwargs: synced.append(number))
+
+    with app.test_request_context('/'):
+        repo = repo_factory()
+        db.session.commit()
+        owner, name, repo_id = repo.owner_login, repo.name, repo.id
+
+        assert events.poll_repository_events(owner, name) == 1
+        issue = Issue.query.get(1001)
+        assert issue.title == "Broken"
+        # the events API gives the repository next to the payload
+        assert issue.repo_id == repo_id
+        # comments only say which issue changed
+        assert synced == [8]
+        repo = Repository.get(owner, name)
+        assert repo.events_last_id == 12
+        assert repo.events_poll_interval == 120
+
+        # nothing new
+        assert events.poll_repository_events(owner, name) == 0
+        assert requests[-1] == {"If-None-Match": '"abc"'}
+
+
+def test_etag_is_saved_after_processing(app, repo_factory, monkeypatch):
+    event_list = [
+        {"id": "11", "type": "IssuesEvent",
+         "created_at": "2015-01-01T00:01:00Z",
+         "payload": {"action": "opened", "issue": {"id": 1001}}},
+    ]
+    requests = []
+    def fake_fetch(url, requestor_id=None, headers=None):
+        requests.append(headers)
+        return FakeResponse(event_list)
+    def crash(*args, **kwargs):
+        raise RuntimeError("worker lost")
+    monkeypatch.setattr(events, "fetch_url_from_github", fake_fetch)
+    monkeypatch.setattr(events, "process_event", crash)
+
+    with app.test_request_context('/'):
+        repo = repo_factory()
+        db.session.commit()
+        owner, name = repo.owner_login, repo.name
+        with pytest.raises(RuntimeError):
+            events.poll_repository_events(owner, name)
+        db.session.rollback()
+        repo = Repository.get(owner, name)
+        assert repo.events_etag is None
+        assert repo.events_last_id is None
+        assert repo.events_last_polled_at
+
+        # so the next poll gets the events again, instead of a 304
+        monkeypatch.undo()
+        monkeypatch.setattr(events, "fetch_url_from_github", fake_fetch)
+        assert events.poll_repository_events(owner, name) == 1
+        assert requests == [{}, {}]
+        assert Repository.get(owner, name).events_etag == '"abc"'
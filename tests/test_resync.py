@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta
+from webhookdb import db
+from webhookdb.models import OAuth, Repository, UserRepoAssociation
+from webhookdb.tasks import resync
+
+
+class FakeResponse(object):
+    ok = True
+    links = {}
+
+    def __init__(self, data, status_code=200, etag=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = {"ETag": etag} if etag else {}
+
+    def json(self):
+        return self.data
+
+
+def test_repositories_are_resynced_every_time_they_change(
+        app, user_factory, repo_factory, monkeypatch):
+    now = datetime.now()
+    github = {"pushed_at": now - timedelta(hours=1), "etag": '"v1"'}
+    def fake_fetch(url, requestor_id=None, headers=None):
+        if url == "/rate_limit":
+            return FakeResponse({"resources": {"core": {
+                "limit": 5000, "remaining": 5000,
+            }}})
+        if (headers or {}).get("If-None-Match") == github["etag"]:
+            return FakeResponse(None, status_code=304)
+        return FakeResponse({
+            "id": repo_id, "name": name,
+            "pushed_at": github["pushed_at"].strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }, etag=github["etag"])
+    queued = []
+    monkeypatch.setattr(resync, "fetch_url_from_github", fake_fetch)
+    monkeypatch.setattr(resync, "enqueue",
+                        lambda spawn, owner, repo, **kwargs: queued.append(repo))
+    monkeypatch.setattr(resync.dispatch_pending_tasks, "delay", lambda: None)
+
+    with app.test_request_context('/'):
+        user = user_factory()
+        repo = repo_factory(
+            pushed_at=now - timedelta(hours=3), updated_at=now - timedelta(hours=3),
+        )
+        repo.issues_last_scanned_at = now - timedelta(hours=2)
+        db.session.add(OAuth(user_id=user.id, provider="github", token={}))
+        db.session.add(UserRepoAssociation(
+            user_id=user.id, repo_id=repo.id, can_pull=True,
+        ))
+        db.session.commit()
+        repo_id, name = repo.id, repo.name
+
+        # pushed to since the last scan
+        assert resync.resync_stale_repositories.run() == 1
+        assert queued == [name]
+        assert Repository.query.get(repo_id).etag == '"v1"'
+
+        # the scan finished, and nothing has changed since
+        Repository.query.get(repo_id).issues_last_scanned_at = datetime.now()
+        db.session.commit()
+        assert resync.resync_stale_repositories.run() == 0
+
+        # pushed to again
+        github.update(pushed_at=datetime.now() + timedelta(minutes=1), etag='"v2"')
+        assert resync.resync_stale_repositories.run() == 1
+        assert queued == [name, name]
+
+
+def test_repository_refreshes_are_charged_to_the_budget(
+        app, user_factory, repo_factory, monkeypatch):
+    now = datetime.now()
+    fetched = []
+    def fake_fetch(url, requestor_id=None, headers=None):
+        if url == "/rate_limit":
+            # half of the remaining calls are held back: that leaves 3
+            return FakeResponse({"resources": {"core": {
+                "limit": 10, "remaining": 8,
+            }}})
+        repo = repos[url]
+        fetched.append(url)
+        return FakeResponse({
+            "id": repo["id"], "name": repo["name"],
+            "pushed_at": now.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }, etag='"v1"')
+    queued = []
+    monkeypatch.setattr(resync, "fetch_url_from_github", fake_fetch)
+    monkeypatch.setattr(resync, "enqueue",
+                        lambda spawn, owner, repo, **kwargs: queued.append(repo))
+    monkeypatch.setattr(resync.dispatch_pending_tasks, "delay", lambda: None)
+
+    repos = {}
+    with app.test_request_context('/'):
+        user = user_factory()
+        db.session.add(OAuth(user_id=user.id, provider="github", token={}))
+        for _ in range(4):
+            repo = repo_factory(pushed_at=now - timedelta(hours=3))
+            repo.issues_last_scanned_at = now - timedelta(hours=2)
+            db.session.add(UserRepoAssociation(
+                user_id=user.id, repo_id=repo.id, can_pull=True,
+            ))
+            url = "/repos/{}/{}".format(repo.owner_login, repo.name)
+            repos[url] = {"id": repo.id, "name": repo.name}
+        db.session.commit()
+
+        # the refreshes use up the budget, so the last repository isn't
+        # refreshed, and there's nothing left for scans
+        assert resync.resync_stale_repositories.run() == 0
+        assert queued == []
+    assert len(fetched) == 3
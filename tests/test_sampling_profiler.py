@@ -0,0 +1,82 @@
+import json
+import time
+from webhookdb import profiler as app_profiler
+from webhookdb.profiler import SamplingProfiler
+
+
+class Admin(object):
+    login = "octocat"
+
+    def is_anonymous(self):
+        return False
+
+
+def test_enable_and_disable(tmpdir):
+    profiler = SamplingProfiler()
+    profiler.output_dir = str(tmpdir)
+    assert not profiler.should_profile("sync_issue")
+
+    profiler.enable(seconds=60, match="sync_*")
+    assert profiler.should_profile("sync_issue")
+    assert not profiler.should_profile("request:api.issues")
+    assert tmpdir.join("profiler.control").check()
+
+    profiler.samples["sync_issue"]["main;sync_issue"] += 3
+    written = profiler.disable()
+    assert not profiler.should_profile("sync_issue")
+    assert not tmpdir.join("profiler.control").check()
+    assert [str(path) for path in tmpdir.listdir(
+        lambda path: path.basename.startswith("sync_issue.")
+    )] == written
+
+
+def test_expired_session_is_dumped_and_forgotten(tmpdir):
+    profiler = SamplingProfiler()
+    profiler.output_dir = str(tmpdir)
+    profiler.enable(seconds=60, match="sync_*")
+
+    # another process, like a pool child, only sees the control file
+    child = SamplingProfiler()
+    child.output_dir = str(tmpdir)
+    assert child.should_profile("sync_issue")
+    child.samples["sync_issue"]["main;sync_issue"] += 1
+
+    child.enabled_until = time.time() - 1
+    assert not child.enabled
+    assert child.match == "*"
+    assert not child.samples
+    assert tmpdir.listdir(lambda path: path.basename.startswith("sync_issue."))
+
+    # a later session without a pattern profiles everything
+    child.enable(seconds=60)
+    assert child.should_profile("request:api.issues")
+
+
+def test_control_route(app, monkeypatch, tmpdir):
+    broadcasts = []
+    monkeypatch.setattr(
+        "webhookdb.celery.control.broadcast",
+        lambda command, arguments: broadcasts.append(arguments),
+    )
+    monkeypatch.setattr(app_profiler, "output_dir", str(tmpdir))
+    app.config["PROFILER_ADMINS"] = ["octocat"]
+    client = app.test_client()
+    url = "/tasks/profiler"
+    base_url = "https://localhost/"
+
+    assert client.post(url, base_url=base_url).status_code == 403
+
+    monkeypatch.setattr("webhookdb.tasks.current_user", Admin())
+    resp = client.post(url + "?seconds=soon", base_url=base_url)
+    assert resp.status_code == 400
+    resp = client.post(url + "?action=restart", base_url=base_url)
+    assert resp.status_code == 400
+    assert broadcasts == []
+
+    resp = client.post(url + "?seconds=5&match=sync_*", base_url=base_url)
+    assert resp.status_code == 200
+    assert app_profiler.should_profile("sync_issue")
+    resp = client.post(url + "?action=disable", base_url=base_url)
+    assert resp.status_code == 200
+    assert not app_profiler.should_profile("sync_issue")
+    assert [args["action"] for args in broadcasts] == ["enable", "disable"]
@@ -0,0 +1,43 @@
+from sqlalchemy import event
+from webhookdb import db
+from webhookdb.models import PullRequest
+from webhookdb.serialize import iter_github_json
+
+
+def count_queries(func):
+    statements = []
+    def before_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db.get_engine(db.get_app())
+    event.listen(engine, "before_cursor_execute", before_execute)
+    try:
+        result = func()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_execute)
+    return result, len(statements)
+
+
+def test_serializing_pull_requests_takes_constant_queries(
+        app, pull_request_factory, milestone_factory):
+    def serialize_all():
+        return list(iter_github_json(PullRequest.query, batch_size=100))
+
+    with app.test_request_context('/'):
+        for _ in range(3):
+            pr = pull_request_factory()
+            pr.milestone = milestone_factory(repo=pr.head_repo)
+            pr.milestone_number = pr.milestone.number
+        db.session.commit()
+        db.session.expunge_all()
+        serialized, few = count_queries(serialize_all)
+        assert len(serialized) == 3
+        assert all(pr["milestone"] for pr in serialized)
+
+        for _ in range(10):
+            pull_request_factory()
+        db.session.commit()
+        db.session.expunge_all()
+        serialized, many = count_queries(serialize_all)
+        assert len(serialized) == 13
+        assert many == few
+        assert few <= 5
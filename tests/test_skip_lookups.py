@@ -0,0 +1,30 @@
+from webhookdb import db, metrics, known_ids
+from webhookdb.known_ids import BloomFilter, get_or_new
+from webhookdb.models import User
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for obj_id in range(0, 2000, 2):
+        bloom.add(obj_id)
+    # no false negatives
+    assert all(obj_id in bloom for obj_id in range(0, 2000, 2))
+    false_positives = sum(1 for obj_id in range(1, 2000, 2) if obj_id in bloom)
+    assert false_positives < 50
+
+
+def test_get_or_new_skips_lookups_for_new_ids(app, user_factory):
+    with app.test_request_context('/'):
+        user = user_factory()
+        db.session.commit()
+        known_ids.reset()
+        metrics.reset()
+        with known_ids.skip_lookups():
+            assert get_or_new(User, user.id) is user
+            new_user = get_or_new(User, user.id + 1)
+        assert new_user is not user
+        assert new_user.id == user.id + 1
+        counters = metrics.snapshot()
+        assert counters["known_ids.skip"] == 1
+        assert counters["known_ids.lookup"] == 1
+        known_ids.reset()
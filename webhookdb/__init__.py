@@ -21,10 +21,15 @@ from flask_sslify import SSLify
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
 from celery import Celery
+from webhookdb.profiler import SamplingProfiler
+from webhookdb.cache import TokenCache
+from webhookdb import metrics
 
 db = SQLAlchemy()
 bootstrap = Bootstrap()
 celery = Celery()
+profiler = SamplingProfiler()
+token_cache = TokenCache()
 
 login_manager = LoginManager()
 login_manager.session_protection = 'strong'
@@ -49,6 +54,8 @@ def create_app(config=None):
     db.init_app(app)
     bootstrap.init_app(app)
     login_manager.init_app(app)
+    profiler.init_app(app)
+    token_cache.init_app(app)
     create_celery_app(app)
     if not app.debug:
         SSLify(app)
@@ -62,6 +69,9 @@ def create_app(config=None):
     from .load import load as load_blueprint
     app.register_blueprint(load_blueprint, url_prefix="/load")
 
+    from .api import api as api_blueprint
+    app.register_blueprint(api_blueprint, url_prefix="/api")
+
     from .tasks import tasks as tasks_blueprint
     app.register_blueprint(tasks_blueprint, url_prefix="/tasks")
 
@@ -79,12 +89,20 @@ def create_celery_app(app=None, config="worker"):
     celery.main = app.import_name
     celery.conf["BROKER_URL"] = app.config["CELERY_BROKER_URL"]
     celery.conf.update(app.config)
-    TaskBase = celery.Task
+    # create_app can run more than once in a process (the tests do that), so
+    # the tasks use the latest app, and don't wrap an earlier ContextTask
+    celery.flask_app = app
+    TaskBase = getattr(celery.Task, "task_base", celery.Task)
     class ContextTask(TaskBase):
         abstract = True
+        task_base = TaskBase
         def __call__(self, *args, **kwargs):
-            with app.app_context():
-                return TaskBase.__call__(self, *args, **kwargs)
+            flask_app = celery.flask_app
+            try:
+                with flask_app.app_context(), profiler.profile(self.name):
+                    return TaskBase.__call__(self, *args, **kwargs)
+            finally:
+                metrics.log_if_due(flask_app.config.get("METRICS_LOG_INTERVAL", 60))
     celery.Task = ContextTask
     if not app.config["TESTING"]:
         connect_failure_handler()
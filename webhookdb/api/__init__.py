@@ -0,0 +1,20 @@
+# coding=utf-8
+"""
+A read-only JSON API for the data that WebhookDB has replicated from Github.
+Objects are serialized the same way Github serializes them, and listings
+are paginated with the ``after`` query parameter: follow the ``next`` link
+in the ``Link`` header of each response to get the next page.
+"""
+from __future__ import unicode_literals, print_function
+
+from flask import Blueprint
+
+api = Blueprint('api', __name__)
+
+from .repository import repository, repositories
+from .issue import issue, issues
+from .pull_request import pull_request, pull_requests
+from .pull_request_file import pull_request_files
+from .label import labels
+from .milestone import milestones
+from .export import export
@@ -0,0 +1,54 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from flask import request, Response, stream_with_context
+from . import api
+from .pagination import visible_repositories, bad_request
+from webhookdb.models import Repository
+from webhookdb.export import (
+    KINDS, InvalidCursor, decode_cursor, export_records, ndjson, gzipped
+)
+
+
+@api.route('/export/<owner>')
+@api.route('/export/<owner>/<repo>')
+def export(owner, repo=None):
+    """
+    Stream everything WebhookDB knows about a repository, or about all of
+    the repositories owned by a user or organization, as newline-delimited
+    JSON. See :mod:`webhookdb.export` for the format.
+
+    :query kinds: comma-separated kinds of objects to export. Defaults to
+      ``repository,label,milestone,issue,pull_request,pull_request_file``.
+    :query cursor: the ``cursor`` of the last line received, to resume
+      an interrupted export
+    :query gzip: compress the response. Clients that send
+      ``Accept-Encoding: gzip`` get a compressed response anyway.
+    """
+    query = visible_repositories().filter(Repository.owner_login == owner)
+    if repo:
+        query = query.filter(Repository.name == repo)
+
+    kinds = KINDS
+    if request.args.get("kinds"):
+        kinds = request.args["kinds"].split(",")
+        unknown = set(kinds) - set(KINDS)
+        if unknown:
+            bad_request("unknown kinds: {}".format(", ".join(sorted(unknown))))
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except InvalidCursor:
+            bad_request("invalid cursor")
+
+    lines = ndjson(export_records(query, kinds=kinds, cursor=cursor))
+    headers = {}
+    if request.args.get("gzip") or "gzip" in request.accept_encodings:
+        lines = gzipped(lines)
+        headers["Content-Encoding"] = "gzip"
+    return Response(
+        stream_with_context(lines),
+        mimetype="application/x-ndjson",
+        headers=headers,
+    )
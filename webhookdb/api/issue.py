@@ -0,0 +1,48 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from flask import request
+from sqlalchemy.orm import undefer
+from . import api
+from .pagination import (
+    get_repository_or_404, filter_updated, paginate, single, not_found
+)
+from webhookdb.models import Issue
+
+
+@api.route('/repos/<owner>/<repo>/issues')
+def issues(owner, repo):
+    """
+    List the issues on a repository, by number.
+
+    :query state: one of ``all``, ``open``, or ``closed``. Defaults to ``open``.
+    :query since: only list issues updated at or after this time
+    :query until: only list issues updated before this time
+    :query per_page: how many to list per page. Defaults to 30.
+    :query after: list the issues after this number
+    :statuscode 404: the repository isn't in WebhookDB, or you can't see it
+    """
+    repository = get_repository_or_404(owner, repo)
+    query = (
+        Issue.query.options(undefer(Issue.raw_payload))
+        .filter(Issue.repo_id == repository.id)
+    )
+    state = request.args.get("state", "open")
+    if state != "all":
+        query = query.filter(Issue.state == state)
+    query = filter_updated(query, Issue.updated_at)
+    return paginate(query, Issue.number)
+
+
+@api.route('/repos/<owner>/<repo>/issues/<int:number>')
+def issue(owner, repo, number):
+    """
+    Get a single issue.
+
+    :statuscode 404: the issue isn't in WebhookDB, or you can't see it
+    """
+    repository = get_repository_or_404(owner, repo)
+    issue = Issue.query.filter_by(repo_id=repository.id, number=number).first()
+    if not issue:
+        return not_found("issue")
+    return single(issue)
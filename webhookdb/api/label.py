@@ -0,0 +1,24 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from sqlalchemy.orm import undefer
+from . import api
+from .pagination import get_repository_or_404, paginate
+from webhookdb.models import IssueLabel
+
+
+@api.route('/repos/<owner>/<repo>/labels')
+def labels(owner, repo):
+    """
+    List the labels on a repository, by name.
+
+    :query per_page: how many to list per page. Defaults to 30.
+    :query after: list the labels after this name
+    :statuscode 404: the repository isn't in WebhookDB, or you can't see it
+    """
+    repository = get_repository_or_404(owner, repo)
+    query = (
+        IssueLabel.query.options(undefer(IssueLabel.raw_payload))
+        .filter(IssueLabel.repo_id == repository.id)
+    )
+    return paginate(query, IssueLabel.name, key_type=unicode)
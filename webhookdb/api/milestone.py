@@ -0,0 +1,32 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from flask import request
+from sqlalchemy.orm import undefer
+from . import api
+from .pagination import get_repository_or_404, filter_updated, paginate
+from webhookdb.models import Milestone
+
+
+@api.route('/repos/<owner>/<repo>/milestones')
+def milestones(owner, repo):
+    """
+    List the milestones on a repository, by number.
+
+    :query state: one of ``all``, ``open``, or ``closed``. Defaults to ``open``.
+    :query since: only list milestones updated at or after this time
+    :query until: only list milestones updated before this time
+    :query per_page: how many to list per page. Defaults to 30.
+    :query after: list the milestones after this number
+    :statuscode 404: the repository isn't in WebhookDB, or you can't see it
+    """
+    repository = get_repository_or_404(owner, repo)
+    query = (
+        Milestone.query.options(undefer(Milestone.raw_payload))
+        .filter(Milestone.repo_id == repository.id)
+    )
+    state = request.args.get("state", "open")
+    if state != "all":
+        query = query.filter(Milestone.state == state)
+    query = filter_updated(query, Milestone.updated_at)
+    return paginate(query, Milestone.number)
@@ -0,0 +1,160 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import json
+from iso8601 import parse_date, ParseError
+from flask import (
+    request, url_for, current_app, jsonify, abort, Response, stream_with_context
+)
+from flask_login import current_user
+from sqlalchemy import or_
+from webhookdb import db
+from webhookdb.models import Repository, UserRepoAssociation
+from webhookdb.serialize import GithubJSONEncoder, preload, iter_batches, release
+
+
+def bad_request(message):
+    resp = jsonify({"error": message})
+    resp.status_code = 400
+    abort(resp)
+
+
+def visible_repositories():
+    """
+    A query for the repositories that the current user may read: all public
+    repositories, and the private ones that they can pull from.
+    """
+    query = Repository.query
+    if current_user.is_anonymous():
+        return query.filter(Repository.private == False)
+    pullable = (
+        db.session.query(UserRepoAssociation.repo_id)
+        .filter(UserRepoAssociation.user_id == current_user.id)
+        .filter(UserRepoAssociation.can_pull == True)
+    )
+    return query.filter(or_(
+        Repository.private == False, Repository.id.in_(pullable),
+    ))
+
+
+def get_repository_or_404(owner, repo):
+    repository = (
+        visible_repositories()
+        .filter(Repository.owner_login == owner)
+        .filter(Repository.name == repo)
+        .first()
+    )
+    if not repository:
+        abort(not_found("repository"))
+    return repository
+
+
+def filter_updated(query, column):
+    """
+    Filter a query by the ``since`` and ``until`` query parameters:
+    ISO 8601 timestamps that bound when objects were last updated.
+    """
+    for param, compare in (("since", column.__ge__), ("until", column.__lt__)):
+        value = request.args.get(param)
+        if not value:
+            continue
+        try:
+            dt = parse_date(value)
+        except ParseError:
+            bad_request("invalid {param} timestamp".format(param=param))
+        if dt.tzinfo:
+            dt = dt.replace(tzinfo=None) - dt.utcoffset()
+        query = query.filter(compare(dt))
+    return query
+
+
+def paginate(query, key, key_type=int, serialize=None):
+    """
+    Return a page of the results of ``query`` as a streamed JSON list.
+
+    This uses keyset pagination, rather than ``OFFSET``: results are sorted
+    by the ``key`` column, which should be unique within the query and
+    indexed, and the ``after`` query parameter is the key of the last result
+    on the previous page. That way, the database can seek straight to the
+    start of every page, no matter how deep into the listing it is.
+    ``key_type`` converts the ``after`` query parameter to the type of the
+    key column.
+
+    Only the keys are read before the response starts, to find out where the
+    page ends and whether there's another one. The results themselves are
+    loaded in batches of ``SERIALIZE_BATCH_SIZE`` as the response is sent,
+    and serialized with ``serialize``, which defaults to each object's
+    ``github_json``.
+    """
+    max_per_page = current_app.config.get("API_MAX_PER_PAGE", 100)
+    try:
+        per_page = int(request.args.get("per_page", 30))
+    except ValueError:
+        bad_request("invalid per_page")
+    per_page = max(1, min(per_page, max_per_page))
+
+    after = request.args.get("after")
+    if after is not None:
+        try:
+            after = key_type(after)
+        except ValueError:
+            bad_request("invalid after")
+        query = query.filter(key > after)
+
+    # fetch one more key than we need, to find out if there is another page
+    keys = [
+        row[0] for row in
+        query.order_by(key).with_entities(key).limit(per_page + 1)
+    ]
+    headers = {}
+    if len(keys) > per_page:
+        keys = keys[:per_page]
+        args = request.args.to_dict()
+        args.update(request.view_args)
+        args["after"] = keys[-1]
+        next_url = url_for(request.endpoint, _external=True, **args)
+        headers["Link"] = '<{url}>; rel="next"'.format(url=next_url)
+
+    serialize = serialize or (lambda obj: obj.github_json)
+    batch_size = current_app.config.get("SERIALIZE_BATCH_SIZE", 500)
+
+    def generate():
+        yield "["
+        if not keys:
+            yield "]"
+            return
+        page_query = query.filter(key <= keys[-1])
+        # objects that were already in the session stay there
+        keep = set(db.session.identity_map.keys())
+        index = 0
+        for batch in iter_batches(page_query, batch_size, key=[key]):
+            # load everything the batch refers to up front, rather than one
+            # relationship at a time while serializing
+            loaded = preload(batch)
+            for obj in batch:
+                if index:
+                    yield ","
+                yield json.dumps(serialize(obj), cls=GithubJSONEncoder)
+                index += 1
+            release(batch + loaded, keep)
+        yield "]"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/json",
+        headers=headers,
+    )
+
+
+def single(obj):
+    "Return one object, serialized the same way as a page of results."
+    return Response(
+        json.dumps(obj.github_json, cls=GithubJSONEncoder),
+        mimetype="application/json",
+    )
+
+
+def not_found(kind):
+    resp = jsonify({"error": "{kind} not found".format(kind=kind)})
+    resp.status_code = 404
+    return resp
@@ -0,0 +1,51 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from flask import request
+from sqlalchemy.orm import undefer
+from . import api
+from .pagination import (
+    get_repository_or_404, filter_updated, paginate, single, not_found
+)
+from webhookdb.models import PullRequest
+
+
+@api.route('/repos/<owner>/<repo>/pulls')
+def pull_requests(owner, repo):
+    """
+    List the pull requests on a repository, by number.
+
+    :query state: one of ``all``, ``open``, or ``closed``. Defaults to ``open``.
+    :query since: only list pull requests updated at or after this time
+    :query until: only list pull requests updated before this time
+    :query per_page: how many to list per page. Defaults to 30.
+    :query after: list the pull requests after this number
+    :statuscode 404: the repository isn't in WebhookDB, or you can't see it
+    """
+    repository = get_repository_or_404(owner, repo)
+    query = (
+        PullRequest.query.options(undefer(PullRequest.raw_payload))
+        .filter(PullRequest.base_repo_id == repository.id)
+    )
+    state = request.args.get("state", "open")
+    if state != "all":
+        query = query.filter(PullRequest.state == state)
+    query = filter_updated(query, PullRequest.updated_at)
+    return paginate(query, PullRequest.number)
+
+
+@api.route('/repos/<owner>/<repo>/pulls/<int:number>')
+def pull_request(owner, repo, number):
+    """
+    Get a single pull request.
+
+    :statuscode 404: the pull request isn't in WebhookDB, or you can't see it
+    """
+    repository = get_repository_or_404(owner, repo)
+    pr = (
+        PullRequest.query.filter_by(base_repo_id=repository.id, number=number)
+        .first()
+    )
+    if not pr:
+        return not_found("pull request")
+    return single(pr)
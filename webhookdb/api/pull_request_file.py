@@ -0,0 +1,26 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from . import api
+from .pagination import get_repository_or_404, paginate, not_found
+from webhookdb.models import PullRequest, PullRequestFile
+
+
+@api.route('/repos/<owner>/<repo>/pulls/<int:number>/files')
+def pull_request_files(owner, repo, number):
+    """
+    List the files changed by a pull request, by filename.
+
+    :query per_page: how many to list per page. Defaults to 30.
+    :query after: list the files after this filename
+    :statuscode 404: the pull request isn't in WebhookDB, or you can't see it
+    """
+    repository = get_repository_or_404(owner, repo)
+    pr = (
+        PullRequest.query.filter_by(base_repo_id=repository.id, number=number)
+        .first()
+    )
+    if not pr:
+        return not_found("pull request")
+    query = PullRequestFile.query.filter(PullRequestFile.pull_request_id == pr.id)
+    return paginate(query, PullRequestFile.filename, key_type=unicode)
@@ -0,0 +1,40 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from flask import request
+from sqlalchemy.orm import undefer
+from . import api
+from .pagination import (
+    visible_repositories, get_repository_or_404, filter_updated, paginate, single
+)
+from webhookdb.models import Repository
+
+
+@api.route('/repos')
+def repositories():
+    """
+    List the repositories in WebhookDB that you can see.
+
+    :query owner: only list repositories owned by this user or organization
+    :query since: only list repositories updated at or after this time
+    :query until: only list repositories updated before this time
+    :query per_page: how many to list per page. Defaults to 30.
+    :query after: list the repositories after this ID. Use the ``next``
+      link in the ``Link`` header rather than setting this yourself.
+    """
+    query = visible_repositories().options(undefer(Repository.raw_payload))
+    owner = request.args.get("owner")
+    if owner:
+        query = query.filter(Repository.owner_login == owner)
+    query = filter_updated(query, Repository.updated_at)
+    return paginate(query, Repository.id)
+
+
+@api.route('/repos/<owner>/<repo>')
+def repository(owner, repo):
+    """
+    Get a single repository.
+
+    :statuscode 404: the repository isn't in WebhookDB, or you can't see it
+    """
+    return single(get_repository_or_404(owner, repo))
@@ -0,0 +1,112 @@
+# coding=utf-8
+"""
+Loading history from GH Archive-style event dumps: gzipped files of Github
+events (as returned by the events API, one JSON object per line), usually
+one file per hour.
+
+Issue, pull request and repository events carry the same payloads as the
+webhooks for those events, so they are processed with
+:func:`~webhookdb.process.process_event`, as if each had been fetched when
+the event happened. An old event never overwrites newer data, so files can
+be loaded in any order, in parallel, and alongside live replication. When
+two workers insert the same new object at once, the one that loses
+processes its event again. This makes no API calls.
+"""
+from __future__ import unicode_literals, print_function
+
+import io
+import json
+import gzip
+from collections import Counter
+from multiprocessing import Pool
+from iso8601 import parse_date
+from webhookdb import db
+from webhookdb.process import process_event
+from webhookdb.process.save import resolve_conflicts
+from webhookdb.exceptions import WebhookDBException, StaleData
+
+# event API type -> webhook event name
+EVENT_TYPES = {
+    "IssuesEvent": "issues",
+    "PullRequestEvent": "pull_request",
+    "RepositoryEvent": "repository",
+}
+
+
+def iter_archive_events(path):
+    "Stream the events in a dump file, which may be gzipped."
+    if path.endswith(".gz"):
+        f = io.BufferedReader(gzip.open(path, "rb"))
+    else:
+        f = io.open(path, "rb")
+    with f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def wanted(event, owners=None, repos=None):
+    "Is this an event we can process, for a repository we want?"
+    if event.get("type") not in EVENT_TYPES:
+        return False
+    if not (owners or repos):
+        return True
+    full_name = ((event.get("repo") or {}).get("name") or "").lower()
+    return (
+        full_name in (repos or ()) or
+        full_name.split("/")[0] in (owners or ())
+    )
+
+
+def ingest_file(args):
+    """
+    Process the events we want in one dump file. Runs in a worker process.
+    Returns the path and a :class:`~collections.Counter` of what happened to
+    the events.
+    """
+    path, owners, repos = args
+    counts = Counter()
+    try:
+        for event in iter_archive_events(path):
+            if not wanted(event, owners, repos):
+                counts["skipped"] += 1
+                continue
+            try:
+                resolve_conflicts(
+                    process_event,
+                    EVENT_TYPES[event["type"]], event.get("payload") or {},
+                    fetched_at=parse_date(event["created_at"]).replace(tzinfo=None),
+                    repo_id=(event.get("repo") or {}).get("id"),
+                )
+            except StaleData:
+                counts["stale"] += 1
+            except WebhookDBException:
+                db.session.rollback()
+                counts["failed"] += 1
+            else:
+                counts["processed"] += 1
+    finally:
+        db.session.remove()
+    return path, counts
+
+
+def ingest(paths, owners=None, repos=None, processes=4):
+    """
+    Load dump files in parallel, keeping only events for repositories owned
+    by one of ``owners`` or named in ``repos`` (as ``owner/name``), if
+    either is given. Must run in an app context. Yields ``(path, counts)``
+    for each file as it finishes.
+    """
+    owners = set(owner.lower() for owner in owners or ())
+    repos = set(repo.lower() for repo in repos or ())
+    # don't let the worker processes share our database connections
+    db.session.remove()
+    db.engine.dispose()
+    pool = Pool(processes)
+    try:
+        jobs = [(path, owners, repos) for path in paths]
+        for result in pool.imap_unordered(ingest_file, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
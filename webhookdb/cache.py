@@ -0,0 +1,72 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import time
+import threading
+from webhookdb import metrics
+
+
+class TokenCache(object):
+    """
+    A small per-process cache for OAuth tokens, so that a scan doesn't look
+    up the requestor's token in the database for every page it fetches.
+    It implements the parts of Flask-Cache's API that Flask-Dance's
+    ``SQLAlchemyBackend`` uses (``get``, ``set`` and ``delete``), so it can
+    be passed to the backend as its ``cache``.
+
+    Entries expire after ``OAUTH_TOKEN_CACHE_TTL`` seconds, which bounds how
+    long another process can keep using a token after a user logs in again.
+    The process that stores a new token drops the old one right away, and a
+    token that Github rejects is dropped with :meth:`invalidate`.
+    Hits and misses are counted in :mod:`webhookdb.metrics`.
+    """
+    def __init__(self, app=None, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get("OAUTH_TOKEN_CACHE_TTL", self.ttl)
+        self.max_size = app.config.get("OAUTH_TOKEN_CACHE_MAX_SIZE", self.max_size)
+
+    def get(self, key):
+        if not self.ttl:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] < time.time():
+                del self._entries[key]
+                entry = None
+        if entry:
+            metrics.incr("token_cache.hit")
+            return entry[1]
+        metrics.incr("token_cache.miss")
+        return None
+
+    def set(self, key, value):
+        if not self.ttl or not value:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
+            self._entries[key] = (time.time() + self.ttl, value)
+
+    def delete(self, key):
+        with self._lock:
+            removed = self._entries.pop(key, None)
+        if removed:
+            metrics.incr("token_cache.invalidate")
+
+    def invalidate(self, user_id, provider="github"):
+        "Forget the cached token for this user."
+        # this is the key format that Flask-Dance's SQLAlchemyBackend uses
+        self.delete("flask_dance_token|{name}|{user_id}".format(
+            name=provider, user_id=user_id,
+        ))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
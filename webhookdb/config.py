@@ -1,6 +1,8 @@
 # coding=utf-8
 from __future__ import unicode_literals
 import os
+from datetime import timedelta
+from kombu import Queue
 
 RABBITMQ_PROVIDER = "bigwig"
 REDIS_PROVIDER = "rediscloud"
@@ -15,6 +17,10 @@ class DefaultConfig(object):
     CELERY_TASK_SERIALIZER = "json"
     CELERY_RESULT_SERIALIZER = 'json'
     CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+    # see webhookdb.tasks.routing
+    CELERY_QUEUES = (Queue("webhook"), Queue("interactive"), Queue("bulk"))
+    CELERY_DEFAULT_QUEUE = "interactive"
+    CELERY_ROUTES = ("webhookdb.tasks.routing.TaskRouter",)
     if RABBITMQ_PROVIDER == "bigwig":
         # TX_URL for producers
         CELERY_BROKER_URL = os.environ.get("RABBITMQ_BIGWIG_TX_URL", "amqp://")
@@ -25,11 +31,156 @@ class DefaultConfig(object):
     if REDIS_PROVIDER == "rediscloud":
         CELERY_RESULT_BACKEND = os.environ.get("REDISCLOUD_URL", "redis://")
 
+    # How many pages of a Github API listing each "sync page" task fetches.
+    # If PAGES_PER_TASK isn't set, it's chosen per scan so that each task
+    # takes about PAGE_TASK_TARGET_SECONDS, based on recent page latency.
+    PAGES_PER_TASK = int(os.environ.get("PAGES_PER_TASK", 0)) or None
+    PAGE_TASK_TARGET_SECONDS = float(os.environ.get("PAGE_TASK_TARGET_SECONDS", 10))
+    MAX_PAGES_PER_TASK = int(os.environ.get("MAX_PAGES_PER_TASK", 40))
+    PAGE_LATENCY_DEFAULT = 1.0
+    # How many pages each "sync page" task downloads at once, with a pool of
+    # threads. Concurrent fetches stop this many API calls short of the rate
+    # limit; the rest of the pages are fetched one at a time.
+    PAGE_FETCH_CONCURRENCY = int(os.environ.get("PAGE_FETCH_CONCURRENCY", 4))
+    PAGE_FETCH_RATE_RESERVE = int(os.environ.get("PAGE_FETCH_RATE_RESERVE", 50))
+
+    # "rest", or "graphql" to load a repository's issues, pull requests,
+    # labels and milestones together with Github's GraphQL API --
+    # see webhookdb.tasks.graphql
+    FETCH_BACKEND = os.environ.get("FETCH_BACKEND", "rest")
+    GRAPHQL_PAGE_SIZE = int(os.environ.get("GRAPHQL_PAGE_SIZE", 50))
+
+    # Fair scheduling of scans between requestors -- see
+    # webhookdb.tasks.scheduler. Limits are on "sync page" tasks in flight.
+    SCHEDULER_MAX_PAGE_TASKS_PER_REQUESTOR = int(
+        os.environ.get("SCHEDULER_MAX_PAGE_TASKS_PER_REQUESTOR", 50)
+    )
+    SCHEDULER_MAX_PAGE_TASKS_PER_TOKEN = int(
+        os.environ.get("SCHEDULER_MAX_PAGE_TASKS_PER_TOKEN", 50)
+    )
+    SCHEDULER_MAX_DISPATCH = 100
+    SCHEDULER_DISPATCH_GRACE_SECONDS = 60
+
+    # Periodic rescans of repositories that have changed on Github since
+    # they were last scanned -- see webhookdb.tasks.resync. Only this many
+    # API calls are used per token per run, and this fraction of each
+    # token's rate limit is left for interactive use.
+    RESYNC_INTERVAL_SECONDS = int(os.environ.get("RESYNC_INTERVAL_SECONDS", 900))
+    RESYNC_MAX_CALLS_PER_RUN = int(os.environ.get("RESYNC_MAX_CALLS_PER_RUN", 1000))
+    RESYNC_RATE_RESERVE = float(os.environ.get("RESYNC_RATE_RESERVE", 0.5))
+    # incremental issue scans ask for issues updated a bit before the last
+    # scan, to make up for changes made while that scan was running
+    RESYNC_SINCE_OVERLAP_SECONDS = 3600
+    # rescan collections this old even if their repository looks unchanged
+    RESYNC_MAX_AGE_SECONDS = int(os.environ.get("RESYNC_MAX_AGE_SECONDS", 86400))
+
+    # Repositories without our webhook are kept fresh by polling their
+    # events, no more often than this -- see webhookdb.tasks.events
+    EVENTS_POLL_INTERVAL_SECONDS = int(
+        os.environ.get("EVENTS_POLL_INTERVAL_SECONDS", 60)
+    )
+
+    # tasks that nothing else imports, but that celery beat schedules
+    CELERY_IMPORTS = (
+        "webhookdb.tasks.scheduler", "webhookdb.tasks.resync",
+        "webhookdb.tasks.events",
+    )
+    CELERYBEAT_SCHEDULE = {
+        # in case a finisher never runs, check for pending scans regularly
+        "dispatch-pending-tasks": {
+            "task": "webhookdb.tasks.scheduler.dispatch_pending_tasks",
+            "schedule": timedelta(seconds=30),
+        },
+        "resync-stale-repositories": {
+            "task": "webhookdb.tasks.resync.resync_stale_repositories",
+            "schedule": timedelta(seconds=RESYNC_INTERVAL_SECONDS),
+        },
+        "poll-unhooked-repositories": {
+            "task": "webhookdb.tasks.events.poll_unhooked_repositories",
+            "schedule": timedelta(seconds=EVENTS_POLL_INTERVAL_SECONDS),
+        },
+    }
+
+    # Webhooks rescan a pull request's files when its head commit changes,
+    # after waiting this long in case more commits are pushed
+    PULL_REQUEST_FILES_DEBOUNCE_SECONDS = int(
+        os.environ.get("PULL_REQUEST_FILES_DEBOUNCE_SECONDS", 30)
+    )
+
+    # Patches longer than this many characters aren't stored. Patches are
+    # compressed and deduplicated -- see webhookdb.models.PullRequestPatch
+    PULL_REQUEST_PATCH_MAX_SIZE = int(
+        os.environ.get("PULL_REQUEST_PATCH_MAX_SIZE", 0)
+    ) or None
+
+    # The first scan of a repository's issues or pull requests inserts them
+    # with Postgres COPY -- see webhookdb.process.bulk
+    BULK_LOAD_ENABLED = os.environ.get("BULK_LOAD_ENABLED", "1") not in ("0", "")
+
+    # "Sync page" tasks skip looking up objects that a per-process Bloom
+    # filter says are new -- see webhookdb.known_ids
+    KNOWN_IDS_ENABLED = os.environ.get("KNOWN_IDS_ENABLED", "1") not in ("0", "")
+    KNOWN_IDS_TTL = int(os.environ.get("KNOWN_IDS_TTL", 600))
+    KNOWN_IDS_ERROR_RATE = 0.01
+
+    # Keep every webhook delivery, for rebuilding the database with
+    # `manage.py replay` -- see webhookdb.replay
+    EVENT_LOG_ENABLED = os.environ.get("EVENT_LOG_ENABLED", "1") not in ("0", "")
+
+    # Keep the JSON that Github sends for each object, and serve it from
+    # github_json -- see webhookdb.models.github.RawPayloadMixin
+    STORE_RAW_PAYLOADS = bool(os.environ.get("STORE_RAW_PAYLOADS", False))
+
+    # the most objects that one page of the read API can list -- see
+    # webhookdb.api
+    API_MAX_PER_PAGE = int(os.environ.get("API_MAX_PER_PAGE", 100))
+    # how many objects webhookdb.serialize loads and serializes at once
+    SERIALIZE_BATCH_SIZE = int(os.environ.get("SERIALIZE_BATCH_SIZE", 500))
+
+    # Fetch public data with whichever consenting user's token has the
+    # most calls left -- see webhookdb.tasks.token_pool
+    TOKEN_POOL_ENABLED = bool(os.environ.get("TOKEN_POOL_ENABLED", False))
+    TOKEN_POOL_REFRESH_SECONDS = 300
+    TOKEN_POOL_ATTEMPTS = 3
+
+    # how long each process caches OAuth tokens -- see webhookdb.cache
+    OAUTH_TOKEN_CACHE_TTL = int(os.environ.get("OAUTH_TOKEN_CACHE_TTL", 60))
+    # how often each worker process logs its counters -- see webhookdb.metrics
+    METRICS_LOG_INTERVAL = int(os.environ.get("METRICS_LOG_INTERVAL", 60))
+
+    # sampling profiler -- see webhookdb.profiler
+    PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") not in ("0", "")
+    PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", 0.01))
+    PROFILER_MATCH = os.environ.get("PROFILER_MATCH", "*")
+    PROFILER_OUTPUT_DIR = os.environ.get("PROFILER_OUTPUT_DIR", "profiles")
+    PROFILER_DUMP_INTERVAL = int(os.environ.get("PROFILER_DUMP_INTERVAL", 60))
+    # Github logins that can turn the profiler on and off over HTTP
+    PROFILER_ADMINS = [
+        login for login in os.environ.get("PROFILER_ADMINS", "").split(",")
+        if login
+    ]
+
 
 class WorkerConfig(DefaultConfig):
     if RABBITMQ_PROVIDER == "bigwig":
         # RX_URL for consumers
         CELERY_BROKER_URL = os.environ.get("RABBITMQ_BIGWIG_RX_URL", "amqp://")
+    # how many tasks a worker for each queue runs at once.
+    # Used by `manage.py worker --queue=<name>`
+    WORKER_QUEUE_CONCURRENCY = {
+        "webhook": int(os.environ.get("WEBHOOK_WORKER_CONCURRENCY", 4)),
+        "interactive": int(os.environ.get("INTERACTIVE_WORKER_CONCURRENCY", 4)),
+        "bulk": int(os.environ.get("BULK_WORKER_CONCURRENCY", 8)),
+    }
+    # Only reserve one message at a time, and acknowledge it when it's done,
+    # so that a worker doesn't hoard a backlog of long scan tasks while
+    # other messages sit waiting for it.
+    CELERYD_PREFETCH_MULTIPLIER = 1
+    CELERY_ACKS_LATE = True
+    # How many tasks a worker runs at once with `manage.py worker --pool=gevent`
+    # (or eventlet). Tasks spend most of their time waiting on Github, so
+    # one process can run hundreds of them.
+    GREEN_WORKER_CONCURRENCY = int(os.environ.get("GREEN_WORKER_CONCURRENCY", 200))
 
 
 class DevelopmentConfig(DefaultConfig):
@@ -59,3 +59,12 @@ class DatabaseError(WebhookDBException):
         self.message = message
         self.info = info or {}
         WebhookDBException.__init__(self, message)
+
+
+class GraphQLError(WebhookDBException):
+    def __init__(self, errors):
+        self.errors = errors or []
+        message = "; ".join(
+            error.get("message", "unknown error") for error in self.errors
+        )
+        WebhookDBException.__init__(self, message)
@@ -0,0 +1,131 @@
+# coding=utf-8
+"""
+Exporting everything WebhookDB knows about some repositories, as
+newline-delimited JSON. Each line is an object like this::
+
+    {"type": "issue", "repository": "octocat/Hello-World",
+     "cursor": "...", "data": {...}}
+
+where ``data`` is the object's ``github_json``. Pass the ``cursor`` of the
+last line you received to :func:`export_records` to pick up after it.
+
+Objects are loaded in keyset-paginated batches with
+:mod:`webhookdb.serialize`, so memory use stays the same however big the
+repositories are, and no transaction is held open for the whole export.
+"""
+from __future__ import unicode_literals, print_function
+
+import json
+import zlib
+import base64
+from webhookdb.models import (
+    Repository, IssueLabel, Milestone, Issue, PullRequest, PullRequestFile
+)
+from webhookdb.serialize import GithubJSONEncoder, iter_keyed_github_json
+
+# the order that each repository's objects are exported in
+KINDS = (
+    "repository", "label", "milestone", "issue", "pull_request",
+    "pull_request_file",
+)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(repo_id, kind, key):
+    data = json.dumps([repo_id, kind, list(key)], cls=GithubJSONEncoder)
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        repo_id, kind, key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+    if kind not in KINDS:
+        raise InvalidCursor(cursor)
+    return repo_id, kind, tuple(key)
+
+
+def kind_query(kind, repo):
+    """
+    The query for one kind of object in a repository, and the columns to
+    page through it by.
+    """
+    if kind == "repository":
+        return Repository.query.filter(Repository.id == repo.id), [Repository.id]
+    if kind == "label":
+        query = IssueLabel.query.filter(IssueLabel.repo_id == repo.id)
+        return query, [IssueLabel.name]
+    if kind == "milestone":
+        query = Milestone.query.filter(Milestone.repo_id == repo.id)
+        return query, [Milestone.number]
+    if kind == "issue":
+        return Issue.query.filter(Issue.repo_id == repo.id), [Issue.number]
+    if kind == "pull_request":
+        query = PullRequest.query.filter(PullRequest.base_repo_id == repo.id)
+        return query, [PullRequest.number]
+    if kind == "pull_request_file":
+        pr_ids = (
+            PullRequest.query.filter(PullRequest.base_repo_id == repo.id)
+            .with_entities(PullRequest.id)
+        )
+        query = PullRequestFile.query.filter(
+            PullRequestFile.pull_request_id.in_(pr_ids.subquery())
+        )
+        return query, [
+            PullRequestFile.pull_request_id, PullRequestFile.filename,
+            PullRequestFile.sha,
+        ]
+    raise ValueError(kind)
+
+
+def export_records(repos_query, kinds=KINDS, cursor=None, batch_size=None):
+    """
+    Yield a record for every object of the given kinds in the repositories
+    that ``repos_query`` returns, a repository at a time.
+    """
+    kinds = [kind for kind in KINDS if kind in kinds]
+    start_repo_id = start_kind = start_key = None
+    if cursor:
+        start_repo_id, start_kind, start_key = decode_cursor(cursor)
+        repos_query = repos_query.filter(Repository.id >= start_repo_id)
+    repos = repos_query.order_by(Repository.id).with_entities(
+        Repository.id, Repository.owner_login, Repository.name,
+    ).all()
+    for repo in repos:
+        full_name = "{owner}/{name}".format(owner=repo.owner_login, name=repo.name)
+        for kind in kinds:
+            after = None
+            if repo.id == start_repo_id:
+                if KINDS.index(kind) < KINDS.index(start_kind):
+                    continue
+                if kind == start_kind:
+                    after = start_key
+            query, key = kind_query(kind, repo)
+            for obj_key, data in iter_keyed_github_json(
+                    query, batch_size=batch_size, key=key, after=after):
+                yield {
+                    "type": kind,
+                    "repository": full_name,
+                    "cursor": encode_cursor(repo.id, kind, obj_key),
+                    "data": data,
+                }
+
+
+def ndjson(records):
+    "Serialize records as lines of JSON."
+    for record in records:
+        yield json.dumps(record, cls=GithubJSONEncoder) + "\n"
+
+
+def gzipped(chunks, level=6):
+    "Compress a stream of strings in gzip format, as it goes."
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode("utf-8"))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
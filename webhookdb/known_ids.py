@@ -0,0 +1,132 @@
+# coding=utf-8
+"""
+Skipping lookups for objects that we know are new.
+
+The process layer looks up every object it's given before updating it, and
+while a repository is being backfilled nearly all of those lookups find
+nothing. Each process keeps a Bloom filter of the IDs in the user, issue and
+pull request tables, loaded from the database and updated as objects are
+created, so that it can tell when an ID is definitely new and create the
+object without asking the database first.
+
+A filter can't know about rows that other processes inserted after it was
+loaded, so it's only trusted inside :func:`skip_lookups`, which the "sync
+page" tasks use. If it was wrong, inserting the object raises an
+``IntegrityError``, and :func:`webhookdb.process.save.resolve_conflicts`
+processes it again -- the ID is in the filter by then, so this time it's
+looked up. If that doesn't help, :func:`reset` is called, and the filters
+are loaded again. Filters are also reloaded every ``KNOWN_IDS_TTL`` seconds.
+Skipped and performed lookups are counted in :mod:`webhookdb.metrics`.
+"""
+from __future__ import unicode_literals, print_function
+
+import math
+import time
+import threading
+from contextlib import contextmanager
+from flask import current_app
+from webhookdb import db, metrics
+
+MASK_64 = (1 << 64) - 1
+
+_lock = threading.Lock()
+# table name -> (filter, loaded at)
+_filters = {}
+_state = threading.local()
+
+
+class BloomFilter(object):
+    """
+    A set of IDs that can have false positives, but no false negatives.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.num_bits = max(int(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        ), 64)
+        self.num_hashes = max(int(round(
+            self.num_bits / float(capacity) * math.log(2)
+        )), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing, from one well-mixed 64-bit hash
+        h = (hash(key) * 0x9E3779B97F4A7C15) & MASK_64
+        h ^= h >> 31
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7))
+            for pos in self._positions(key)
+        )
+
+
+def load_filter(model):
+    count = db.session.query(db.func.count(model.id)).scalar()
+    # leave room for the objects this process will create
+    bloom = BloomFilter(
+        capacity=count * 2 + 1000,
+        error_rate=current_app.config.get("KNOWN_IDS_ERROR_RATE", 0.01),
+    )
+    for (obj_id,) in db.session.query(model.id).yield_per(10000):
+        bloom.add(obj_id)
+    metrics.incr("known_ids.load")
+    return bloom
+
+
+def get_filter(model):
+    ttl = current_app.config.get("KNOWN_IDS_TTL", 600)
+    name = model.__tablename__
+    with _lock:
+        entry = _filters.get(name)
+    if entry and time.time() - entry[1] < ttl:
+        return entry[0]
+    bloom = load_filter(model)
+    with _lock:
+        _filters[name] = (bloom, time.time())
+    return bloom
+
+
+def reset():
+    "Forget all filters. They are loaded again the next time they're needed."
+    with _lock:
+        _filters.clear()
+
+
+@contextmanager
+def skip_lookups():
+    "Trust the filters inside this block, if ``KNOWN_IDS_ENABLED`` is set."
+    previous = getattr(_state, "enabled", False)
+    _state.enabled = bool(current_app.config.get("KNOWN_IDS_ENABLED"))
+    try:
+        yield
+    finally:
+        _state.enabled = previous
+
+
+def get_or_new(model, obj_id):
+    """
+    Fetch the object with this ID from the database, or make a new one if it
+    doesn't exist. Inside :func:`skip_lookups`, the database is only asked if
+    the ID might already be there.
+    """
+    if getattr(_state, "enabled", False):
+        bloom = get_filter(model)
+        if obj_id not in bloom:
+            metrics.incr("known_ids.skip")
+            bloom.add(obj_id)
+            return model(id=obj_id)
+        metrics.incr("known_ids.lookup")
+    obj = model.query.get(obj_id)
+    if obj:
+        return obj
+    if getattr(_state, "enabled", False):
+        get_filter(model).add(obj_id)
+    return model(id=obj_id)
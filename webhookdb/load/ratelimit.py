@@ -3,18 +3,17 @@ from __future__ import unicode_literals, print_function
 
 from datetime import datetime
 from . import load
-from flask import jsonify
-from flask_dance.contrib.github import github
+from flask import jsonify, g
 from webhookdb.exceptions import RateLimited
 
 
 @load.after_request
 def attach_ratelimit_headers(response, gh_response=None):
     # A response with a non-OK response code is falsy, so can't just do:
-    #   gh_response = gh_response or getattr(github, "last_response", None)
+    #   gh_response = gh_response or g.get("github_response")
     # Instead, we have to actually check for None
     if gh_response is None:
-        gh_response = getattr(github, "last_response", None)
+        gh_response = g.get("github_response")
     if gh_response is None:
         return response
 
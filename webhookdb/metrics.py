@@ -0,0 +1,66 @@
+# coding=utf-8
+"""
+Simple in-process counters, for keeping an eye on things like how well
+caches are working. Counters are per process: each Celery worker process
+logs its own counters every ``METRICS_LOG_INTERVAL`` seconds, and the
+``metrics`` remote control command (see ``manage.py metrics``) reports the
+counters of each worker's main process -- which is where tasks run, if the
+worker uses the gevent, eventlet or solo pool.
+"""
+from __future__ import unicode_literals, print_function
+
+import os
+import time
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+_counters = Counter()
+_lock = threading.Lock()
+_last_logged_at = [time.time()]
+
+
+def incr(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def snapshot():
+    """
+    Return a dict of all counters. For every pair of ``<name>.hit`` and
+    ``<name>.miss`` counters, also include a ``<name>.hit_rate``.
+    """
+    with _lock:
+        data = dict(_counters)
+    for key in list(data):
+        if key.endswith(".hit"):
+            prefix = key[:-len(".hit")]
+            hits = data[key]
+            total = hits + data.get(prefix + ".miss", 0)
+            data[prefix + ".hit_rate"] = round(float(hits) / total, 3) if total else None
+    return data
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+
+
+def log_if_due(interval=60):
+    "Log all counters, if we haven't done so in the last ``interval`` seconds."
+    now = time.time()
+    if not interval or now - _last_logged_at[0] < interval:
+        return False
+    _last_logged_at[0] = now
+    data = snapshot()
+    if data:
+        logger.info("metrics pid={pid} {counters}".format(
+            pid=os.getpid(),
+            counters=" ".join(
+                "{key}={value}".format(key=key, value=value)
+                for key, value in sorted(data.items())
+            ),
+        ))
+    return True
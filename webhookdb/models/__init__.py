@@ -1,12 +1,15 @@
 # coding=utf-8
 from __future__ import unicode_literals
+import json
+import zlib
 from datetime import datetime
 from flask_dance.consumer.backend.sqla import OAuthConsumerMixin
 from sqlalchemy import text
+from sqlalchemy_utils import JSONType
 from webhookdb import db, login_manager
 from .github import (
     User, Repository, UserRepoAssociation, RepositoryHook, Milestone,
-    PullRequest, PullRequestFile, IssueLabel, Issue
+    PullRequest, PullRequestFile, PullRequestPatch, IssueLabel, Issue
 )
 
 
@@ -14,6 +17,9 @@ class OAuth(db.Model, OAuthConsumerMixin):
     "Used by Flask-Dance"
     user_id = db.Column(db.Integer, db.ForeignKey(User.id))
     user = db.relationship(User)
+    # has this user agreed to let their token be used for other people's
+    # scans of public repositories? See webhookdb.tasks.token_pool
+    pool_consent = db.Column(db.Boolean, default=False)
 
 
 class Mutex(db.Model):
@@ -22,6 +28,8 @@ class Mutex(db.Model):
     name = db.Column(db.String(256), primary_key=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, index=True)
+    # how many "sync page" tasks the scan holding this lock has queued
+    page_tasks = db.Column(db.Integer, default=1)
     user = db.relationship(
         User,
         primaryjoin=(user_id == User.id),
@@ -31,6 +39,55 @@ class Mutex(db.Model):
     )
 
 
+class PendingTask(db.Model):
+    """
+    A scan that is waiting for its requestor to have room for more work
+    in flight. See :mod:`webhookdb.tasks.scheduler`.
+    """
+    __tablename__ = "webhookdb_pending_task"
+
+    id = db.Column(db.Integer, primary_key=True)
+    task_name = db.Column(db.String(256))
+    args = db.Column(JSONType)
+    kwargs = db.Column(JSONType)
+    requestor_id = db.Column(db.Integer, index=True)
+    token_id = db.Column(db.Integer, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    dispatched_at = db.Column(db.DateTime, index=True)
+
+
+class WebhookEvent(db.Model):
+    """
+    A webhook delivery from Github, as it was received, so that the database
+    can be rebuilt or caught up without calling the API. See
+    :mod:`webhookdb.process.event` and :mod:`webhookdb.replay`.
+    """
+    __tablename__ = "webhookdb_event_log"
+
+    # also the order that deliveries were received in
+    id = db.Column(db.Integer, primary_key=True)
+    # the X-Github-Delivery header: Github sends it again on redelivery
+    delivery_id = db.Column(db.String(64), unique=True)
+    event = db.Column(db.String(64), index=True)
+    repo_id = db.Column(db.Integer, index=True)
+    repo_full_name = db.Column(db.String(256), index=True)
+    headers = db.Column(JSONType)
+    # the JSON body, compressed
+    payload = db.Column(db.LargeBinary)
+    received_at = db.Column(db.DateTime, default=datetime.now, index=True)
+    # set once the delivery was processed without an error, so that
+    # redeliveries of a delivery that failed aren't skipped
+    processed_at = db.Column(db.DateTime)
+
+    @property
+    def payload_json(self):
+        return json.loads(zlib.decompress(self.payload))
+
+    @payload_json.setter
+    def payload_json(self, data):
+        self.payload = zlib.compress(json.dumps(data))
+
+
 @login_manager.user_loader
 def load_user(user_id):
     "Used by Flask-Login"
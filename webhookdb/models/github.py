@@ -1,8 +1,12 @@
 # coding=utf-8
 from __future__ import unicode_literals
+import zlib
+import json
+import hashlib
 from datetime import datetime
 from sqlalchemy import func, and_
 from sqlalchemy.orm import backref
+from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.ext.associationproxy import association_proxy
@@ -39,7 +43,49 @@ class ReplicationTimestampMixin(object):
         return func.greatest(webhook, api, datetime.min)
 
 
-class User(db.Model, ReplicationTimestampMixin, UserMixin):
+class RawPayloadMixin(object):
+    """
+    Keeps the JSON that Github sent for this object, compressed, so that
+    :attr:`github_json` can return it instead of rebuilding it from this
+    object and the objects it refers to. Payloads are only stored if the
+    ``STORE_RAW_PAYLOADS`` config variable is set. The column is deferred,
+    so it's only loaded when it's used (or when a query undefers it).
+    """
+    # github_json key -> attribute, for fields that WebhookDB may have
+    # updated since the payload was stored
+    raw_payload_overrides = {}
+
+    @declared_attr
+    def raw_payload(cls):
+        return db.deferred(db.Column(db.LargeBinary))
+
+    @property
+    def raw_payload_json(self):
+        if not self.raw_payload:
+            return None
+        return json.loads(zlib.decompress(self.raw_payload))
+
+    def update_raw_payload(self, data):
+        """
+        Merge ``data`` into the stored payload. Objects nested in other
+        objects' payloads are often abbreviated, so this keeps any fields
+        that ``data`` leaves out.
+        """
+        payload = self.raw_payload_json or {}
+        payload.update(data)
+        self.raw_payload = zlib.compress(json.dumps(payload))
+
+    def raw_github_json(self):
+        "The stored payload with local overrides, or None."
+        payload = self.raw_payload_json
+        if payload is None:
+            return None
+        for key, attr in self.raw_payload_overrides.items():
+            payload[key] = getattr(self, attr)
+        return payload
+
+
+class User(db.Model, ReplicationTimestampMixin, RawPayloadMixin, UserMixin):
     __tablename__ = "github_user"
 
     id = db.Column(db.Integer, primary_key=True)
@@ -84,6 +130,9 @@ class User(db.Model, ReplicationTimestampMixin, UserMixin):
 
     @property
     def github_json(self):
+        raw = self.raw_github_json()
+        if raw is not None:
+            return raw
         url = "https://api.github.com/users/{login}".format(login=self.login)
         html_url = "https://github.com/{login}".format(login=self.login)
         avatar_url = "https://avatars.githubusercontent.com/u/{id}".format(
@@ -111,7 +160,7 @@ class User(db.Model, ReplicationTimestampMixin, UserMixin):
         return serialized
 
 
-class Repository(db.Model, ReplicationTimestampMixin):
+class Repository(db.Model, ReplicationTimestampMixin, RawPayloadMixin):
     __tablename__ = "github_repository"
 
     id = db.Column(db.Integer, primary_key=True)
@@ -158,6 +207,14 @@ class Repository(db.Model, ReplicationTimestampMixin):
     pull_requests_last_scanned_at = db.Column(db.DateTime)
     labels_last_scanned_at = db.Column(db.DateTime)
     milestones_last_scanned_at = db.Column(db.DateTime)
+    # for polling the events API -- see webhookdb.tasks.events
+    events_etag = db.Column(db.String(256))
+    events_last_id = db.Column(db.BigInteger)
+    events_last_polled_at = db.Column(db.DateTime)
+    events_poll_interval = db.Column(db.Integer)
+    # for conditional fetches of the repository itself -- see
+    # webhookdb.tasks.resync
+    etag = db.Column(db.String(256))
 
     # just for finding all the admins on a repo
     admin_assocs = db.relationship(
@@ -208,6 +265,9 @@ class Repository(db.Model, ReplicationTimestampMixin):
 
     @property
     def github_json(self):
+        raw = self.raw_github_json()
+        if raw is not None:
+            return raw
         url = "https://api.github.com/repos/{owner}/{repo}".format(
             owner=self.owner_login,
             repo=self.name,
@@ -346,8 +406,13 @@ class RepositoryHook(db.Model, ReplicationTimestampMixin):
     updated_at = db.Column(db.DateTime)
 
 
-class Milestone(db.Model, ReplicationTimestampMixin):
+class Milestone(db.Model, ReplicationTimestampMixin, RawPayloadMixin):
     __tablename__ = "github_milestone"
+    raw_payload_overrides = {
+        "state": "state",
+        "open_issues": "open_issues_count",
+        "closed_issues": "closed_issues_count",
+    }
 
     repo_id = db.Column(db.Integer, primary_key=True)
     repo = db.relationship(
@@ -400,6 +465,9 @@ class Milestone(db.Model, ReplicationTimestampMixin):
 
     @property
     def github_json(self):
+        raw = self.raw_github_json()
+        if raw is not None:
+            return raw
         url = "https://api.github.com/repos/{owner}/{repo}/milestones/{number}".format(
             owner=self.repo.owner_login,
             repo=self.repo.name,
@@ -414,7 +482,6 @@ class Milestone(db.Model, ReplicationTimestampMixin):
             "url": url,
             "html_url": html_url,
             "labels_url": url + "/labels",
-            "id": self.id,
             "number": self.number,
             "state": self.state,
             "title": self.title,
@@ -430,8 +497,20 @@ class Milestone(db.Model, ReplicationTimestampMixin):
         return serialized
 
 
-class PullRequest(db.Model, ReplicationTimestampMixin):
+class PullRequest(db.Model, ReplicationTimestampMixin, RawPayloadMixin):
     __tablename__ = "github_pull_request"
+    __table_args__ = (
+        # for listing a repository's pull requests by number
+        db.Index("ix_github_pull_request_base_repo_number", "base_repo_id", "number"),
+    )
+    raw_payload_overrides = {
+        "state": "state",
+        "locked": "locked",
+        "merged": "merged",
+        "mergeable": "mergeable",
+        "comments": "comments_count",
+        "review_comments": "review_comments_count",
+    }
 
     id = db.Column(db.Integer, primary_key=True)
     number = db.Column(db.Integer)
@@ -470,6 +549,7 @@ class PullRequest(db.Model, ReplicationTimestampMixin):
         backref=backref("pull_requests", order_by=number),
     )
     base_ref = db.Column(db.String(256))
+    base_sha = db.Column(db.String(40))
     head_repo_id = db.Column(db.Integer, index=True)
     head_repo = db.relationship(
         Repository,
@@ -478,6 +558,7 @@ class PullRequest(db.Model, ReplicationTimestampMixin):
         remote_side=Repository.id,
     )
     head_ref = db.Column(db.String(256))
+    head_sha = db.Column(db.String(40))
     milestone_number = db.Column(db.Integer)
     milestone = db.relationship(
         Milestone,
@@ -547,6 +628,9 @@ class PullRequest(db.Model, ReplicationTimestampMixin):
         Serialize to a JSON-serializable dict that matches GitHub's
         JSON serialization.
         """
+        raw = self.raw_github_json()
+        if raw is not None:
+            return raw
         url = "https://api.github.com/repos/{owner}/{repo}/pulls/{number}".format(
             owner=self.base_repo.owner_login,
             repo=self.base_repo.name,
@@ -573,7 +657,7 @@ class PullRequest(db.Model, ReplicationTimestampMixin):
             "comments_url": issue_url + "/comments",
             "review_comments_url": url + "/comments",
             "review_comment_url": url + "/comment{/number}",
-            "statuses_url": url + "/statuses/1234567890abcdef",
+            "statuses_url": url + "/statuses/{sha}".format(sha=self.head_sha),
             "_links": {
                 "self": {
                     "href": url,
@@ -597,7 +681,7 @@ class PullRequest(db.Model, ReplicationTimestampMixin):
                     "href": url + "/commits",
                 },
                 "statuses": {
-                    "href": url + "/statuses/1234567890abcdef",
+                    "href": url + "/statuses/{sha}".format(sha=self.head_sha),
                 }
             },
             "number": self.number,
@@ -617,7 +701,7 @@ class PullRequest(db.Model, ReplicationTimestampMixin):
                     owner=self.head_repo.owner_login, ref=self.head_ref
                 ),
                 "ref": self.head_ref,
-                "sha": "1234567890abcdef",
+                "sha": self.head_sha,
                 "user": self.head_repo.owner.github_json,
                 "repo": self.head_repo.github_json,
             },
@@ -626,14 +710,14 @@ class PullRequest(db.Model, ReplicationTimestampMixin):
                     owner=self.base_repo.owner_login, ref=self.base_ref
                 ),
                 "ref": self.base_ref,
-                "sha": "1234567890abcdef",
+                "sha": self.base_sha,
                 "user": self.base_repo.owner.github_json,
                 "repo": self.base_repo.github_json,
             },
             "merged": self.merged,
             "mergeable": self.mergeable,
             "mergeable_state": self.mergeable_state,
-            "merged_by": getattr(self.assignee, "github_json", None),
+            "merged_by": getattr(self.merged_by, "github_json", None),
             "comments": self.comments_count,
             "review_comments": self.review_comments_count,
             "commits": self.commits_count,
@@ -646,20 +730,161 @@ class PullRequest(db.Model, ReplicationTimestampMixin):
         return serialized
 
 
+class PullRequestPatch(db.Model):
+    """
+    The text of a pull request file's patch, compressed. Patches are stored
+    out of line, keyed by a hash of their content: they make up most of the
+    size of pull request files, and the same patch often shows up again
+    (for example, when a branch is force-pushed, or a change is backported).
+    They aren't keyed by the file's blob SHA, because the same blob has a
+    different patch in pull requests against different bases.
+
+    Pull request files share patches, so a patch is only deleted once no
+    file refers to it -- see :meth:`collect`.
+    """
+    __tablename__ = "github_pull_request_patch"
+
+    hash = db.Column(db.String(40), primary_key=True)
+    data = db.Column(db.LargeBinary)
+    # uncompressed size, in bytes
+    size = db.Column(db.Integer)
+
+    @staticmethod
+    def hash_text(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def for_text(cls, text):
+        """
+        Return the patch with this text, or a new one if it isn't in the
+        webhookdb database yet. An existing patch is locked until the end
+        of the transaction, so that :meth:`collect` can't delete it while
+        a file is being pointed at it.
+        """
+        patch_hash = cls.hash_text(text)
+        # this autoflushes, so it finds patches that were just added to
+        # the session, too
+        patch = cls.query.with_for_update(read=True).get(patch_hash)
+        if not patch:
+            encoded = text.encode("utf-8")
+            patch = cls(
+                hash=patch_hash, data=zlib.compress(encoded), size=len(encoded),
+            )
+        return patch
+
+    @property
+    def text(self):
+        return zlib.decompress(self.data).decode("utf-8")
+
+    @classmethod
+    def collect(cls, hashes):
+        """
+        Delete the patches with these hashes that no pull request file
+        refers to anymore. Call this after removing or changing files, with
+        the hashes of the patches they used to have. Returns the number of
+        patches deleted.
+
+        The patches are locked first, so this waits for any transaction
+        that is reusing one of them (see :meth:`for_text`) to commit, and
+        then sees the file that now refers to it. A transaction that tries
+        to reuse a patch while this one holds the lock finds it deleted,
+        and stores it again.
+        """
+        hashes = sorted(patch_hash for patch_hash in set(hashes) if patch_hash)
+        if not hashes:
+            return 0
+        # in a consistent order, so that two collections can't deadlock
+        (
+            db.session.query(cls.hash).filter(cls.hash.in_(hashes))
+            .order_by(cls.hash).with_for_update().all()
+        )
+        referenced = (
+            db.session.query(PullRequestFile.patch_hash)
+            .filter(PullRequestFile.patch_hash == cls.hash)
+            .exists()
+        )
+        return (
+            cls.query.filter(cls.hash.in_(hashes))
+            .filter(~referenced)
+            .delete(synchronize_session=False)
+        )
+
+
 class PullRequestFile(db.Model, ReplicationTimestampMixin):
     __tablename__ = "github_pull_request_file"
 
     pull_request_id = db.Column(db.Integer, db.ForeignKey(PullRequest.id), primary_key=True)
     pull_request = db.relationship(PullRequest)
 
+    # files with the same contents have the same SHA, so both are needed
+    filename = db.Column(db.String(256), primary_key=True)
     sha = db.Column(db.String(40), primary_key=True)
-    filename = db.Column(db.String(256))
     status = db.Column(db.String(64))
     additions = db.Column(db.Integer)
     deletions = db.Column(db.Integer)
     changes = db.Column(db.Integer)
-    patch = db.Column(db.Text)
+    # the patch itself is only loaded when it's used
+    patch_hash = db.Column(db.String(40), index=True)
+    patch_blob = db.relationship(
+        PullRequestPatch,
+        primaryjoin=(patch_hash == PullRequestPatch.hash),
+        foreign_keys=patch_hash,
+        remote_side=PullRequestPatch.hash,
+    )
+
+    @property
+    def patch(self):
+        if not self.patch_blob:
+            return None
+        return self.patch_blob.text
+
+    @patch.setter
+    def patch(self, text):
+        if text is None:
+            self.patch_blob = None
+        elif self.patch_hash != PullRequestPatch.hash_text(text):
+            self.patch_blob = PullRequestPatch.for_text(text)
 
+    @property
+    def github_json(self):
+        """
+        Serialize to a JSON-serializable dict that matches GitHub's
+        JSON serialization.
+        """
+        serialized = {
+            "sha": self.sha,
+            "filename": self.filename,
+            "status": self.status,
+            "additions": self.additions,
+            "deletions": self.deletions,
+            "changes": self.changes,
+            "blob_url": None,
+            "raw_url": None,
+            "contents_url": None,
+            "patch": self.patch,
+        }
+        pr = self.pull_request
+        # the head repo is gone if the fork was deleted
+        repo = pr and (pr.head_repo or pr.base_repo)
+        if not repo or not pr.head_sha:
+            return serialized
+        html_url = "https://github.com/{owner}/{repo}".format(
+            owner=repo.owner_login, repo=repo.name,
+        )
+        serialized["blob_url"] = "{html_url}/blob/{ref}/{filename}".format(
+            html_url=html_url, ref=pr.head_sha, filename=self.filename,
+        )
+        serialized["raw_url"] = "{html_url}/raw/{ref}/{filename}".format(
+            html_url=html_url, ref=pr.head_sha, filename=self.filename,
+        )
+        serialized["contents_url"] = (
+            "https://api.github.com/repos/{owner}/{repo}/contents/"
+            "{filename}?ref={ref}"
+        ).format(
+            owner=repo.owner_login, repo=repo.name,
+            filename=self.filename, ref=pr.head_sha,
+        )
+        return serialized
 
     def __unicode__(self):
         return "{pr} {filename}".format(
@@ -671,7 +896,7 @@ class PullRequestFile(db.Model, ReplicationTimestampMixin):
         return unicode(self).encode('utf-8')
 
 
-class IssueLabel(db.Model, ReplicationTimestampMixin):
+class IssueLabel(db.Model, ReplicationTimestampMixin, RawPayloadMixin):
     __tablename__ = "github_issue_label"
 
     repo_id = db.Column(db.Integer, primary_key=True)
@@ -723,7 +948,14 @@ class IssueLabel(db.Model, ReplicationTimestampMixin):
 
     @property
     def github_json(self):
-        url = "https://api.github.com/repos/{owner}/{repo}/labels/{name}",
+        raw = self.raw_github_json()
+        if raw is not None:
+            return raw
+        url = "https://api.github.com/repos/{owner}/{repo}/labels/{name}".format(
+            owner=self.repo.owner_login,
+            repo=self.repo.name,
+            name=self.name,
+        )
         serialized = {
             "url": url,
             "name": self.name,
@@ -738,8 +970,17 @@ label_association_table = db.Table("github_issue_label_association", db.Model.me
 )
 
 
-class Issue(db.Model, ReplicationTimestampMixin):
+class Issue(db.Model, ReplicationTimestampMixin, RawPayloadMixin):
     __tablename__ = "github_issue"
+    __table_args__ = (
+        # for listing a repository's issues by number
+        db.Index("ix_github_issue_repo_number", "repo_id", "number"),
+    )
+    raw_payload_overrides = {
+        "state": "state",
+        "locked": "locked",
+        "comments": "comments_count",
+    }
 
     id = db.Column(db.Integer, primary_key=True)
     repo_id = db.Column(db.Integer, index=True)
@@ -792,6 +1033,7 @@ class Issue(db.Model, ReplicationTimestampMixin):
         foreign_keys=[milestone_number, repo_id],
         backref=backref("issues", order_by=lambda: Issue.number),
     )
+    locked = db.Column(db.Boolean)
     comments_count = db.Column(db.Integer)
     created_at = db.Column(db.DateTime)
     updated_at = db.Column(db.DateTime)
@@ -829,6 +1071,9 @@ class Issue(db.Model, ReplicationTimestampMixin):
 
     @property
     def github_json(self):
+        raw = self.raw_github_json()
+        if raw is not None:
+            return raw
         url = "https://api.github.com/repos/{owner}/{repo}/issues/{number}".format(
             owner=self.repo.owner_login,
             repo=self.repo.name,
@@ -4,13 +4,15 @@ from __future__ import unicode_literals, print_function
 import os
 from datetime import datetime
 
+import requests
+from requests.adapters import HTTPAdapter
 from flask import request, flash
 from flask_dance.contrib.github import make_github_blueprint
 from flask_dance.consumer.requests import OAuth2Session
 from flask_dance.consumer.backend.sqla import SQLAlchemyBackend
 from flask_dance.consumer import oauth_authorized, oauth_error
 from flask_login import login_user, current_user
-from webhookdb import db
+from webhookdb import db, token_cache
 from webhookdb.models import OAuth
 from webhookdb.exceptions import RateLimited
 
@@ -20,16 +22,40 @@ class GithubSession(OAuth2Session):
     A requests.Session subclass with a few special properties:
 
     * base_url relative resolution (from OAuth2SessionWithBaseURL)
-    * remembers the last request it made, using the `last_response` property
     * raises a RateLimited exception if our Github rate limit has expired
+    * accepts a `token` for each request, so that one session can be shared
+      by many threads or greenlets making requests as different users
     """
-    last_response = None
+    # enough connections for a worker running lots of greenlets or threads
+    pool_maxsize = 100
 
-    def request(self, method, url, data=None, headers=None, **kwargs):
-        resp = super(GithubSession, self).request(
-            method=method, url=url, data=data, headers=headers, **kwargs
-        )
-        self.last_response = resp
+    def __init__(self, *args, **kwargs):
+        super(GithubSession, self).__init__(*args, **kwargs)
+        self.mount("https://", HTTPAdapter(pool_maxsize=self.pool_maxsize))
+
+    def request(self, method, url, data=None, headers=None, token=None, **kwargs):
+        """
+        If `token` is None, use the token that Flask-Dance loads for the
+        current user. Otherwise, authenticate this request (and only this
+        request) with the given token: an empty dict means anonymous.
+        """
+        if token is None:
+            resp = super(GithubSession, self).request(
+                method=method, url=url, data=data, headers=headers, **kwargs
+            )
+        else:
+            headers = dict(headers or {})
+            if token.get("access_token"):
+                headers["Authorization"] = "token {token}".format(
+                    token=token["access_token"],
+                )
+            if self.base_url:
+                url = self.base_url.relative(url)
+            # skip OAuth2Session.request, which would add the session's token
+            resp = requests.Session.request(
+                self, method=method, url=url, data=data, headers=headers,
+                **kwargs
+            )
         if resp.status_code == 403 and resp.headers.get("X-RateLimit-Remaining"):
             rl_remaining = int(resp.headers["X-RateLimit-Remaining"])
             if rl_remaining < 1:
@@ -42,7 +68,20 @@ github_bp = make_github_blueprint(
     redirect_to="ui.index",
     session_class=GithubSession,
 )
-github_bp.backend = SQLAlchemyBackend(OAuth, db.session, user=current_user)
+github_bp.backend = SQLAlchemyBackend(
+    OAuth, db.session, user=current_user, cache=token_cache,
+)
+
+
+def token_for(user_id):
+    """
+    Look up the OAuth token for a user, without changing any state that's
+    shared between threads or greenlets (like ``github_bp.config``).
+    Returns an empty dict for anonymous access.
+    """
+    if not user_id:
+        return {}
+    return github_bp.backend.get(github_bp, user_id=int(user_id)) or {}
 
 
 @oauth_authorized.connect_via(github_bp)
@@ -71,6 +110,8 @@ def github_logged_in(blueprint, token):
         if resp.ok:
             from webhookdb.tasks.user import process_user
             user = process_user(resp.json(), via="api", fetched_at=datetime.now())
+            # the user may have a new token now
+            token_cache.invalidate(user.id)
             login_user(user)
             flash("Successfully signed in with Github")
         else:
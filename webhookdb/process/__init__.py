@@ -5,4 +5,6 @@ from .issue import process_issue
 from .repository import process_repository
 from .repository_hook import process_repository_hook
 from .pull_request import process_pull_request
-from .pull_request_file import process_pull_request_file
+from .pull_request_file import process_pull_request_file, process_pull_request_files
+from .bulk import bulk_process_issues, bulk_process_pull_requests
+from .event import process_event, log_event
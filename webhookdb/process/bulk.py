@@ -0,0 +1,273 @@
+# coding=utf-8
+"""
+Initial loads with Postgres ``COPY``.
+
+The first scan of a big repository inserts every issue and pull request
+through the ORM, one object at a time, which spends most of its time on
+round trips and per-object bookkeeping. When a repository doesn't have any
+issues (or pull requests) yet, the page tasks use this module instead: the
+rows are normalized in Python, streamed into a temporary staging table with
+``COPY``, and merged into the real table with one ``INSERT ... SELECT`` per
+table. The users, repositories, labels and milestones that those rows refer
+to repeat a lot within a page, so they are deduplicated and go through the
+usual ``process_*`` functions.
+
+Bulk loading is only used on PostgreSQL, when the ``BULK_LOAD_ENABLED``
+config variable is set, and only when the table has no rows for the
+repository. Objects that are already in the database go through the normal
+path, and the merge leaves alone any rows that appear while it's running.
+"""
+from __future__ import unicode_literals, print_function
+
+import io
+import json
+import zlib
+import binascii
+from datetime import datetime
+from collections import OrderedDict
+from flask import current_app
+from iso8601 import parse_date
+from webhookdb import db
+from webhookdb.models import Issue, PullRequest
+from webhookdb.models.github import label_association_table
+from webhookdb.process import (
+    process_user, process_label, process_milestone, process_repository,
+    process_issue, process_pull_request,
+)
+from webhookdb.exceptions import MissingData, StaleData
+
+
+def bulk_load_available(query):
+    """
+    Should we bulk load the rows that ``query`` selects? Only if we can,
+    and if there aren't any yet.
+    """
+    if not current_app.config.get("BULK_LOAD_ENABLED"):
+        return False
+    if db.engine.dialect.name != "postgresql":
+        return False
+    return not db.session.query(query.exists()).scalar()
+
+
+def copy_value(value):
+    "Format a value for the text format of ``COPY``."
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        # bytea hex format, with the backslash escaped
+        return "\\\\x" + binascii.hexlify(value).decode("ascii")
+    return (
+        unicode(value).replace("\\", "\\\\").replace("\t", "\\t")
+        .replace("\n", "\\n").replace("\r", "\\r")
+    )
+
+
+def copy_rows(table, rows):
+    """
+    Insert ``rows``, a list of dicts of column values, into ``table``. The rows
+    are copied into a staging table, and merged into ``table`` with a single
+    statement that skips rows whose primary key (or, for tables that don't
+    have one, whose every column) is already there. Returns how many rows
+    were inserted.
+    """
+    if not rows:
+        return 0
+    columns = [column.name for column in table.columns if column.name in rows[0]]
+    key = [column.name for column in table.primary_key.columns] or columns
+    unique = OrderedDict(
+        (tuple(row[name] for name in key), row) for row in rows
+    )
+    data = io.BytesIO("".join(
+        "\t".join(copy_value(row[name]) for name in columns) + "\n"
+        for row in unique.values()
+    ).encode("utf-8"))
+
+    # anything the ORM is holding on to has to be in the database first
+    db.session.flush()
+    connection = db.session.connection()
+    staging = "staging_{table}".format(table=table.name)
+    connection.execute(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS {staging} "
+        "(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP".format(
+            staging=staging, table=table.name,
+        )
+    )
+    connection.execute("TRUNCATE {staging}".format(staging=staging))
+    cursor = connection.connection.cursor()
+    cursor.copy_expert("COPY {staging} ({columns}) FROM STDIN".format(
+        staging=staging, columns=", ".join(columns),
+    ), data)
+    result = connection.execute(
+        "INSERT INTO {table} ({columns}) "
+        "SELECT {columns} FROM {staging} s WHERE NOT EXISTS "
+        "(SELECT 1 FROM {table} t WHERE {match})".format(
+            table=table.name, staging=staging, columns=", ".join(columns),
+            match=" AND ".join("t.{name} = s.{name}".format(name=name) for name in key),
+        )
+    )
+    return result.rowcount
+
+
+def base_row(data, fields, dt_fields, field_to_model, via, fetched_at):
+    row = {}
+    for field in fields:
+        row[field_to_model.get(field, field)] = data.get(field)
+    for field in dt_fields:
+        value = data.get(field)
+        row[field] = parse_date(value).replace(tzinfo=None) if value else None
+    row["last_replicated_via_{}_at".format(via)] = fetched_at
+    if current_app.config.get("STORE_RAW_PAYLOADS"):
+        row["raw_payload"] = zlib.compress(json.dumps(data))
+    return row
+
+
+def add_user_references(row, data, user_fields, users):
+    "Fill in the user columns of ``row``, and collect the users it refers to."
+    for user_field in user_fields:
+        user_data = data.get(user_field)
+        row["{}_id".format(user_field)] = user_data["id"] if user_data else None
+        row["{}_login".format(user_field)] = user_data["login"] if user_data else None
+        if user_data:
+            users[user_data["id"]] = user_data
+
+
+def process_referenced(process, objects, **kwargs):
+    for obj_data in objects:
+        try:
+            process(obj_data, commit=False, **kwargs)
+        except StaleData:
+            pass
+
+
+def split_existing(model, objects_data):
+    """
+    Split a list of payloads into the ones we don't have in the database
+    yet, and the ones we do.
+    """
+    ids = [obj_data["id"] for obj_data in objects_data]
+    existing = set(
+        obj_id for (obj_id,) in
+        db.session.query(model.id).filter(model.id.in_(ids))
+    ) if ids else set()
+    new = [obj_data for obj_data in objects_data if obj_data["id"] not in existing]
+    old = [obj_data for obj_data in objects_data if obj_data["id"] in existing]
+    return new, old
+
+
+def bulk_process_issues(issues_data, repo_id, via="api", fetched_at=None):
+    """
+    Insert issues from a list of payloads into the repository with the given
+    ID. Returns the issue IDs.
+    """
+    fetched_at = fetched_at or datetime.now()
+    for issue_data in issues_data:
+        if not issue_data.get("id"):
+            raise MissingData("no issue ID", obj=issue_data)
+    new, old = split_existing(Issue, issues_data)
+
+    users = {}
+    labels = {}
+    milestones = {}
+    rows = []
+    label_rows = []
+    for issue_data in new:
+        row = base_row(
+            issue_data,
+            fields=("id", "number", "state", "locked", "title", "body", "comments"),
+            dt_fields=("created_at", "updated_at", "closed_at"),
+            field_to_model={"comments": "comments_count"},
+            via=via, fetched_at=fetched_at,
+        )
+        row["repo_id"] = repo_id
+        add_user_references(row, issue_data, ("user", "assignee", "closed_by"), users)
+        for label_data in issue_data.get("labels") or []:
+            labels[label_data["name"]] = label_data
+            label_rows.append({
+                "issue_id": issue_data["id"], "label_name": label_data["name"],
+            })
+        milestone_data = issue_data.get("milestone")
+        row["milestone_number"] = milestone_data["number"] if milestone_data else None
+        if milestone_data:
+            milestones[milestone_data["number"]] = milestone_data
+        rows.append(row)
+
+    process_referenced(process_user, users.values(), via=via, fetched_at=fetched_at)
+    process_referenced(
+        process_label, labels.values(),
+        via=via, fetched_at=fetched_at, repo_id=repo_id,
+    )
+    process_referenced(
+        process_milestone, milestones.values(),
+        via=via, fetched_at=fetched_at, repo_id=repo_id,
+    )
+    copy_rows(Issue.__table__, rows)
+    copy_rows(label_association_table, label_rows)
+    for issue_data in old:
+        try:
+            process_issue(
+                issue_data, via=via, fetched_at=fetched_at, commit=False,
+                repo_id=repo_id,
+            )
+        except StaleData:
+            pass
+    db.session.commit()
+    return [issue_data["id"] for issue_data in issues_data]
+
+
+def bulk_process_pull_requests(prs_data, via="api", fetched_at=None):
+    """
+    Insert pull requests from a list of payloads. Returns the pull
+    request numbers.
+    """
+    fetched_at = fetched_at or datetime.now()
+    for pr_data in prs_data:
+        if not pr_data.get("id"):
+            raise MissingData("no pull_request ID", obj=pr_data)
+    new, old = split_existing(PullRequest, prs_data)
+
+    users = {}
+    repos = {}
+    rows = []
+    for pr_data in new:
+        row = base_row(
+            pr_data,
+            fields=(
+                "id", "number", "state", "locked", "title", "body", "merged",
+                "mergeable", "comments", "review_comments", "commits",
+                "additions", "deletions", "changed_files",
+            ),
+            dt_fields=("created_at", "updated_at", "closed_at", "merged_at"),
+            field_to_model={
+                "comments": "comments_count",
+                "review_comments": "review_comments_count",
+                "commits": "commits_count",
+            },
+            via=via, fetched_at=fetched_at,
+        )
+        add_user_references(row, pr_data, ("user", "assignee", "merged_by"), users)
+        for ref in ("base", "head"):
+            ref_data = pr_data.get(ref) or {}
+            repo_data = ref_data.get("repo")
+            row["{}_ref".format(ref)] = ref_data.get("ref")
+            row["{}_sha".format(ref)] = ref_data.get("sha")
+            row["{}_repo_id".format(ref)] = repo_data["id"] if repo_data else None
+            if repo_data:
+                repos[repo_data["id"]] = repo_data
+        rows.append(row)
+
+    process_referenced(process_user, users.values(), via=via, fetched_at=fetched_at)
+    process_referenced(
+        process_repository, repos.values(), via=via, fetched_at=fetched_at,
+    )
+    copy_rows(PullRequest.__table__, rows)
+    for pr_data in old:
+        try:
+            process_pull_request(pr_data, via=via, fetched_at=fetched_at, commit=False)
+        except StaleData:
+            pass
+    db.session.commit()
+    return [pr_data["number"] for pr_data in prs_data]
@@ -0,0 +1,256 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from datetime import datetime
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from webhookdb import db
+from webhookdb.models import WebhookEvent, PullRequest
+from webhookdb.process import (
+    process_user, process_label, process_milestone, process_issue,
+    process_pull_request, process_repository,
+)
+from webhookdb.process.label import rename_label, delete_label
+from webhookdb.process.milestone import delete_milestone
+from webhookdb.process.pull_request import adjust_review_comments_count
+from webhookdb.process.repository import (
+    permissions_for_level, process_repository_permissions
+)
+from webhookdb.exceptions import MissingData, StaleData
+
+# X-Github-Event header -> (payload key, process function, takes repo_id)
+EVENT_PROCESSORS = {
+    "issues": ("issue", process_issue, True),
+    "pull_request": ("pull_request", process_pull_request, False),
+    "repository": ("repository", process_repository, False),
+}
+# request headers worth keeping with each event
+LOGGED_HEADER_PREFIXES = ("x-github-", "x-hub-")
+# what a collaborator could do before Github had finer-grained permissions
+DEFAULT_MEMBER_PERMISSION = "write"
+
+
+def log_event(event, headers, payload):
+    """
+    Append a webhook delivery to the event log, if the ``EVENT_LOG_ENABLED``
+    config variable is set. Returns the new
+    :class:`~webhookdb.models.WebhookEvent`, or None if the event isn't
+    logged or if this delivery is already in the log.
+    """
+    if not current_app.config.get("EVENT_LOG_ENABLED"):
+        return None
+    repo_data = payload.get("repository") or {}
+    logged = WebhookEvent(
+        delivery_id=headers.get("X-Github-Delivery"),
+        event=event,
+        repo_id=repo_data.get("id"),
+        repo_full_name=repo_data.get("full_name"),
+        headers={
+            key: value for key, value in headers.items()
+            if key.lower().startswith(LOGGED_HEADER_PREFIXES)
+        },
+        received_at=datetime.now(),
+    )
+    logged.payload_json = payload
+    db.session.add(logged)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Github redelivered it
+        db.session.rollback()
+        return None
+    return logged
+
+
+def delivery_processed(delivery_id):
+    "Was this logged delivery processed without an error before?"
+    processed_at = (
+        db.session.query(WebhookEvent.processed_at)
+        .filter_by(delivery_id=delivery_id).scalar()
+    )
+    return processed_at is not None
+
+
+def mark_processed(delivery_id, commit=True):
+    "Note that a logged delivery was processed without an error."
+    (
+        WebhookEvent.query.filter_by(delivery_id=delivery_id)
+        .filter(WebhookEvent.processed_at == None)
+        .update({"processed_at": datetime.now()}, synchronize_session=False)
+    )
+    if commit:
+        db.session.commit()
+
+
+def payload_repo_id(payload, repo_id=None):
+    repo_data = payload.get("repository") or {}
+    return repo_id or repo_data.get("id")
+
+
+def process_label_event(payload, via="webhook", fetched_at=None, commit=True,
+                        repo_id=None, redelivery=False):
+    """
+    A label was created, edited or deleted. A renamed label is renamed in
+    place on the repository's issues, and a deleted label is removed from
+    them. Returns the label, or None if it was deleted.
+    """
+    label_data = payload.get("label")
+    repo_id = payload_repo_id(payload, repo_id)
+    if not label_data or not repo_id:
+        raise MissingData("no label or repository in payload", obj=payload)
+
+    if payload.get("action") == "deleted":
+        delete_label(repo_id, label_data["name"], commit=commit)
+        return None
+
+    old_name = payload.get("changes", {}).get("name", {}).get("from")
+    if old_name and old_name != label_data["name"]:
+        rename_label(repo_id, old_name, label_data["name"], commit=False)
+    return process_label(
+        label_data, via=via, fetched_at=fetched_at, commit=commit,
+        repo_id=repo_id,
+    )
+
+
+def process_milestone_event(payload, via="webhook", fetched_at=None,
+                            commit=True, repo_id=None, redelivery=False):
+    """
+    A milestone was created, edited, closed, opened or deleted. A deleted
+    milestone is removed from the repository's issues and pull requests.
+    Returns the milestone, or None if it was deleted.
+    """
+    milestone_data = payload.get("milestone")
+    repo_id = payload_repo_id(payload, repo_id)
+    if not milestone_data or not repo_id:
+        raise MissingData("no milestone or repository in payload", obj=payload)
+
+    if payload.get("action") == "deleted":
+        delete_milestone(repo_id, milestone_data["number"], commit=commit)
+        return None
+    return process_milestone(
+        milestone_data, via=via, fetched_at=fetched_at, commit=commit,
+        repo_id=repo_id,
+    )
+
+
+def process_member_event(payload, via="webhook", fetched_at=None, commit=True,
+                         repo_id=None, redelivery=False):
+    """
+    A collaborator was added to or removed from a repository, or their
+    permissions changed. A removed collaborator may still have access
+    through a team or the organization, so their permissions aren't changed
+    here: the webhook endpoint syncs them again. Returns the collaborator's
+    ID.
+    """
+    user_data = payload.get("member")
+    repo_id = payload_repo_id(payload, repo_id)
+    if not user_data or not repo_id:
+        raise MissingData("no member or repository in payload", obj=payload)
+
+    try:
+        process_user(user_data, via=via, fetched_at=fetched_at, commit=False)
+    except StaleData:
+        pass
+
+    if payload.get("action") != "removed":
+        permission_change = payload.get("changes", {}).get("permission", {})
+        level = permission_change.get("to") or DEFAULT_MEMBER_PERMISSION
+        process_repository_permissions(
+            user_data["id"], repo_id, permissions_for_level(level),
+            commit=False,
+        )
+    if commit:
+        db.session.commit()
+    return user_data["id"]
+
+
+def process_issue_comment_event(payload, via="webhook", fetched_at=None,
+                                commit=True, repo_id=None, redelivery=False):
+    """
+    A comment on an issue or a pull request's conversation changed. The
+    payload has the whole issue, including its comment count, so there's
+    nothing to fetch. Returns the issue.
+    """
+    issue_data = payload.get("issue")
+    if not issue_data:
+        raise MissingData("no issue in payload", obj=payload)
+
+    issue = process_issue(
+        issue_data, via=via, fetched_at=fetched_at, commit=False,
+        repo_id=payload_repo_id(payload, repo_id),
+    )
+    if issue_data.get("pull_request") and issue.repo_id:
+        # pull requests count their conversation comments the same way
+        PullRequest.query.filter_by(
+            base_repo_id=issue.repo_id, number=issue.number,
+        ).update({
+            PullRequest.comments_count: issue_data.get("comments"),
+        }, synchronize_session=False)
+    if commit:
+        db.session.commit()
+    return issue
+
+
+def process_review_comment_event(payload, via="webhook", fetched_at=None,
+                                 commit=True, repo_id=None, redelivery=False):
+    """
+    A review comment on a pull request changed. The pull request in the
+    payload doesn't include its review comment count, so the count is
+    adjusted instead -- unless this ``redelivery`` was processed before.
+    Returns how many pull requests changed.
+    """
+    pr_data = payload.get("pull_request")
+    if not pr_data:
+        raise MissingData("no pull_request in payload", obj=payload)
+
+    delta = {"created": 1, "deleted": -1}.get(payload.get("action"))
+    if not delta or redelivery:
+        return 0
+    return adjust_review_comments_count(pr_data["id"], delta, commit=commit)
+
+
+# X-Github-Event header -> function that processes the whole payload
+EVENT_HANDLERS = {
+    "label": process_label_event,
+    "milestone": process_milestone_event,
+    "member": process_member_event,
+    "issue_comment": process_issue_comment_event,
+    "pull_request_review_comment": process_review_comment_event,
+}
+
+
+def handles_event(event):
+    "Can :func:`process_event` process this kind of event?"
+    return event in EVENT_PROCESSORS or event in EVENT_HANDLERS
+
+
+def process_event(event, payload, via="webhook", fetched_at=None, commit=True,
+                  repo_id=None, redelivery=False):
+    """
+    Process a webhook payload, for the given kind of event. Unlike the
+    replication endpoints, this doesn't queue any follow-up tasks, so it
+    makes no API calls. Returns the object (None for a deletion), or None if
+    we don't handle this kind of event.
+
+    ``repo_id`` is the ID of the repository that the event happened in.
+    Webhook payloads say that themselves, but the events API and event
+    archives give the repository next to the payload instead. Events that
+    adjust counters don't adjust them again for a ``redelivery``.
+    """
+    if event in EVENT_HANDLERS:
+        return EVENT_HANDLERS[event](
+            payload, via=via, fetched_at=fetched_at, commit=commit,
+            repo_id=repo_id, redelivery=redelivery,
+        )
+    if event not in EVENT_PROCESSORS:
+        return None
+    key, process, takes_repo_id = EVENT_PROCESSORS[event]
+    obj_data = payload.get(key)
+    if not obj_data:
+        raise MissingData("no {key} in payload".format(key=key), obj=payload)
+    kwargs = {}
+    if takes_repo_id:
+        kwargs["repo_id"] = payload_repo_id(payload, repo_id)
+    return process(
+        obj_data, via=via, fetched_at=fetched_at, commit=commit, **kwargs
+    )
@@ -7,18 +7,19 @@ from webhookdb import db
 from webhookdb.models import Issue
 from webhookdb.process import process_user, process_label, process_milestone
 from webhookdb.exceptions import MissingData, StaleData
+from webhookdb.known_ids import get_or_new
+from webhookdb.process.payload import store_raw_payload
 
 
-def process_issue(issue_data, via="webhook", fetched_at=None, commit=True):
+def process_issue(issue_data, via="webhook", fetched_at=None, commit=True,
+                  repo_id=None, raw=True):
     issue_id = issue_data.get("id")
     if not issue_id:
         raise MissingData("no issue ID", obj=issue_data)
 
     # fetch the object from the database,
     # or create it if it doesn't exist in the DB
-    issue = Issue.query.get(issue_id)
-    if not issue:
-        issue = Issue(id=issue_id)
+    issue = get_or_new(Issue, issue_id)
 
     # should we update the object?
     fetched_at = fetched_at or datetime.now()
@@ -33,7 +34,7 @@ def process_issue(issue_data, via="webhook", fetched_at=None, commit=True):
 
     # update the object
     fields = (
-        "number", "state", "title", "body", "comments",
+        "number", "state", "locked", "title", "body", "comments",
     )
     for field in fields:
         if field in issue_data:
@@ -67,8 +68,8 @@ def process_issue(issue_data, via="webhook", fetched_at=None, commit=True):
             if hasattr(issue, login_field):
                 setattr(issue, login_field, None)
 
-    # used for labels and milestone
-    repo_id = None
+    # Github's issue payloads only name the repository in the URLs, so unless
+    # we're told which one it is, it comes from the labels or the milestone
 
     # label reference
     if "labels" in issue_data:
@@ -78,7 +79,7 @@ def process_issue(issue_data, via="webhook", fetched_at=None, commit=True):
             for label_data in label_data_list:
                 label = process_label(
                     label_data, via=via, fetched_at=fetched_at, commit=False,
-                    repo_id=repo_id,
+                    repo_id=repo_id, raw=raw,
                 )
                 repo_id = repo_id or label.repo_id
                 labels.append(label)
@@ -92,13 +93,18 @@ def process_issue(issue_data, via="webhook", fetched_at=None, commit=True):
         if milestone_data:
             milestone = process_milestone(
                 milestone_data, via=via, fetched_at=fetched_at, commit=False,
-                repo_id=repo_id,
+                repo_id=repo_id, raw=raw,
             )
             repo_id = repo_id or milestone.repo_id
             issue.milestone_number = milestone.number
         else:
             issue.milestone = None
 
+    if repo_id:
+        issue.repo_id = repo_id
+
+    store_raw_payload(issue, issue_data, raw=raw)
+
     # update replication timestamp
     replicated_dt_field = "last_replicated_via_{}_at".format(via)
     if hasattr(issue, replicated_dt_field):
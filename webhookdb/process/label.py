@@ -6,13 +6,15 @@ from iso8601 import parse_date
 from urlobject import URLObject
 from colour import Color
 from webhookdb import db
-from webhookdb.models import IssueLabel, Repository
+from webhookdb.models import IssueLabel, Repository, Issue
+from webhookdb.models.github import label_association_table
 from webhookdb.exceptions import MissingData, StaleData, NotFound
+from webhookdb.process.payload import store_raw_payload, clear_raw_payloads
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 
 def process_label(label_data, via="webhook", fetched_at=None, commit=True,
-                  repo_id=None):
+                  repo_id=None, raw=True):
     name = label_data.get("name")
     if not name:
         raise MissingData("no label name")
@@ -70,6 +72,8 @@ def process_label(label_data, via="webhook", fetched_at=None, commit=True,
         else:
             label.color = None
 
+    store_raw_payload(label, label_data, raw=raw)
+
     # update replication timestamp
     replicated_dt_field = "last_replicated_via_{}_at".format(via)
     if hasattr(label, replicated_dt_field):
@@ -81,3 +85,62 @@ def process_label(label_data, via="webhook", fetched_at=None, commit=True,
         db.session.commit()
 
     return label
+
+
+def repo_label_associations(repo_id, name):
+    "A filter for the label associations of a repository's issues."
+    issue_ids = db.session.query(Issue.id).filter(Issue.repo_id == repo_id)
+    return db.and_(
+        label_association_table.c.label_name == name,
+        label_association_table.c.issue_id.in_(issue_ids.subquery()),
+    )
+
+
+def labeled_issue_ids(repo_id, name):
+    "A query for the IDs of a repository's issues that have this label."
+    return (
+        db.session.query(label_association_table.c.issue_id)
+        .filter(repo_label_associations(repo_id, name))
+    )
+
+
+def rename_label(repo_id, old_name, new_name, commit=True):
+    """
+    Rename a label in place, along with its references from issues, so that
+    a renamed label doesn't look like a deleted label and a new one.
+    """
+    clear_raw_payloads(repo_id, labeled_issue_ids(repo_id, old_name).subquery())
+    if IssueLabel.query.get((repo_id, new_name)):
+        IssueLabel.query.filter_by(repo_id=repo_id, name=old_name).delete()
+        # issues that have both labels keep the one they already had
+        db.session.execute(
+            label_association_table.delete()
+            .where(repo_label_associations(repo_id, old_name))
+            .where(label_association_table.c.issue_id.in_(
+                labeled_issue_ids(repo_id, new_name).subquery()
+            ))
+        )
+    else:
+        (
+            IssueLabel.query.filter_by(repo_id=repo_id, name=old_name)
+            .update({"name": new_name})
+        )
+    db.session.execute(
+        label_association_table.update()
+        .where(repo_label_associations(repo_id, old_name))
+        .values(label_name=new_name)
+    )
+    if commit:
+        db.session.commit()
+
+
+def delete_label(repo_id, name, commit=True):
+    "Delete a label, and remove it from the repository's issues."
+    clear_raw_payloads(repo_id, labeled_issue_ids(repo_id, name).subquery())
+    IssueLabel.query.filter_by(repo_id=repo_id, name=name).delete()
+    db.session.execute(
+        label_association_table.delete()
+        .where(repo_label_associations(repo_id, name))
+    )
+    if commit:
+        db.session.commit()
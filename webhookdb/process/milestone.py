@@ -5,13 +5,14 @@ from datetime import datetime
 from iso8601 import parse_date
 from urlobject import URLObject
 from webhookdb import db
-from webhookdb.models import Milestone, Repository
+from webhookdb.models import Milestone, Repository, Issue, PullRequest
 from webhookdb.process import process_user
 from webhookdb.exceptions import MissingData, StaleData
+from webhookdb.process.payload import store_raw_payload
 
 
 def process_milestone(milestone_data, via="webhook", fetched_at=None, commit=True,
-                      repo_id=None):
+                      repo_id=None, raw=True):
     number = milestone_data.get("number")
     if not number:
         raise MissingData("no milestone number")
@@ -105,6 +106,8 @@ def process_milestone(milestone_data, via="webhook", fetched_at=None, commit=Tru
             if hasattr(milestone, login_field):
                 setattr(milestone, login_field, None)
 
+    store_raw_payload(milestone, milestone_data, raw=raw)
+
     # update replication timestamp
     replicated_dt_field = "last_replicated_via_{}_at".format(via)
     if hasattr(milestone, replicated_dt_field):
@@ -116,3 +119,19 @@ def process_milestone(milestone_data, via="webhook", fetched_at=None, commit=Tru
         db.session.commit()
 
     return milestone
+
+
+def delete_milestone(repo_id, number, commit=True):
+    "Delete a milestone, and remove it from the repository's issues and PRs."
+    Milestone.query.filter_by(repo_id=repo_id, number=number).delete()
+    # the stored payloads still show the milestone
+    (
+        Issue.query.filter_by(repo_id=repo_id, milestone_number=number)
+        .update({"milestone_number": None, "raw_payload": None})
+    )
+    (
+        PullRequest.query.filter_by(base_repo_id=repo_id, milestone_number=number)
+        .update({"milestone_number": None, "raw_payload": None})
+    )
+    if commit:
+        db.session.commit()
@@ -0,0 +1,41 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from flask import current_app
+from webhookdb import db
+from webhookdb.models import Issue, PullRequest
+
+
+def store_raw_payload(obj, data, raw=True):
+    """
+    Keep the payload that Github sent for this object, if the
+    ``STORE_RAW_PAYLOADS`` config variable is set. See
+    :class:`~webhookdb.models.github.RawPayloadMixin`. Data that isn't
+    ``raw``, like the payloads the GraphQL backend puts together, isn't
+    kept, and any payload that was kept before is out of date now.
+    """
+    if not current_app.config.get("STORE_RAW_PAYLOADS"):
+        return
+    if raw:
+        obj.update_raw_payload(data)
+    else:
+        obj.raw_payload = None
+
+
+def clear_raw_payloads(repo_id, issue_ids):
+    """
+    Forget the stored payloads of the issues with these IDs (a query), and
+    of the repository's pull requests with the same numbers, because they
+    show labels or a milestone that changed. They're rebuilt from the
+    database until the objects are replicated again.
+    """
+    numbers = db.session.query(Issue.number).filter(Issue.id.in_(issue_ids))
+    (
+        PullRequest.query.filter(PullRequest.base_repo_id == repo_id)
+        .filter(PullRequest.number.in_(numbers.subquery()))
+        .update({"raw_payload": None}, synchronize_session=False)
+    )
+    (
+        Issue.query.filter(Issue.id.in_(issue_ids))
+        .update({"raw_payload": None}, synchronize_session=False)
+    )
@@ -7,18 +7,19 @@ from webhookdb import db
 from webhookdb.models import PullRequest, Repository
 from webhookdb.process import process_user, process_repository
 from webhookdb.exceptions import MissingData, StaleData
+from webhookdb.known_ids import get_or_new
+from webhookdb.process.payload import store_raw_payload
 
 
-def process_pull_request(pr_data, via="webhook", fetched_at=None, commit=True):
+def process_pull_request(pr_data, via="webhook", fetched_at=None, commit=True,
+                         raw=True):
     pr_id = pr_data.get("id")
     if not pr_id:
         raise MissingData("no pull_request ID", obj=pr_data)
 
     # fetch the object from the database,
     # or create it if it doesn't exist in the DB
-    pr = PullRequest.query.get(pr_id)
-    if not pr:
-        pr = PullRequest(id=pr_id)
+    pr = get_or_new(PullRequest, pr_id)
 
     # should we update the object?
     fetched_at = fetched_at or datetime.now()
@@ -79,6 +80,8 @@ def process_pull_request(pr_data, via="webhook", fetched_at=None, commit=True):
         ref_data = pr_data[ref]
         ref_field = "{}_ref".format(ref)
         setattr(pr, ref_field, ref_data["ref"])
+        if "sha" in ref_data:
+            setattr(pr, "{}_sha".format(ref), ref_data["sha"])
         repo_data = ref_data["repo"]
         repo_id_field = "{}_repo_id".format(ref)
         if repo_data:
@@ -90,6 +93,8 @@ def process_pull_request(pr_data, via="webhook", fetched_at=None, commit=True):
         else:
             setattr(pr, repo_id_field, None)
 
+    store_raw_payload(pr, pr_data, raw=raw)
+
     # update replication timestamp
     replicated_dt_field = "last_replicated_via_{}_at".format(via)
     if hasattr(pr, replicated_dt_field):
@@ -101,3 +106,21 @@ def process_pull_request(pr_data, via="webhook", fetched_at=None, commit=True):
         db.session.commit()
 
     return pr
+
+
+def adjust_review_comments_count(pr_id, delta, commit=True):
+    """
+    Add ``delta`` to a pull request's count of review comments. This happens
+    in the database, so concurrent webhooks don't lose each other's changes.
+    Counts we don't know yet stay unknown. Returns how many rows changed.
+    """
+    count = (
+        PullRequest.query.filter_by(id=pr_id)
+        .filter(PullRequest.review_comments_count != None)
+        .update({
+            PullRequest.review_comments_count: PullRequest.review_comments_count + delta,
+        }, synchronize_session=False)
+    )
+    if commit:
+        db.session.commit()
+    return count
@@ -2,11 +2,39 @@
 from __future__ import unicode_literals, print_function
 
 from datetime import datetime
+from flask import current_app
 from webhookdb import db
-from webhookdb.models import PullRequestFile
+from webhookdb.models import PullRequestFile, PullRequestPatch
 from webhookdb.exceptions import MissingData, StaleData, NothingToDo
 
 
+FIELDS = ("filename", "status", "additions", "deletions", "changes", "patch")
+
+
+def file_values(prf_data):
+    """
+    The fields of a pull request file that we store, from Github's data.
+    Patches longer than ``PULL_REQUEST_PATCH_MAX_SIZE`` are left out.
+    """
+    values = {field: prf_data[field] for field in FIELDS if field in prf_data}
+    max_size = current_app.config.get("PULL_REQUEST_PATCH_MAX_SIZE")
+    patch = values.get("patch")
+    if patch and max_size and len(patch) > max_size:
+        values["patch"] = None
+    return values
+
+
+def is_unchanged(prf, values):
+    for field, value in values.items():
+        if field == "patch":
+            # compare hashes, rather than loading the stored patch
+            if prf.patch_hash != (value and PullRequestPatch.hash_text(value)):
+                return False
+        elif getattr(prf, field) != value:
+            return False
+    return True
+
+
 def process_pull_request_file(
             prf_data, via="webhook", fetched_at=None, commit=True,
             pull_request_id=None,
@@ -18,15 +46,21 @@ def process_pull_request_file(
         # way, but it's not actually an error.
         raise NothingToDo("no pull request file SHA")
 
+    filename = prf_data.get("filename")
+    if not filename:
+        raise MissingData("no pull request file filename", obj=prf_data)
+
     pr_id = pull_request_id
     if not pr_id:
         raise MissingData("no pull_request_id", obj=prf_data)
 
     # fetch the object from the database,
     # or create it if it doesn't exist in the DB
-    prf = PullRequestFile.query.get((pr_id, sha))
+    prf = PullRequestFile.query.get((pr_id, filename, sha))
     if not prf:
-        prf = PullRequestFile(sha=sha, pull_request_id=pr_id)
+        prf = PullRequestFile(
+            pull_request_id=pr_id, filename=filename, sha=sha,
+        )
 
     # should we update the object?
     fetched_at = fetched_at or datetime.now()
@@ -34,12 +68,9 @@ def process_pull_request_file(
         raise StaleData()
 
     # update the object
-    fields = (
-        "filename", "status", "additions", "deletions", "changes", "patch",
-    )
-    for field in fields:
-        if field in prf_data:
-            setattr(prf, field, prf_data[field])
+    prev_patch_hash = prf.patch_hash
+    for field, value in file_values(prf_data).items():
+        setattr(prf, field, value)
 
     # update replication timestamp
     replicated_dt_field = "last_replicated_via_{}_at".format(via)
@@ -48,7 +79,97 @@ def process_pull_request_file(
 
     # add to DB session, so that it will be committed
     db.session.add(prf)
+    if prev_patch_hash:
+        db.session.flush()
+        PullRequestPatch.collect([prev_patch_hash])
     if commit:
         db.session.commit()
 
     return prf
+
+
+def process_pull_request_files(
+            files_data, via="webhook", fetched_at=None, commit=True,
+            pull_request_id=None,
+    ):
+    """
+    Bring the files of a pull request in line with the complete list of
+    its files from Github, ``files_data``. Rather than replacing every file,
+    this compares them by filename and SHA: new and modified files are
+    saved, files that are no longer part of the pull request are deleted,
+    and files that haven't changed aren't written at all. All the changes
+    are made in one transaction, so the pull request never appears to have
+    no files. Patches that are no longer used by any file are deleted.
+    ``files_data`` must really be complete: any file it leaves out is
+    deleted.
+
+    Returns a tuple of the number of files saved, and the number deleted.
+    """
+    pr_id = pull_request_id
+    if not pr_id:
+        raise MissingData("no pull_request_id", obj=files_data)
+    fetched_at = fetched_at or datetime.now()
+
+    existing = {
+        (prf.filename, prf.sha): prf
+        for prf in PullRequestFile.query.filter_by(pull_request_id=pr_id)
+    }
+    if any(prf.last_replicated_at > fetched_at for prf in existing.values()):
+        raise StaleData()
+
+    replicated_dt_field = "last_replicated_via_{}_at".format(via)
+    seen = set()
+    saved = 0
+    # patches that these files no longer use, which other files might not
+    # be using either
+    released_patches = set()
+    for prf_data in files_data:
+        sha = prf_data.get("sha")
+        filename = prf_data.get("filename")
+        if not sha or not filename:
+            # a moved file -- see process_pull_request_file
+            continue
+        key = (filename, sha)
+        seen.add(key)
+        values = file_values(prf_data)
+        prf = existing.get(key)
+        if prf and is_unchanged(prf, values):
+            continue
+        if not prf:
+            prf = PullRequestFile(
+                pull_request_id=pr_id, filename=filename, sha=sha,
+            )
+            existing[key] = prf
+        if "patch" in values:
+            released_patches.add(prf.patch_hash)
+        for field, value in values.items():
+            setattr(prf, field, value)
+        if hasattr(prf, replicated_dt_field):
+            setattr(prf, replicated_dt_field, fetched_at)
+        db.session.add(prf)
+        saved += 1
+
+    removed = [key for key in existing if key not in seen]
+    if removed:
+        (
+            PullRequestFile.query.filter_by(pull_request_id=pr_id)
+            .filter(db.tuple_(
+                PullRequestFile.filename, PullRequestFile.sha,
+            ).in_(removed))
+            .delete(synchronize_session=False)
+        )
+        for key in removed:
+            prf = existing[key]
+            released_patches.add(prf.patch_hash)
+            if prf in db.session:
+                db.session.expunge(prf)
+
+    released_patches.discard(None)
+    if released_patches:
+        db.session.flush()
+        PullRequestPatch.collect(released_patches)
+
+    if commit:
+        db.session.commit()
+
+    return saved, len(removed)
@@ -7,6 +7,7 @@ from webhookdb import db
 from webhookdb.models import Repository, UserRepoAssociation
 from webhookdb.process import process_user
 from webhookdb.exceptions import MissingData, StaleData
+from webhookdb.process.payload import store_raw_payload
 
 
 def process_repository(repo_data, via="webhook", fetched_at=None, commit=True,
@@ -63,6 +64,8 @@ def process_repository(repo_data, via="webhook", fetched_at=None, commit=True,
             if hasattr(repo, login_field):
                 setattr(repo, login_field, None)
 
+    store_raw_payload(repo, repo_data)
+
     # update replication timestamp
     replicated_dt_field = "last_replicated_via_{}_at".format(via)
     if hasattr(repo, replicated_dt_field):
@@ -73,17 +76,53 @@ def process_repository(repo_data, via="webhook", fetched_at=None, commit=True,
 
     # if we have requestor_id and permissions, update the permissions object
     if requestor_id and repo_data.get("permissions"):
-        permissions_data = repo_data["permissions"]
-        assoc = UserRepoAssociation.query.get((requestor_id, repo_id))
+        process_repository_permissions(
+            requestor_id, repo_id, repo_data["permissions"], commit=False,
+        )
+
+    if commit:
+        db.session.commit()
+
+    return repo
+
+
+def permissions_for_level(level):
+    """
+    Convert a permission level, as Github names them in ``member`` and
+    ``team_add`` events, to a dict like the ``permissions`` of a repository.
+    """
+    level = (level or "").lower()
+    return {
+        "pull": True,
+        "push": level in ("push", "write", "maintain", "admin"),
+        "admin": level == "admin",
+    }
+
+
+def process_repository_permissions(user_id, repo_id, permissions_data,
+                                   commit=True, upgrade_only=False):
+    """
+    Record what a user can do with a repository. ``permissions_data`` is a
+    dict like the ``permissions`` of a repository, or None if the user can't
+    access the repository anymore. With ``upgrade_only``, permissions the
+    user already has are never taken away: for when the user has gained
+    access one way (like a team) and may still have it another way.
+    """
+    assoc = UserRepoAssociation.query.get((user_id, repo_id))
+    if permissions_data is None:
+        if assoc:
+            db.session.delete(assoc)
+    else:
         if not assoc:
-            assoc = UserRepoAssociation(user_id=requestor_id, repo_id=repo_id)
+            assoc = UserRepoAssociation(user_id=user_id, repo_id=repo_id)
         for perm in ("admin", "push", "pull"):
             if perm in permissions_data:
                 perm_attr = "can_{perm}".format(perm=perm)
-                setattr(assoc, perm_attr, permissions_data[perm])
+                value = permissions_data[perm]
+                if upgrade_only and getattr(assoc, perm_attr):
+                    continue
+                setattr(assoc, perm_attr, value)
         db.session.add(assoc)
-
     if commit:
         db.session.commit()
-
-    return repo
+    return assoc
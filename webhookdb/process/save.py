@@ -0,0 +1,46 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from sqlalchemy.exc import IntegrityError
+from webhookdb import db, metrics, known_ids
+
+# how many times an object is processed before a conflict is given up on
+CONFLICT_ATTEMPTS = 3
+
+
+def resolve_conflicts(process, *args, **kwargs):
+    """
+    Call ``process(*args, commit=True, **kwargs)``, where ``process`` is one
+    of the ``process_*`` functions, and return what it returns.
+
+    Workers processing pages that share users or repositories often try to
+    insert the same object at the same time, and the loser used to fail with
+    an ``IntegrityError`` and retry its whole task, fetching everything from
+    Github again. Instead, the loser's transaction is rolled back and the
+    payload it already has is processed again. This time the process function
+    finds the row that the other worker inserted and updates it -- or raises
+    :exc:`~webhookdb.exceptions.StaleData`, if that row is newer. Inserts
+    don't cost anything extra; only a conflict costs a rollback.
+
+    Conflicts resolved this way are counted in :mod:`webhookdb.metrics` as
+    ``conflict.resolved``. If the object still can't be saved after
+    ``CONFLICT_ATTEMPTS`` tries, the error is raised and counted as
+    ``conflict.unresolved``.
+    """
+    kwargs["commit"] = True
+    conflicts = 0
+    while True:
+        try:
+            result = process(*args, **kwargs)
+        except IntegrityError:
+            db.session.rollback()
+            conflicts += 1
+            if conflicts >= CONFLICT_ATTEMPTS:
+                metrics.incr("conflict.unresolved")
+                # maybe the filters are wrong about something else
+                known_ids.reset()
+                raise
+            continue
+        if conflicts:
+            metrics.incr("conflict.resolved", conflicts)
+        return result
@@ -6,6 +6,8 @@ from iso8601 import parse_date
 from webhookdb import db
 from webhookdb.models import User
 from webhookdb.exceptions import MissingData, StaleData
+from webhookdb.known_ids import get_or_new
+from webhookdb.process.payload import store_raw_payload
 
 
 def process_user(user_data, via="webhook", fetched_at=None, commit=True):
@@ -15,9 +17,7 @@ def process_user(user_data, via="webhook", fetched_at=None, commit=True):
 
     # fetch the object from the database,
     # or create it if it doesn't exist in the DB
-    user = User.query.get(user_id)
-    if not user:
-        user = User(id=user_id)
+    user = get_or_new(User, user_id)
 
     # should we update the object?
     fetched_at = fetched_at or datetime.now()
@@ -49,6 +49,8 @@ def process_user(user_data, via="webhook", fetched_at=None, commit=True):
             dt = parse_date(user_data[field]).replace(tzinfo=None)
             setattr(user, field, dt)
 
+    store_raw_payload(user, user_data)
+
     # update replication timestamp
     replicated_dt_field = "last_replicated_via_{}_at".format(via)
     if hasattr(user, replicated_dt_field):
@@ -0,0 +1,262 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+from fnmatch import fnmatch
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+
+
+class SamplingProfiler(object):
+    """
+    A low-overhead statistical profiler. While a thread is being profiled,
+    a background thread periodically looks at that thread's call stack and
+    counts how often each stack is seen. The results are written out in the
+    "collapsed stack" format used by `FlameGraph`_ and `speedscope`_, one file
+    per label (usually a Celery task name or a Flask endpoint) per process.
+
+    Profiling only happens when the profiler is enabled, either permanently
+    with the ``PROFILER_ENABLED`` config variable, or temporarily by calling
+    :meth:`enable` with a number of seconds. When nothing is being profiled,
+    the sampling thread sleeps and costs nothing.
+
+    Temporary enabling is recorded in a control file in the output directory,
+    so that it reaches every process on the machine: Celery's prefork pool
+    children and gunicorn's workers all check that file (at most once a
+    second) rather than relying on in-process state.
+
+    .. _FlameGraph: https://github.com/brendangregg/FlameGraph
+    .. _speedscope: https://www.speedscope.app/
+    """
+    def __init__(self, app=None):
+        self.interval = 0.01
+        self.output_dir = None
+        self.dump_interval = 60
+        self.always = False
+        self.match = "*"
+        self.default_match = "*"
+        self.enabled_until = None
+        self._control_checked_at = 0
+        self.samples = defaultdict(Counter)
+        self.last_dump_at = time.time()
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.interval = app.config.get("PROFILER_INTERVAL", self.interval)
+        self.output_dir = app.config.get("PROFILER_OUTPUT_DIR", self.output_dir)
+        self.dump_interval = app.config.get("PROFILER_DUMP_INTERVAL", self.dump_interval)
+        self.always = app.config.get("PROFILER_ENABLED", self.always)
+        self.match = app.config.get("PROFILER_MATCH", self.match)
+        self.default_match = self.match
+
+        @app.before_request
+        def start_request_profile():
+            from flask import request
+            self.start("request:{endpoint}".format(endpoint=request.endpoint))
+
+        @app.teardown_request
+        def stop_request_profile(exception=None):
+            self.stop()
+
+    @property
+    def control_file(self):
+        if not self.output_dir:
+            return None
+        return os.path.join(self.output_dir, "profiler.control")
+
+    @property
+    def enabled(self):
+        if self.always:
+            return True
+        now = time.time()
+        if now - self._control_checked_at > 1:
+            self._control_checked_at = now
+            self._read_control_file()
+        if self.enabled_until and now >= self.enabled_until:
+            self._end_session()
+        return bool(self.enabled_until)
+
+    def _end_session(self):
+        """
+        A timed session has expired, or was disabled by another process:
+        write out what it collected, and stop applying its ``match``.
+        """
+        self.enabled_until = None
+        self.match = self.default_match
+        self.dump()
+
+    def _read_control_file(self):
+        path = self.control_file
+        if not path:
+            return
+        if not os.path.exists(path):
+            if self.enabled_until:
+                self._end_session()
+            return
+        try:
+            with open(path) as f:
+                control = json.load(f)
+        except (IOError, ValueError):
+            return
+        self.enabled_until = control.get("until")
+        self.match = control.get("match") or self.match
+        self.interval = control.get("interval") or self.interval
+
+    def enable(self, seconds=60, match=None, interval=None):
+        """
+        Turn on profiling for the next ``seconds`` seconds. If ``match`` is
+        given, only labels matching that shell-style pattern are profiled.
+        """
+        self.enabled_until = time.time() + float(seconds)
+        self.match = match or self.default_match
+        if interval:
+            self.interval = float(interval)
+        path = self.control_file
+        if path:
+            if not os.path.isdir(self.output_dir):
+                os.makedirs(self.output_dir)
+            with open(path, "w") as f:
+                json.dump({
+                    "until": self.enabled_until,
+                    "match": self.match,
+                    "interval": self.interval,
+                }, f)
+        return self.enabled_until
+
+    def disable(self):
+        self.enabled_until = None
+        self.always = False
+        self.match = self.default_match
+        path = self.control_file
+        if path and os.path.exists(path):
+            os.remove(path)
+        return self.dump()
+
+    def should_profile(self, label):
+        return self.enabled and fnmatch(label, self.match or "*")
+
+    def start(self, label):
+        """
+        Start sampling the current thread under the given label. Returns
+        ``True`` if sampling was started, or ``False`` if this label shouldn't
+        be profiled right now or the thread is already being profiled.
+        """
+        if not self.should_profile(label):
+            return False
+        ident = threading.current_thread().ident
+        with self._lock:
+            if ident in self._active:
+                # nested task call: the outermost label wins
+                return False
+            self._active[ident] = label
+        self._ensure_sampler()
+        self._wakeup.set()
+        return True
+
+    def stop(self):
+        ident = threading.current_thread().ident
+        with self._lock:
+            label = self._active.pop(ident, None)
+        if label and (
+            not self.enabled or
+            time.time() - self.last_dump_at > self.dump_interval
+        ):
+            self.dump()
+        return label
+
+    @contextmanager
+    def profile(self, label):
+        started = self.start(label)
+        try:
+            yield
+        finally:
+            if started:
+                self.stop()
+
+    def _ensure_sampler(self):
+        # After a fork (Celery's prefork pool, gunicorn workers), the sampler
+        # thread from the parent process doesn't exist anymore.
+        pid = os.getpid()
+        if self._thread and self._thread.is_alive() and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == pid:
+                return
+            self._pid = pid
+            self._thread = threading.Thread(
+                target=self._run, name="webhookdb-profiler",
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            if not self._active:
+                self._wakeup.wait()
+                self._wakeup.clear()
+            time.sleep(self.interval)
+            self.sample()
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self._lock:
+            active = list(self._active.items())
+            for ident, label in active:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.samples[label][collapse_stack(frame)] += 1
+
+    def dump(self, output_dir=None):
+        """
+        Append all collected samples to collapsed-stack files, and clear
+        the in-memory samples. Returns the list of files written.
+        """
+        output_dir = output_dir or self.output_dir
+        with self._lock:
+            samples, self.samples = self.samples, defaultdict(Counter)
+            self.last_dump_at = time.time()
+        if not output_dir:
+            return []
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        written = []
+        for label, stacks in samples.items():
+            filename = "{label}.{pid}.collapsed".format(
+                label=re.sub(r"[^\w.-]+", "_", label), pid=os.getpid(),
+            )
+            path = os.path.join(output_dir, filename)
+            with open(path, "a") as f:
+                for stack, count in stacks.items():
+                    f.write("{stack} {count}\n".format(
+                        stack=stack, count=count,
+                    ).encode("utf-8"))
+            written.append(path)
+        return written
+
+
+def collapse_stack(frame):
+    """
+    Render a frame and its callers as a single semicolon-separated line,
+    outermost frame first.
+    """
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append("{func} ({file}:{line})".format(
+            func=code.co_name,
+            file=os.path.basename(code.co_filename),
+            line=code.co_firstlineno,
+        ))
+        frame = frame.f_back
+    return ";".join(reversed(parts))
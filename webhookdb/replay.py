@@ -0,0 +1,134 @@
+# coding=utf-8
+"""
+Rebuilding or catching up the database from the webhook event log (see
+:class:`~webhookdb.models.WebhookEvent`), without calling Github's API.
+
+Each repository's events are replayed in the order they were received,
+and different repositories are replayed in parallel, in separate
+processes. Every event is processed as if it had been fetched when it was
+received, so an object that appears in several repositories' events (like
+a user) ends up with the newest data no matter which process gets to it
+first: older data is rejected as stale, just like a late webhook. Events
+are processed by the same code as the webhook endpoints, except that
+nothing is fetched from Github. Counters are only adjusted for events that
+weren't processed before, as for redeliveries. When two processes insert
+the same new object at once, the one that loses processes its event again.
+"""
+from __future__ import unicode_literals, print_function
+
+from datetime import datetime
+from collections import Counter
+from multiprocessing import Pool
+from webhookdb import db
+from webhookdb.models import WebhookEvent
+from webhookdb.process import process_event
+from webhookdb.process.event import handles_event
+from webhookdb.process.save import resolve_conflicts
+from webhookdb.exceptions import WebhookDBException, StaleData
+
+
+def events_query(owner=None, repo=None, since=None):
+    query = WebhookEvent.query
+    if owner and repo:
+        query = query.filter(WebhookEvent.repo_full_name == "{owner}/{repo}".format(
+            owner=owner, repo=repo,
+        ))
+    elif owner:
+        query = query.filter(WebhookEvent.repo_full_name.like("{owner}/%".format(
+            owner=owner,
+        )))
+    if since:
+        query = query.filter(WebhookEvent.received_at >= since)
+    return query
+
+
+def replay_events(query, batch_size=500):
+    """
+    Process the events that ``query`` selects, in the order they were
+    received. Returns a :class:`~collections.Counter` of what happened to them.
+    """
+    counts = Counter()
+    last_id = 0
+    while True:
+        batch = (
+            query.filter(WebhookEvent.id > last_id)
+            .order_by(WebhookEvent.id).limit(batch_size).all()
+        )
+        if not batch:
+            break
+        for logged in batch:
+            last_id = logged.id
+            if not handles_event(logged.event):
+                counts["ignored"] += 1
+                continue
+            try:
+                stale = resolve_conflicts(replay_event, logged)
+            except WebhookDBException:
+                db.session.rollback()
+                counts["failed"] += 1
+            else:
+                counts["stale" if stale else "processed"] += 1
+        db.session.expunge_all()
+    return counts
+
+
+def replay_event(logged, commit=True):
+    """
+    Process one logged event, and note that it was processed in the same
+    transaction, so counters are only adjusted once. Returns True if the
+    event was stale.
+    """
+    try:
+        process_event(
+            logged.event, logged.payload_json,
+            fetched_at=logged.received_at, commit=False,
+            redelivery=logged.processed_at is not None,
+        )
+    except StaleData:
+        stale = True
+    else:
+        stale = False
+    logged.processed_at = logged.processed_at or datetime.now()
+    if commit:
+        db.session.commit()
+    return stale
+
+
+def replay_repository(args):
+    "Replay one repository's events. Runs in a worker process."
+    repo_id, filters = args
+    try:
+        query = events_query(**filters).filter(WebhookEvent.repo_id == repo_id)
+        return repo_id, replay_events(query)
+    finally:
+        db.session.remove()
+
+
+def replay(owner=None, repo=None, since=None, processes=4):
+    """
+    Replay the event log, optionally only for one owner's repositories, or
+    one repository, or events received ``since`` a certain time. Must run in
+    an app context. Yields ``(repo_id, counts)`` for each repository as it
+    finishes; events that don't belong to a repository come last.
+    """
+    filters = {"owner": owner, "repo": repo, "since": since}
+    repo_ids = [
+        repo_id for (repo_id,) in
+        events_query(**filters).with_entities(WebhookEvent.repo_id).distinct()
+        if repo_id is not None
+    ]
+    # don't let the worker processes share our database connections
+    db.session.remove()
+    db.engine.dispose()
+    pool = Pool(processes)
+    try:
+        jobs = [(repo_id, filters) for repo_id in repo_ids]
+        for result in pool.imap_unordered(replay_repository, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+    if not (owner or repo):
+        query = events_query(**filters).filter(WebhookEvent.repo_id == None)
+        yield None, replay_events(query)
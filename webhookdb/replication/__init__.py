@@ -1,13 +1,19 @@
 # coding=utf-8
 from __future__ import unicode_literals, print_function
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app, g
+from webhookdb.process import log_event
+from webhookdb.process.event import delivery_processed, mark_processed
 
 replication = Blueprint('replication', __name__)
 
 from .repository import repository
 from .pull_request import pull_request
 from .issue import issue
+from .label import label
+from .milestone import milestone
+from .member import member, team_add
+from .comment import issue_comment, pull_request_review_comment
 
 @replication.route('', methods=["POST"])
 def main():
@@ -21,6 +27,18 @@ def main():
         return pull_request()
     elif event == "repository":
         return repository()
+    elif event == "label":
+        return label()
+    elif event == "milestone":
+        return milestone()
+    elif event == "member":
+        return member()
+    elif event == "team_add":
+        return team_add()
+    elif event == "issue_comment":
+        return issue_comment()
+    elif event == "pull_request_review_comment":
+        return pull_request_review_comment()
     else:
         return jsonify({"error": "unhandled event", "event": event}), 400
 
@@ -41,3 +59,31 @@ def payload():
     """
     if not request.get_json():
         return jsonify({"error": "no payload"}), 400
+
+@replication.before_request
+def event_log():
+    """
+    Keep every delivery, so that the database can be rebuilt from them.
+    See :mod:`webhookdb.replay`. Deliveries that are already in the log, and
+    were processed without an error, are marked as redeliveries, so that
+    endpoints that adjust counters don't count them twice.
+    """
+    event = request.headers.get("X-Github-Event", "").lower()
+    logged = log_event(event, request.headers, request.get_json())
+    delivery_id = request.headers.get("X-Github-Delivery")
+    g.redelivery = False
+    if current_app.config.get("EVENT_LOG_ENABLED") and delivery_id:
+        g.logged_delivery_id = delivery_id
+        g.redelivery = logged is None and delivery_processed(delivery_id)
+
+
+@replication.after_request
+def event_processed(response):
+    """
+    Mark a logged delivery as processed, once an endpoint has handled it
+    without an error.
+    """
+    delivery_id = g.get("logged_delivery_id")
+    if delivery_id and response.status_code < 400:
+        mark_processed(delivery_id)
+    return response
@@ -0,0 +1,48 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from flask import request, jsonify, g
+import bugsnag
+from . import replication
+from webhookdb.process.event import (
+    process_issue_comment_event, process_review_comment_event
+)
+from webhookdb.exceptions import MissingData, StaleData
+
+
+@replication.route('/issue_comment', methods=["POST"])
+def issue_comment():
+    """
+    Webhook endpoint for ``issue_comment`` events on Github. The payload
+    has the whole issue, including its comment count, so there's nothing
+    to fetch.
+    """
+    payload = request.get_json()
+    bugsnag.configure_request(meta_data={"payload": payload})
+
+    try:
+        process_issue_comment_event(payload)
+    except MissingData as err:
+        return jsonify({"error": err.message, "obj": err.obj}), 400
+    except StaleData:
+        return jsonify({"message": "stale data"})
+
+    return jsonify({"message": "success"})
+
+
+@replication.route('/pull_request_review_comment', methods=["POST"])
+def pull_request_review_comment():
+    """
+    Webhook endpoint for ``pull_request_review_comment`` events on Github.
+    The pull request in the payload doesn't include its review comment
+    count, so the count is adjusted instead.
+    """
+    payload = request.get_json()
+    bugsnag.configure_request(meta_data={"payload": payload})
+
+    try:
+        process_review_comment_event(payload, redelivery=g.get("redelivery"))
+    except MissingData as err:
+        return jsonify({"error": err.message, "obj": err.obj}), 400
+
+    return jsonify({"message": "success"})
@@ -22,8 +22,9 @@ def issue():
         resp.status_code = 400
         return resp
 
+    repo_data = payload.get("repository") or {}
     try:
-        issue = process_issue(issue_data)
+        issue = process_issue(issue_data, repo_id=repo_data.get("id"))
     except MissingData as err:
         return jsonify({"error": err.message, "obj": err.obj}), 400
     except StaleData:
@@ -0,0 +1,84 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from flask import request, jsonify, url_for
+import bugsnag
+from . import replication
+from webhookdb.process import process_repository
+from webhookdb.process.event import process_member_event
+from webhookdb.tasks.repository import (
+    sync_team_repository_permissions, sync_user_repository_permissions
+)
+from webhookdb.exceptions import MissingData, StaleData
+
+
+@replication.route('/member', methods=["POST"])
+def member():
+    """
+    Webhook endpoint for ``member`` events on Github: collaborators being
+    added to or removed from a repository, or their permissions changing.
+    A removed collaborator may still have access another way, so their
+    permissions are fetched again in a task.
+    """
+    payload = request.get_json()
+    bugsnag.configure_request(meta_data={"payload": payload})
+
+    removed = payload.get("action") == "removed"
+    repo_data = payload.get("repository") or {}
+    owner_data = repo_data.get("owner") or {}
+    if removed and not (repo_data.get("name") and owner_data.get("login")):
+        resp = jsonify({"error": "no repository name in payload"})
+        resp.status_code = 400
+        return resp
+
+    try:
+        process_member_event(payload)
+    except MissingData as err:
+        return jsonify({"error": err.message, "obj": err.obj}), 400
+
+    if not removed:
+        return jsonify({"message": "success"})
+
+    result = sync_user_repository_permissions.delay(
+        owner_data["login"], repo_data["name"], payload["member"]["login"],
+    )
+    resp = jsonify({"message": "queued"})
+    resp.status_code = 202
+    resp.headers["Location"] = url_for("tasks.status", task_id=result.id)
+    return resp
+
+
+@replication.route('/team_add', methods=["POST"])
+def team_add():
+    """
+    Webhook endpoint for ``team_add`` events on Github: a team being given
+    access to a repository. The payload doesn't say who is on the team, so
+    the team's members are fetched in a task.
+    """
+    payload = request.get_json()
+    bugsnag.configure_request(meta_data={"payload": payload})
+
+    team_data = payload.get("team")
+    repo_data = payload.get("repository") or {}
+    owner_data = repo_data.get("owner") or {}
+    if not team_data or not repo_data.get("name") or not owner_data.get("login"):
+        resp = jsonify({"error": "no team or repository in payload"})
+        resp.status_code = 400
+        return resp
+
+    # the task needs the repository to be loaded
+    try:
+        process_repository(repo_data)
+    except MissingData as err:
+        return jsonify({"error": err.message, "obj": err.obj}), 400
+    except StaleData:
+        pass
+
+    result = sync_team_repository_permissions.delay(
+        team_data["id"], owner_data["login"], repo_data["name"],
+        team_data.get("permission"),
+    )
+    resp = jsonify({"message": "queued"})
+    resp.status_code = 202
+    resp.headers["Location"] = url_for("tasks.status", task_id=result.id)
+    return resp
@@ -0,0 +1,26 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+from flask import request, jsonify
+import bugsnag
+from . import replication
+from webhookdb.process.event import process_milestone_event
+from webhookdb.exceptions import MissingData, StaleData
+
+
+@replication.route('/milestone', methods=["POST"])
+def milestone():
+    """
+    Webhook endpoint for ``milestone`` events on Github.
+    """
+    payload = request.get_json()
+    bugsnag.configure_request(meta_data={"payload": payload})
+
+    try:
+        process_milestone_event(payload)
+    except MissingData as err:
+        return jsonify({"error": err.message, "obj": err.obj}), 400
+    except StaleData:
+        return jsonify({"message": "stale data"})
+
+    return jsonify({"message": "success"})
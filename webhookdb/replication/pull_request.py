@@ -1,15 +1,14 @@
 # coding=utf-8
 from __future__ import unicode_literals, print_function
 
-from flask import request, jsonify
+from flask import request, jsonify, current_app
 import bugsnag
 from . import replication
-from webhookdb.models import PullRequestFile
+from webhookdb.models import PullRequest
 from webhookdb.exceptions import MissingData, StaleData
 from webhookdb.tasks.pull_request import process_pull_request
-from webhookdb.tasks.pull_request_file import (
-    sync_page_of_pull_request_files, spawn_page_tasks_for_pull_request_files
-)
+from webhookdb.tasks.pull_request_file import sync_pull_request_files_for_head
+from webhookdb.tasks.routing import WEBHOOK_QUEUE
 
 
 @replication.route('/pull_request', methods=["POST"])
@@ -26,6 +25,11 @@ def pull_request():
         resp.status_code = 400
         return resp
 
+    # most pull request events (labels, assignees, edits) can't change the
+    # diff, so we only rescan the files when the head commit changes
+    prev_pr = PullRequest.query.get(pr_data["id"]) if pr_data.get("id") else None
+    prev_head_sha = prev_pr.head_sha if prev_pr else None
+
     try:
         pr = process_pull_request(pr_data)
     except MissingData as err:
@@ -33,18 +37,11 @@ def pull_request():
     except StaleData:
         return jsonify({"message": "stale data"})
 
-    # Fetch the pull request files, too!
-    if pr.changed_files < 100:
-        # If there are fewer than 100, do it inline
-        PullRequestFile.query.filter_by(pull_request_id=pr.id).delete()
-        sync_page_of_pull_request_files(
-            owner=pr.base_repo.owner_login, repo=pr.base_repo.name,
-            number=pr.number, pull_request_id=pr.id,
-        )
-    else:
-        # otherwise, spawn tasks
-        spawn_page_tasks_for_pull_request_files.delay(
-            pr.base_repo.owner_login, pr.base_repo.name, pr.number
+    if pr.head_sha and pr.head_sha != prev_head_sha:
+        sync_pull_request_files_for_head.apply_async(
+            (pr.base_repo.owner_login, pr.base_repo.name, pr.number, pr.head_sha),
+            countdown=current_app.config.get("PULL_REQUEST_FILES_DEBOUNCE_SECONDS", 30),
+            queue=WEBHOOK_QUEUE,
         )
 
     return jsonify({"message": "success"})
@@ -0,0 +1,285 @@
+# coding=utf-8
+"""
+Serializing lots of objects at once. Each object's ``github_json`` includes
+the objects it refers to (users, repositories, milestones and labels), and
+loading those one at a time as relationships are accessed takes a dozen
+queries per object. Instead, :func:`iter_github_json` loads objects in
+batches, loads everything that each batch refers to with one query per kind
+of object, and then serializes the batch without any more queries.
+Each batch is removed from the database session once it's serialized,
+so memory use doesn't grow with the number of objects.
+"""
+from __future__ import unicode_literals, print_function
+
+import json
+from datetime import datetime, date
+from flask import current_app
+from sqlalchemy import inspect, and_, or_
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm.attributes import set_committed_value
+from webhookdb import db
+from webhookdb.models import (
+    User, Repository, Milestone, PullRequest, PullRequestFile, PullRequestPatch,
+    IssueLabel, Issue
+)
+from webhookdb.models.github import RawPayloadMixin, label_association_table
+
+# model -> (relationship, foreign key attribute) for each many-to-one
+# relationship that github_json follows
+USER_RELATIONSHIPS = {
+    Repository: (("owner", "owner_id"), ("organization", "organization_id")),
+    Milestone: (("creator", "creator_id"),),
+    PullRequest: (
+        ("user", "user_id"), ("assignee", "assignee_id"),
+        ("merged_by", "merged_by_id"),
+    ),
+    Issue: (
+        ("user", "user_id"), ("assignee", "assignee_id"),
+        ("closed_by", "closed_by_id"),
+    ),
+}
+REPO_RELATIONSHIPS = {
+    Milestone: (("repo", "repo_id"),),
+    PullRequest: (("base_repo", "base_repo_id"), ("head_repo", "head_repo_id")),
+    IssueLabel: (("repo", "repo_id"),),
+    Issue: (("repo", "repo_id"),),
+}
+# model -> (relationship, repository ID attribute, milestone number attribute)
+MILESTONE_RELATIONSHIPS = {
+    PullRequest: ("milestone", "head_repo_id", "milestone_number"),
+    Issue: ("milestone", "repo_id", "milestone_number"),
+}
+# how many IDs to put in a single IN clause
+IN_CHUNK_SIZE = 500
+
+
+class GithubJSONEncoder(json.JSONEncoder):
+    "Serializes dates the way Github does."
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.strftime("%Y-%m-%dT%H:%M:%SZ")
+        if isinstance(obj, date):
+            return obj.isoformat()
+        return super(GithubJSONEncoder, self).default(obj)
+
+
+def with_raw_payload(query, model):
+    if issubclass(model, RawPayloadMixin):
+        return query.options(undefer(model.raw_payload))
+    return query
+
+
+def load_by_id(model, ids, column=None):
+    """
+    Load these objects by ID (or by another unique ``column``),
+    and return a dict of them by ID.
+    """
+    column = column or model.id
+    ids = sorted(id for id in set(ids) if id is not None)
+    loaded = {}
+    for start in xrange(0, len(ids), IN_CHUNK_SIZE):
+        chunk = ids[start:start + IN_CHUNK_SIZE]
+        query = with_raw_payload(model.query, model).filter(column.in_(chunk))
+        loaded.update((getattr(obj, column.key), obj) for obj in query)
+    return loaded
+
+
+def link(objects, relationships, targets):
+    "Fill in many-to-one relationships from a dict of targets by ID."
+    for obj in objects:
+        for relationship, fk in relationships:
+            set_committed_value(obj, relationship, targets.get(getattr(obj, fk)))
+
+
+def load_milestones(objects, relationship, repo_attr, number_attr):
+    repo_ids = {getattr(obj, repo_attr) for obj in objects}
+    numbers = {getattr(obj, number_attr) for obj in objects}
+    numbers.discard(None)
+    milestones = {}
+    if numbers:
+        query = (
+            with_raw_payload(Milestone.query, Milestone)
+            .filter(Milestone.repo_id.in_(repo_ids))
+            .filter(Milestone.number.in_(numbers))
+        )
+        milestones = {(m.repo_id, m.number): m for m in query}
+    for obj in objects:
+        key = (getattr(obj, repo_attr), getattr(obj, number_attr))
+        set_committed_value(obj, relationship, milestones.get(key))
+    return milestones.values()
+
+
+def load_labels(issues):
+    names_by_issue = {}
+    query = (
+        db.session.query(
+            label_association_table.c.issue_id,
+            label_association_table.c.label_name,
+        )
+        .filter(label_association_table.c.issue_id.in_([i.id for i in issues]))
+    )
+    for issue_id, name in query:
+        names_by_issue.setdefault(issue_id, []).append(name)
+    names = {name for names in names_by_issue.values() for name in names}
+    labels = {}
+    if names:
+        query = (
+            with_raw_payload(IssueLabel.query, IssueLabel)
+            .filter(IssueLabel.repo_id.in_({i.repo_id for i in issues}))
+            .filter(IssueLabel.name.in_(names))
+        )
+        labels = {(label.repo_id, label.name): label for label in query}
+    for issue in issues:
+        set_committed_value(issue, "labels", [
+            labels[(issue.repo_id, name)]
+            for name in names_by_issue.get(issue.id, [])
+            if (issue.repo_id, name) in labels
+        ])
+    return labels.values()
+
+
+def preload(objects):
+    """
+    Load everything that the ``github_json`` of these objects (which must
+    all be of the same model) refers to, using a fixed number of queries.
+    Returns the objects that were loaded: keep a reference to them until
+    you're done serializing, because the session only holds weak references.
+    """
+    objects = list(objects)
+    if not objects:
+        return []
+    model = type(objects[0])
+    loaded = []
+
+    milestones = []
+    if model in MILESTONE_RELATIONSHIPS:
+        milestones = load_milestones(objects, *MILESTONE_RELATIONSHIPS[model])
+        loaded.extend(milestones)
+    labels = []
+    if model is Issue:
+        labels = load_labels(objects)
+        loaded.extend(labels)
+    pull_requests = {}
+    if model is PullRequestFile:
+        pull_requests = load_by_id(
+            PullRequest, [prf.pull_request_id for prf in objects],
+        )
+        link(objects, (("pull_request", "pull_request_id"),), pull_requests)
+        patches = load_by_id(
+            PullRequestPatch, [prf.patch_hash for prf in objects],
+            column=PullRequestPatch.hash,
+        )
+        link(objects, (("patch_blob", "patch_hash"),), patches)
+        loaded.extend(pull_requests.values())
+        loaded.extend(patches.values())
+
+    with_repos = (
+        objects + list(milestones) + list(labels) + list(pull_requests.values())
+    )
+    repo_ids = [
+        getattr(obj, fk)
+        for obj in with_repos
+        for _, fk in REPO_RELATIONSHIPS.get(type(obj), ())
+    ]
+    repos = load_by_id(Repository, repo_ids)
+    loaded.extend(repos.values())
+    for kind in set((model, Milestone, IssueLabel, PullRequest)):
+        link(
+            [obj for obj in with_repos if type(obj) is kind],
+            REPO_RELATIONSHIPS.get(kind, ()), repos,
+        )
+
+    with_users = objects + list(repos.values()) + list(milestones)
+    user_ids = [
+        getattr(obj, fk)
+        for obj in with_users
+        for _, fk in USER_RELATIONSHIPS.get(type(obj), ())
+    ]
+    users = load_by_id(User, user_ids)
+    loaded.extend(users.values())
+    for kind in set(type(obj) for obj in with_users):
+        link(
+            [obj for obj in with_users if type(obj) is kind],
+            USER_RELATIONSHIPS.get(kind, ()), users,
+        )
+    return loaded
+
+
+def key_columns(model):
+    "The attributes of a model's primary key."
+    return [getattr(model, column.key) for column in inspect(model).primary_key]
+
+
+def after_key(key, after):
+    "A filter for rows whose ``key`` columns sort after the ``after`` values."
+    clauses = []
+    for index, column in enumerate(key):
+        equal = [key[prev] == after[prev] for prev in range(index)]
+        clauses.append(and_(*(equal + [column > after[index]])))
+    return or_(*clauses)
+
+
+def iter_batches(query, batch_size, key=None, after=None):
+    """
+    Run the query in batches, and yield each batch as a list. The query is
+    paged through by ``key`` (a list of columns that are unique within the
+    query, and preferably indexed -- by default, the primary key), starting
+    after the ``after`` values of those columns, if given.
+    """
+    model = query.column_descriptions[0]["entity"]
+    query = with_raw_payload(query, model)
+    key = key or key_columns(model)
+    while True:
+        batch_query = query.order_by(None).order_by(*key)
+        if after is not None:
+            batch_query = batch_query.filter(after_key(key, after))
+        batch = batch_query.limit(batch_size).all()
+        if not batch:
+            return
+        yield batch
+        after = tuple(getattr(batch[-1], column.key) for column in key)
+
+
+def release(objects, keep):
+    "Remove these objects from the session, unless their identity is in keep."
+    for obj in objects:
+        state = inspect(obj)
+        if state.key not in keep and obj in db.session:
+            db.session.expunge(obj)
+
+
+def iter_keyed_github_json(query, batch_size=None, key=None, after=None):
+    """
+    Like :func:`iter_github_json`, but yield a tuple of each object's
+    ``key`` values along with its ``github_json``, so that a later call
+    can start after it.
+    """
+    batch_size = batch_size or current_app.config.get("SERIALIZE_BATCH_SIZE", 500)
+    model = query.column_descriptions[0]["entity"]
+    key = key or key_columns(model)
+    # objects that were already in the session stay there
+    keep = set(db.session.identity_map.keys())
+    for batch in iter_batches(query, batch_size, key=key, after=after):
+        loaded = preload(batch)
+        for obj in batch:
+            obj_key = tuple(getattr(obj, column.key) for column in key)
+            yield obj_key, obj.github_json
+        release(batch + loaded, keep)
+
+
+def iter_github_json(query, batch_size=None):
+    """
+    Yield the ``github_json`` of each object that the query returns, using
+    a fixed number of queries per batch of ``SERIALIZE_BATCH_SIZE`` objects.
+    """
+    for _, serialized in iter_keyed_github_json(query, batch_size=batch_size):
+        yield serialized
+
+
+def iter_github_json_by_id(model, ids, batch_size=None):
+    "Like :func:`iter_github_json`, for a list of IDs."
+    ids = list(ids)
+    for start in xrange(0, len(ids), IN_CHUNK_SIZE):
+        query = model.query.filter(model.id.in_(ids[start:start + IN_CHUNK_SIZE]))
+        for serialized in iter_github_json(query, batch_size=batch_size):
+            yield serialized
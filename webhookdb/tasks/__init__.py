@@ -2,10 +2,11 @@
 from __future__ import unicode_literals, print_function
 
 import logging
-from webhookdb import celery
+from webhookdb import celery, profiler
 from webhookdb.oauth import github_bp
 from celery.utils.log import get_task_logger
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request, current_app
+from flask_login import current_user
 
 # set up logging
 logger = get_task_logger(__name__)
@@ -22,3 +23,46 @@ def status(task_id):
 # Working in a Celery task means we can't take advantage of Flask-Dance's
 # session proxies, so we'll explicitly define the Github session here.
 github = github_bp.session
+
+
+@tasks.route('/profiler', methods=["POST"])
+def profiler_control():
+    """
+    Turn the sampling profiler on or off, for this web process and for
+    every Celery worker. Only users listed in the ``PROFILER_ADMINS``
+    config variable may do this.
+
+    :query action: ``enable`` or ``disable``. Defaults to ``enable``.
+    :query seconds: how long to profile for. Defaults to 60.
+    :query match: only profile Celery tasks or Flask endpoints whose name
+      matches this shell-style pattern, such as ``*sync_page_of_issues``
+      or ``request:load.*``. Defaults to everything.
+    :statuscode 200: profiler state changed
+    :statuscode 400: invalid action or number of seconds
+    :statuscode 403: you are not allowed to control the profiler
+    """
+    admins = current_app.config.get("PROFILER_ADMINS", [])
+    if current_user.is_anonymous() or current_user.login not in admins:
+        return jsonify({"error": "forbidden"}), 403
+
+    action = request.values.get("action", "enable")
+    if action not in ("enable", "disable"):
+        return jsonify({"error": "unknown action", "action": action}), 400
+    try:
+        seconds = int(request.values.get("seconds", 60))
+    except ValueError:
+        return jsonify({"error": "seconds must be a whole number"}), 400
+    arguments = {
+        "action": action,
+        "seconds": seconds,
+        "match": request.values.get("match"),
+    }
+    if action == "enable":
+        profiler.enable(seconds=arguments["seconds"], match=arguments["match"])
+    else:
+        profiler.disable()
+    celery.control.broadcast("profiler_control", arguments=arguments)
+    return jsonify({"message": "profiler {action}d".format(action=action)})
+
+# register remote control commands for Celery workers
+from . import control
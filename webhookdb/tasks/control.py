@@ -0,0 +1,34 @@
+# coding=utf-8
+"""
+Remote control commands for Celery workers. These run in the main worker
+process, and can be sent with ``celery.control.broadcast()``.
+"""
+from __future__ import unicode_literals, print_function
+
+from celery.worker.control import Panel
+from webhookdb import profiler, metrics
+
+
+@Panel.register
+def profiler_control(state, action="enable", seconds=60, match=None,
+                     interval=None):
+    if action == "enable":
+        until = profiler.enable(seconds=seconds, match=match, interval=interval)
+        return {"ok": "profiling until {until}".format(until=until)}
+    elif action == "disable":
+        profiler.disable()
+        return {"ok": "profiling disabled"}
+    return {"error": "unknown action {action}".format(action=action)}
+
+
+@Panel.register
+def metrics_report(state, reset=False):
+    """
+    Report the counters in :mod:`webhookdb.metrics` for this worker's main
+    process. With the prefork pool, tasks run in child processes, which log
+    their own counters instead.
+    """
+    data = metrics.snapshot()
+    if reset:
+        metrics.reset()
+    return data
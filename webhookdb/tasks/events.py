@@ -0,0 +1,216 @@
+# coding=utf-8
+"""
+Keeping repositories without our webhook fresh by polling their events.
+
+Only a repository's admins can install webhooks, so for everything else
+WebhookDB used to depend on :mod:`webhookdb.tasks.resync` rescanning whole
+collections. Instead, :func:`poll_unhooked_repositories` regularly polls the
+events API (``/repos/{owner}/{repo}/events``) of every repository that has
+been loaded but doesn't have our webhook. Polls send the ETag of the
+previous response, so they cost nothing when nothing has happened, and
+each repository is polled no more often than Github's ``X-Poll-Interval``
+header asks.
+
+Issue, pull request and repository events carry the whole object, so they go
+straight to :func:`~webhookdb.process.process_event`. Other events that
+change an issue or pull request (like comments and reviews), and events
+whose payload can't be processed, fall back to syncing just the objects they
+mention. If more events have happened since the last poll than the events
+API keeps, the repository's issues and pull requests are rescanned.
+"""
+from __future__ import unicode_literals, print_function
+
+from datetime import datetime, timedelta
+from collections import Counter
+from flask import current_app
+from iso8601 import parse_date
+from sqlalchemy import or_
+from webhookdb import db
+from webhookdb.models import Repository
+from webhookdb.process import process_event
+from webhookdb.archive import EVENT_TYPES
+from webhookdb.exceptions import WebhookDBException, StaleData, NotFound
+from webhookdb.tasks import celery, logger
+from webhookdb.tasks.fetch import fetch_url_from_github
+from webhookdb.tasks.issue import sync_issue, spawn_page_tasks_for_issues
+from webhookdb.tasks.pull_request import (
+    sync_pull_request, spawn_page_tasks_for_pull_requests
+)
+from webhookdb.tasks.resync import hooked_repo_ids, requestors_by_repo
+from webhookdb.tasks.routing import WEBHOOK_QUEUE
+from webhookdb.tasks.scheduler import enqueue
+
+# events that change an issue or pull request without carrying all of it:
+# event type -> (payload key, sync task)
+MENTION_EVENTS = {
+    "IssueCommentEvent": ("issue", sync_issue),
+    "PullRequestReviewEvent": ("pull_request", sync_pull_request),
+    "PullRequestReviewCommentEvent": ("pull_request", sync_pull_request),
+}
+# if processing one of these fails, sync the object instead
+FALLBACK_SYNC = {
+    "IssuesEvent": ("issue", sync_issue),
+    "PullRequestEvent": ("pull_request", sync_pull_request),
+}
+
+
+def fetch_new_events(owner, repo, requestor_id=None):
+    """
+    Fetch the repository's events since the last poll, newest first.
+    Returns the list of events (or None if nothing has changed), whether we
+    reached the last event we saw before, and the ETag of the events list.
+    """
+    url = "/repos/{owner}/{repo}/events?per_page=100".format(
+        owner=owner, repo=repo.name,
+    )
+    headers = {}
+    if repo.events_etag:
+        headers["If-None-Match"] = repo.events_etag
+    resp = fetch_url_from_github(url, requestor_id=requestor_id, headers=headers)
+    repo.events_last_polled_at = datetime.now()
+    try:
+        repo.events_poll_interval = int(resp.headers["X-Poll-Interval"])
+    except (KeyError, ValueError):
+        pass
+    if resp.status_code == 304:
+        return None, True, repo.events_etag
+    etag = resp.headers.get("ETag")
+
+    events = []
+    while True:
+        for event in resp.json():
+            if repo.events_last_id and int(event["id"]) <= repo.events_last_id:
+                return events, True, etag
+            events.append(event)
+        next_url = resp.links.get("next", {}).get("url")
+        if not next_url:
+            # the first poll has nothing to catch up with
+            return events, not repo.events_last_id, etag
+        resp = fetch_url_from_github(next_url, requestor_id=requestor_id)
+
+
+@celery.task()
+def poll_repository_events(owner, repo, requestor_id=None):
+    """
+    Process a repository's events since the last poll. Returns how many
+    events were processed.
+    """
+    repo_name = repo
+    repo = Repository.get(owner, repo_name)
+    if not repo:
+        raise NotFound("Repo {owner}/{repo} not loaded in webhookdb".format(
+            owner=owner, repo=repo_name,
+        ), {"type": "repo", "owner": owner, "repo": repo_name})
+    prev_polled_at = repo.events_last_polled_at
+    events, caught_up, etag = fetch_new_events(
+        owner, repo, requestor_id=requestor_id,
+    )
+    if not events:
+        repo.events_etag = etag
+        db.session.commit()
+        return 0
+    # The ETag is saved with the last event ID, once the events are processed.
+    # If this task fails before then, the next poll must not get a 304.
+    db.session.commit()
+
+    counts = Counter()
+    mentioned = set()
+    # oldest first, like webhooks
+    for event in reversed(events):
+        event_type = event.get("type")
+        payload = event.get("payload") or {}
+        fetched_at = parse_date(event["created_at"]).replace(tzinfo=None)
+        if event_type in EVENT_TYPES:
+            try:
+                process_event(
+                    EVENT_TYPES[event_type], payload, via="api",
+                    fetched_at=fetched_at, repo_id=repo.id,
+                )
+            except StaleData:
+                counts["stale"] += 1
+                continue
+            except WebhookDBException:
+                db.session.rollback()
+                counts["failed"] += 1
+                if event_type not in FALLBACK_SYNC:
+                    continue
+                key, task = FALLBACK_SYNC[event_type]
+            else:
+                counts["processed"] += 1
+                continue
+        elif event_type in MENTION_EVENTS:
+            key, task = MENTION_EVENTS[event_type]
+        else:
+            counts["ignored"] += 1
+            continue
+        number = (payload.get(key) or {}).get("number")
+        if number:
+            mentioned.add((task, number))
+
+    repo = Repository.get(owner, repo_name)
+    repo.events_last_id = max(int(event["id"]) for event in events)
+    repo.events_etag = etag
+    db.session.commit()
+
+    for task, number in mentioned:
+        task.delay(owner, repo_name, number, requestor_id=requestor_id)
+    counts["synced"] = len(mentioned)
+
+    if not caught_up:
+        # we missed some events, so rescan what they could have changed
+        logger.info("Events for {owner}/{repo} fell behind; rescanning".format(
+            owner=owner, repo=repo_name,
+        ))
+        kwargs = {}
+        if prev_polled_at:
+            overlap = timedelta(
+                seconds=current_app.config.get("RESYNC_SINCE_OVERLAP_SECONDS", 3600)
+            )
+            since = prev_polled_at - overlap
+            kwargs["since"] = since.strftime("%Y-%m-%dT%H:%M:%SZ")
+        enqueue(spawn_page_tasks_for_issues, owner, repo_name,
+                requestor_id=requestor_id, **kwargs)
+        enqueue(spawn_page_tasks_for_pull_requests, owner, repo_name,
+                requestor_id=requestor_id)
+
+    logger.info("Polled events for {owner}/{repo}: {counts}".format(
+        owner=owner, repo=repo_name, counts=dict(counts),
+    ))
+    return counts["processed"]
+
+
+@celery.task()
+def poll_unhooked_repositories():
+    """
+    Queue an events poll for every loaded repository that doesn't have our
+    webhook, and hasn't been polled within its poll interval.
+    """
+    now = datetime.now()
+    min_interval = current_app.config.get("EVENTS_POLL_INTERVAL_SECONDS", 60)
+    hooked = hooked_repo_ids()
+    requestors = requestors_by_repo()
+    if not requestors:
+        return 0
+    repos = (
+        Repository.query.filter(Repository.id.in_(requestors.keys()))
+        .filter(or_(
+            Repository.issues_last_scanned_at != None,
+            Repository.pull_requests_last_scanned_at != None,
+        ))
+    )
+    queued = 0
+    for repo in repos:
+        if repo.id in hooked:
+            continue
+        interval = max(repo.events_poll_interval or 0, min_interval)
+        polled_at = repo.events_last_polled_at
+        if polled_at and (now - polled_at).total_seconds() < interval:
+            continue
+        poll_repository_events.apply_async(
+            (repo.owner_login, repo.name),
+            {"requestor_id": requestors[repo.id]},
+            queue=WEBHOOK_QUEUE,
+        )
+        queued += 1
+    logger.info("Queued {num} event polls".format(num=queued))
+    return queued
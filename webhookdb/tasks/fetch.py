@@ -1,34 +1,115 @@
 # coding=utf-8
 from __future__ import unicode_literals, print_function
 
-from webhookdb.tasks import celery, github, logger
+import time
+from multiprocessing.pool import ThreadPool
+from flask import current_app, g, has_request_context
+from urlobject import URLObject
+from webhookdb import token_cache
+from webhookdb.oauth import token_for
+from webhookdb.tasks import celery, github, logger, token_pool
 from webhookdb.exceptions import NotFound, RateLimited
 from requests.exceptions import RequestException
 
 
-@celery.task(bind=True)
-def fetch_url_from_github(self, url, as_user=None, requestor_id=None, **kwargs):
-    if "method" in kwargs:
-        method = kwargs.pop("method")
-    else:
-        method = "GET"
+class LatencyEstimate(object):
+    """
+    An exponentially-weighted moving average of how long it takes to fetch
+    a page from Github in this process. Used to decide how many pages
+    each "sync page" task should handle.
+    """
+    def __init__(self, weight=0.2):
+        self.weight = weight
+        self.value = None
+
+    def observe(self, seconds):
+        if self.value is None:
+            self.value = seconds
+        else:
+            self.value = self.weight * seconds + (1 - self.weight) * self.value
+        return self.value
+
+
+page_latency = LatencyEstimate()
+
+
+def request_github(url, method="GET", as_user=None, requestor_id=None, **kwargs):
+    """
+    Make a single request to the Github API, as the given user. Raises
+    :exc:`~webhookdb.exceptions.RateLimited` if we're out of API calls.
+    Most callers should use :func:`fetch_url_from_github` instead, which
+    retries when the rate limit resets.
+    """
     if method.upper() == "HEAD":
         kwargs.setdefault("allow_redirects", False)
 
-    username = "anonymous"
+    # The token is chosen per request, so that concurrent requests
+    # as different users (in threads or greenlets) can't interfere.
     if as_user:
-        github.blueprint.config["user"] = as_user
-        username = "@{login}".format(login=as_user.login)
-    elif requestor_id:
-        github.blueprint.config["user_id"] = int(requestor_id)
-        username = "user {}".format(requestor_id)
+        user_id = as_user.id
+    else:
+        user_id = int(requestor_id) if requestor_id else None
+    # public data can be fetched with any pooled token
+    pooled = (
+        not as_user and token_pool.enabled() and token_pool.is_public(url)
+    )
+    attempts = current_app.config.get("TOKEN_POOL_ATTEMPTS", 3) if pooled else 1
+
+    started_at = time.time()
+    for attempt in xrange(attempts):
+        if pooled:
+            user_id = token_pool.choose_user_id(requestor_id)
+        token = token_for(user_id)
+        username = "user {}".format(user_id) if user_id else "anonymous"
+        if as_user:
+            username = "@{login}".format(login=as_user.login)
+        logger.info("{method} {url} as {username}".format(
+            method=method, url=url, username=username,
+        ))
+
+        try:
+            resp = github.request(method=method, url=url, token=token, **kwargs)
+            if resp.status_code == 401 and token:
+                # The token was revoked, or replaced since we cached it.
+                # Look it up in the database again, and try once more.
+                token_cache.invalidate(user_id)
+                token = token_for(user_id)
+                resp = github.request(method=method, url=url, token=token, **kwargs)
+        except RateLimited as exc:
+            token_pool.record_response(user_id, exc.response)
+            if attempt + 1 < attempts:
+                # try the pooled token with the most calls left
+                continue
+            raise
+        token_pool.record_response(user_id, resp)
+        break
+
+    if method.upper() == "GET":
+        page_latency.observe(time.time() - started_at)
+    if has_request_context():
+        # for the rate limit headers on load API responses; request
+        # contexts are per greenlet, unlike the shared session
+        g.github_response = resp
+    return resp
+
+
+def check_response(url, resp):
+    if resp.status_code == 404:
+        logger.info("not found: {url}".format(url=url))
+        raise NotFound(url)
+    if not resp.ok:
+        raise RequestException(resp.text)
+    return resp
 
-    logger.info("{method} {url} as {username}".format(
-        method=method, url=url, username=username,
-    ))
 
+@celery.task(bind=True)
+def fetch_url_from_github(self, url, as_user=None, requestor_id=None, **kwargs):
+    method = kwargs.pop("method", "GET")
     try:
-        resp = github.request(method=method, url=url, **kwargs)
+        resp = request_github(
+            url, method=method, as_user=as_user, requestor_id=requestor_id,
+            **kwargs
+        )
     except RateLimited as exc:
         logger.info("rate limited: {url}".format(url=url))
         # if this task is being executed inline, let the exception raise
@@ -39,10 +120,127 @@ def fetch_url_from_github(self, url, as_user=None, requestor_id=None, **kwargs):
         else:
             logger.warn("Retrying {url} at {reset}".format(url=url, reset=exc.reset))
             self.retry(exc=exc, eta=exc.reset)
+    return check_response(url, resp)
 
-    if resp.status_code == 404:
-        logger.info("not found: {url}".format(url=url))
-        raise NotFound(url)
-    if not resp.ok:
-        raise RequestException(resp.text)
-    return resp
+
+def rate_limit_remaining(resp):
+    "How many API calls the token used for this response has left, if known."
+    try:
+        return int(resp.headers["X-RateLimit-Remaining"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def fetch_pages_from_github(url, pages=1, requestor_id=None, **kwargs):
+    """
+    Fetch up to ``pages`` consecutive pages of a paginated API response,
+    starting at ``url``. This is a generator that yields each response as
+    it arrives. If ``PAGE_FETCH_CONCURRENCY`` is more than one, the pages
+    after the first are fetched concurrently (see
+    :func:`fetch_pages_concurrently`), so they may arrive out of order.
+    Otherwise, it follows the ``next`` link from each response.
+    """
+    concurrency = current_app.config.get("PAGE_FETCH_CONCURRENCY", 1)
+    if pages > 1 and concurrency > 1:
+        resp = fetch_url_from_github(url, requestor_id=requestor_id, **kwargs)
+        yield resp
+        for resp in fetch_pages_concurrently(
+                resp, pages - 1, requestor_id=requestor_id,
+                concurrency=concurrency, **kwargs):
+            yield resp
+        return
+
+    for _ in xrange(pages):
+        resp = fetch_url_from_github(url, requestor_id=requestor_id, **kwargs)
+        yield resp
+        url = resp.links.get("next", {}).get("url")
+        if not url:
+            break
+
+
+def fetch_pages_concurrently(first_resp, pages, requestor_id=None,
+                             concurrency=4, **kwargs):
+    """
+    Given the response for one page of a paginated API response, fetch up to
+    ``pages`` of the pages after it, using a pool of ``concurrency`` threads.
+    Responses are yielded as they arrive, so that they can be processed
+    in this thread while the other pages are still downloading.
+
+    This won't spend more API calls concurrently than the rate limit allows
+    (keeping ``PAGE_FETCH_RATE_RESERVE`` calls in reserve). Pages that are
+    over budget, or that were rate limited, are fetched one at a time
+    afterwards with :func:`fetch_url_from_github`, which waits for the rate
+    limit to reset.
+    """
+    first_url = URLObject(first_resp.url)
+    first_page = int(first_url.query.dict.get("page", 1))
+    last_url = first_resp.links.get("last", {}).get("url")
+    if not last_url:
+        # this was the last page
+        return
+    last_page = int(URLObject(last_url).query.dict.get("page", first_page))
+    page_nums = range(first_page + 1, min(first_page + pages, last_page) + 1)
+
+    remaining = rate_limit_remaining(first_resp)
+    if remaining is not None:
+        reserve = current_app.config.get("PAGE_FETCH_RATE_RESERVE", 50)
+        budget = max(0, remaining - reserve)
+        page_nums, deferred = page_nums[:budget], page_nums[budget:]
+    else:
+        deferred = []
+
+    app = current_app._get_current_object()
+    def fetch(page):
+        url = first_url.set_query_param("page", unicode(page))
+        with app.app_context():
+            try:
+                return page, url, request_github(
+                    url, requestor_id=requestor_id, **kwargs
+                )
+            except RateLimited as exc:
+                return page, url, exc
+
+    if page_nums:
+        pool = ThreadPool(min(concurrency, len(page_nums)))
+        try:
+            for page, url, result in pool.imap_unordered(fetch, page_nums):
+                if isinstance(result, RateLimited):
+                    deferred.append(page)
+                else:
+                    yield check_response(url, result)
+        finally:
+            pool.terminate()
+
+    for page in sorted(deferred):
+        url = first_url.set_query_param("page", unicode(page))
+        yield fetch_url_from_github(url, requestor_id=requestor_id, **kwargs)
+
+
+def pages_per_task():
+    """
+    Decide how many pages each "sync page" task should fetch. If
+    ``PAGES_PER_TASK`` is configured, use that. Otherwise, size the chunks
+    so that each task takes roughly ``PAGE_TASK_TARGET_SECONDS``, based on
+    how long Github has been taking to return pages recently, and how many
+    pages each task fetches at once. Fewer, longer tasks mean fewer broker
+    messages and less chord bookkeeping.
+    """
+    config = current_app.config
+    if config.get("PAGES_PER_TASK"):
+        return int(config["PAGES_PER_TASK"])
+    latency = page_latency.value or config.get("PAGE_LATENCY_DEFAULT", 1.0)
+    latency = latency / max(config.get("PAGE_FETCH_CONCURRENCY", 1), 1)
+    target = config.get("PAGE_TASK_TARGET_SECONDS", 10)
+    max_pages = config.get("MAX_PAGES_PER_TASK", 10)
+    return max(1, min(int(target / max(latency, 0.01)), max_pages))
+
+
+def page_chunks(last_page_num, chunk_size=None):
+    """
+    Split pages 1 through ``last_page_num`` into contiguous chunks.
+    Yields ``(page, pages)`` tuples: the first page of the chunk, and how
+    many pages are in it.
+    """
+    chunk_size = chunk_size or pages_per_task()
+    for page in xrange(1, last_page_num + 1, chunk_size):
+        yield page, min(chunk_size, last_page_num - page + 1)
@@ -5,19 +5,24 @@ from datetime import datetime
 from iso8601 import parse_date
 from celery import group
 from urlobject import URLObject
-from webhookdb import db
-from webhookdb.models import Issue, Repository, Mutex
-from webhookdb.process import process_issue
+from webhookdb import db, known_ids
+from webhookdb.models import Issue, PullRequest, Repository, Mutex
+from webhookdb.process import process_issue, bulk_process_issues
+from webhookdb.process.bulk import bulk_load_available
+from webhookdb.process.save import resolve_conflicts
 from webhookdb.tasks import celery, logger
-from webhookdb.tasks.fetch import fetch_url_from_github
+from webhookdb.tasks.scheduler import dispatch_pending_tasks
+from webhookdb.tasks.fetch import (
+    fetch_url_from_github, fetch_pages_from_github, page_chunks
+)
 from webhookdb.exceptions import NotFound
 from sqlalchemy.exc import IntegrityError
 
 LOCK_TEMPLATE = "Repository|{owner}/{repo}|issues"
 
 
-@celery.task(bind=True)
-def sync_issue(self, owner, repo, number, children=False, requestor_id=None):
+@celery.task()
+def sync_issue(owner, repo, number, children=False, requestor_id=None):
     issue_url = "/repos/{owner}/{repo}/issues/{number}".format(
         owner=owner, repo=repo, number=number,
     )
@@ -35,19 +40,24 @@ def sync_issue(self, owner, repo, number, children=False, requestor_id=None):
             "number": number,
         })
     issue_data = resp.json()
-    try:
-        issue = process_issue(
-            issue_data, via="api", fetched_at=datetime.now(), commit=True,
-        )
-    except IntegrityError as exc:
-        self.retry(exc=exc)
+    # the issue payload only names its repository in URLs
+    repository = Repository.get(owner, repo)
+    issue = resolve_conflicts(
+        process_issue, issue_data, via="api", fetched_at=datetime.now(),
+        repo_id=repository.id if repository else None,
+    )
     # ignore `children` attribute for now
     return issue.id
 
 
-@celery.task(bind=True)
-def sync_page_of_issues(self, owner, repo, state="all", children=False,
-                        requestor_id=None, per_page=100, page=1):
+@celery.task()
+def sync_page_of_issues(owner, repo, state="all", children=False,
+                        requestor_id=None, per_page=100, page=1, pages=1,
+                        since=None, bulk=False):
+    """
+    Sync some pages of a repository's issues. If ``bulk`` is set, the issues
+    are inserted with :func:`~webhookdb.process.bulk_process_issues`.
+    """
     issue_page_url = (
         "/repos/{owner}/{repo}/issues?"
         "state={state}&per_page={per_page}&page={page}"
@@ -55,27 +65,53 @@ def sync_page_of_issues(self, owner, repo, state="all", children=False,
         owner=owner, repo=repo,
         state=state, per_page=per_page, page=page
     )
-    resp = fetch_url_from_github(issue_page_url, requestor_id=requestor_id)
-    fetched_at = datetime.now()
-    issue_data_list = resp.json()
-    results = []
-    for issue_data in issue_data_list:
+    if since:
+        issue_page_url += "&since={since}".format(since=since)
+    responses = fetch_pages_from_github(
+        issue_page_url, pages=pages, requestor_id=requestor_id,
+    )
+    repository = Repository.get(owner, repo)
+    repo_id = repository.id if repository else None
+    if bulk:
+        fetched_at = datetime.now()
+        issues_data = [
+            issue_data for resp in responses for issue_data in resp.json()
+        ]
         try:
-            issue = process_issue(
-                issue_data, via="api", fetched_at=fetched_at, commit=True,
+            return bulk_process_issues(
+                issues_data, repo_id, via="api", fetched_at=fetched_at,
             )
-            # ignore `children` attribute for now
-            results.append(issue.id)
-        except IntegrityError as exc:
-            self.retry(exc=exc)
+        except IntegrityError:
+            # someone else is loading this repository too: go one by one,
+            # with the pages we already have
+            db.session.rollback()
+        pages_data = [(fetched_at, issues_data)]
+    else:
+        pages_data = ((datetime.now(), resp.json()) for resp in responses)
+
+    results = []
+    with known_ids.skip_lookups():
+        for fetched_at, page_data in pages_data:
+            for issue_data in page_data:
+                issue = resolve_conflicts(
+                    process_issue, issue_data, via="api", fetched_at=fetched_at,
+                    repo_id=repo_id,
+                )
+                # ignore `children` attribute for now
+                results.append(issue.id)
     return results
 
 
 @celery.task()
-def issues_scanned(owner, repo, requestor_id=None):
+def issues_scanned(owner, repo, requestor_id=None, since=None,
+                   exclude_pull_requests=False):
     """
     Update the timestamp on the repository object,
-    and delete old issues that weren't updated.
+    and delete old issues that weren't updated. If the scan was incremental
+    (only issues updated ``since`` a certain time), nothing is deleted:
+    issues that weren't updated recently weren't fetched at all. If the scan
+    didn't include pull requests (the REST API lists them as issues, but the
+    GraphQL API doesn't), the issues for pull requests aren't deleted.
     """
     repo_name = repo
     repo = Repository.get(owner, repo_name)
@@ -83,14 +119,20 @@ def issues_scanned(owner, repo, requestor_id=None):
     repo.issues_last_scanned_at = datetime.now()
     db.session.add(repo)
 
-    if prev_scan_at:
+    if prev_scan_at and not since:
         # delete any issues that were not updated since the previous scan --
         # they have been removed from Github
         query = (
             Issue.query.filter_by(repo_id=repo.id)
             .filter(Issue.last_replicated_at < prev_scan_at)
         )
-        query.delete()
+        if exclude_pull_requests:
+            pr_numbers = (
+                db.session.query(PullRequest.number)
+                .filter(PullRequest.base_repo_id == repo.id)
+            )
+            query = query.filter(~Issue.number.in_(pr_numbers.subquery()))
+        query.delete(synchronize_session=False)
 
     # delete the mutex
     lock_name = LOCK_TEMPLATE.format(owner=owner, repo=repo_name)
@@ -98,11 +140,17 @@ def issues_scanned(owner, repo, requestor_id=None):
     logger.info("Lock {name} deleted".format(name=lock_name))
 
     db.session.commit()
+    # this requestor has room for more work now
+    dispatch_pending_tasks.delay()
 
 
 @celery.task()
 def spawn_page_tasks_for_issues(owner, repo, state="all", children=False,
-                                requestor_id=None, per_page=100):
+                                requestor_id=None, per_page=100, since=None):
+    """
+    Scan all the issues in a repository. If ``since`` is set to an ISO 8601
+    timestamp, only issues updated at or after that time are scanned.
+    """
     # acquire lock or fail (we're already in a transaction)
     lock_name = LOCK_TEMPLATE.format(owner=owner, repo=repo)
     existing = Mutex.query.get(lock_name)
@@ -126,19 +174,30 @@ def spawn_page_tasks_for_issues(owner, repo, state="all", children=False,
         owner=owner, repo=repo,
         state=state, per_page=per_page,
     )
+    if since:
+        issue_list_url += "&since={since}".format(since=since)
     resp = fetch_url_from_github(
         issue_list_url, method="HEAD", requestor_id=requestor_id,
     )
     last_page_url = URLObject(resp.links.get('last', {}).get('url', ""))
     last_page_num = int(last_page_url.query.dict.get('page', 1))
+    chunks = list(page_chunks(last_page_num))
+    # record how much work this scan queued, for webhookdb.tasks.scheduler
+    lock.page_tasks = len(chunks)
+    db.session.commit()
+    # the first full scan of a repository can insert everything at once
+    repo_obj = Repository.get(owner, repo)
+    bulk = bool(repo_obj and not since and bulk_load_available(
+        Issue.query.filter_by(repo_id=repo_obj.id)
+    ))
     g = group(
         sync_page_of_issues.s(
             owner=owner, repo=repo, state=state, children=children,
             requestor_id=requestor_id,
-            per_page=per_page, page=page,
-        ) for page in xrange(1, last_page_num+1)
+            per_page=per_page, page=page, pages=pages, since=since, bulk=bulk,
+        ) for page, pages in chunks
     )
     finisher = issues_scanned.si(
-        owner=owner, repo=repo, requestor_id=requestor_id,
+        owner=owner, repo=repo, requestor_id=requestor_id, since=since,
     )
     return (g | finisher).delay()
@@ -6,17 +6,21 @@ from celery import group
 from urlobject import URLObject
 from webhookdb import db, celery
 from webhookdb.process import process_label
+from webhookdb.process.save import resolve_conflicts
 from webhookdb.models import IssueLabel, Repository, Mutex
 from webhookdb.exceptions import NotFound, StaleData, MissingData, DatabaseError
 from sqlalchemy.exc import IntegrityError
 from webhookdb.tasks import logger
-from webhookdb.tasks.fetch import fetch_url_from_github
+from webhookdb.tasks.scheduler import dispatch_pending_tasks
+from webhookdb.tasks.fetch import (
+    fetch_url_from_github, fetch_pages_from_github, page_chunks
+)
 
 LOCK_TEMPLATE = "Repository|{owner}/{repo}|labels"
 
 
-@celery.task(bind=True)
-def sync_label(self, owner, repo, name, children=False, requestor_id=None):
+@celery.task()
+def sync_label(owner, repo, name, children=False, requestor_id=None):
     label_url = "/repos/{owner}/{repo}/labels/{name}".format(
         owner=owner, repo=repo, name=name,
     )
@@ -34,19 +38,15 @@ def sync_label(self, owner, repo, name, children=False, requestor_id=None):
             "repo": repo,
         })
     label_data = resp.json()
-    try:
-        label = process_label(
-            label_data, via="api", fetched_at=datetime.now(), commit=True,
-        )
-    except IntegrityError as exc:
-        # multiple workers tried to insert the same label simulataneously. Retry!
-        self.retry(exc=exc)
+    label = resolve_conflicts(
+        process_label, label_data, via="api", fetched_at=datetime.now(),
+    )
     return label.name
 
 
-@celery.task(bind=True)
-def sync_page_of_labels(self, owner, repo, children=False, requestor_id=None,
-                        per_page=100, page=1):
+@celery.task()
+def sync_page_of_labels(owner, repo, children=False, requestor_id=None,
+                        per_page=100, page=1, pages=1):
     label_page_url = (
         "/repos/{owner}/{repo}/labels?"
         "per_page={per_page}&page={page}"
@@ -54,21 +54,20 @@ def sync_page_of_labels(self, owner, repo, children=False, requestor_id=None,
         owner=owner, repo=repo,
         per_page=per_page, page=page
     )
-    resp = fetch_url_from_github(label_page_url, requestor_id=requestor_id)
-    fetched_at = datetime.now()
-    label_data_list = resp.json()
+    responses = fetch_pages_from_github(
+        label_page_url, pages=pages, requestor_id=requestor_id,
+    )
     results = []
     repo_id = None
-    for label_data in label_data_list:
-        try:
-            label = process_label(
-                label_data, via="api", fetched_at=fetched_at, commit=True,
-                repo_id=repo_id,
+    for resp in responses:
+        fetched_at = datetime.now()
+        for label_data in resp.json():
+            label = resolve_conflicts(
+                process_label, label_data,
+                via="api", fetched_at=fetched_at, repo_id=repo_id,
             )
             repo_id = repo_id or label.repo_id
             results.append(label.name)
-        except IntegrityError as exc:
-            self.retry(exc=exc)
     return results
 
 
@@ -99,6 +98,8 @@ def labels_scanned(owner, repo, requestor_id=None):
     logger.info("Lock {name} deleted".format(name=lock_name))
 
     db.session.commit()
+    # this requestor has room for more work now
+    dispatch_pending_tasks.delay()
 
 
 @celery.task()
@@ -130,11 +131,15 @@ def spawn_page_tasks_for_labels(owner, repo, children=False,
     )
     last_page_url = URLObject(resp.links.get('last', {}).get('url', ""))
     last_page_num = int(last_page_url.query.dict.get('page', 1))
+    chunks = list(page_chunks(last_page_num))
+    # record how much work this scan queued, for webhookdb.tasks.scheduler
+    lock.page_tasks = len(chunks)
+    db.session.commit()
     g = group(
         sync_page_of_labels.s(
             owner=owner, repo=repo, requestor_id=requestor_id,
-            per_page=per_page, page=page
-        ) for page in xrange(1, last_page_num+1)
+            per_page=per_page, page=page, pages=pages,
+        ) for page, pages in chunks
     )
     finisher = labels_scanned.si(
         owner=owner, repo=repo, requestor_id=requestor_id,
@@ -7,17 +7,21 @@ from celery import group
 from urlobject import URLObject
 from webhookdb import db, celery
 from webhookdb.process import process_milestone
+from webhookdb.process.save import resolve_conflicts
 from webhookdb.models import Milestone, Repository, Mutex
 from webhookdb.exceptions import NotFound, StaleData, MissingData, DatabaseError
 from sqlalchemy.exc import IntegrityError
 from webhookdb.tasks import logger
-from webhookdb.tasks.fetch import fetch_url_from_github
+from webhookdb.tasks.scheduler import dispatch_pending_tasks
+from webhookdb.tasks.fetch import (
+    fetch_url_from_github, fetch_pages_from_github, page_chunks
+)
 
 LOCK_TEMPLATE = "Repository|{owner}/{repo}|milestones"
 
 
-@celery.task(bind=True)
-def sync_milestone(self, owner, repo, number, children=False, requestor_id=None):
+@celery.task()
+def sync_milestone(owner, repo, number, children=False, requestor_id=None):
     milestone_url = "/repos/{owner}/{repo}/milestones/{number}".format(
         owner=owner, repo=repo, number=number,
     )
@@ -35,20 +39,17 @@ def sync_milestone(self, owner, repo, number, children=False, requestor_id=None)
             "repo": repo,
         })
     milestone_data = resp.json()
-    try:
-        milestone = process_milestone(
-            milestone_data, via="api", fetched_at=datetime.now(), commit=True,
-        )
-    except IntegrityError as exc:
-        # multiple workers tried to insert the same milestone simulataneously. Retry!
-        self.retry(exc=exc)
+    milestone = resolve_conflicts(
+        process_milestone, milestone_data,
+        via="api", fetched_at=datetime.now(),
+    )
     return milestone.number
 
 
-@celery.task(bind=True)
-def sync_page_of_milestones(self, owner, repo, state="all",
+@celery.task()
+def sync_page_of_milestones(owner, repo, state="all",
                             children=False, requestor_id=None,
-                            per_page=100, page=1):
+                            per_page=100, page=1, pages=1):
     milestone_page_url = (
         "/repos/{owner}/{repo}/milestones?"
         "state={state}&per_page={per_page}&page={page}"
@@ -56,21 +57,20 @@ def sync_page_of_milestones(self, owner, repo, state="all",
         owner=owner, repo=repo,
         state=state, per_page=per_page, page=page
     )
-    resp = fetch_url_from_github(milestone_page_url, requestor_id=requestor_id)
-    fetched_at = datetime.now()
-    milestone_data_list = resp.json()
+    responses = fetch_pages_from_github(
+        milestone_page_url, pages=pages, requestor_id=requestor_id,
+    )
     results = []
     repo_id = None
-    for milestone_data in milestone_data_list:
-        try:
-            milestone = process_milestone(
-                milestone_data, via="api", fetched_at=fetched_at, commit=True,
-                repo_id=repo_id,
+    for resp in responses:
+        fetched_at = datetime.now()
+        for milestone_data in resp.json():
+            milestone = resolve_conflicts(
+                process_milestone, milestone_data,
+                via="api", fetched_at=fetched_at, repo_id=repo_id,
             )
             repo_id = repo_id or milestone.repo_id
             results.append(milestone.number)
-        except IntegrityError as exc:
-            self.retry(exc=exc)
     return results
 
 
@@ -101,6 +101,8 @@ def milestones_scanned(owner, repo, requestor_id=None):
     logger.info("Lock {name} deleted".format(name=lock_name))
 
     db.session.commit()
+    # this requestor has room for more work now
+    dispatch_pending_tasks.delay()
 
 
 @celery.task()
@@ -134,11 +136,15 @@ def spawn_page_tasks_for_milestones(owner, repo, state="all", children=False,
     )
     last_page_url = URLObject(resp.links.get('last', {}).get('url', ""))
     last_page_num = int(last_page_url.query.dict.get('page', 1))
+    chunks = list(page_chunks(last_page_num))
+    # record how much work this scan queued, for webhookdb.tasks.scheduler
+    lock.page_tasks = len(chunks)
+    db.session.commit()
     g = group(
         sync_page_of_milestones.s(
             owner=owner, repo=repo, state=state, requestor_id=requestor_id,
-            per_page=per_page, page=page,
-        ) for page in xrange(1, last_page_num+1)
+            per_page=per_page, page=page, pages=pages,
+        ) for page, pages in chunks
     )
     finisher = milestones_scanned.si(
         owner=owner, repo=repo, requestor_id=requestor_id,
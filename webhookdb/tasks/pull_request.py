@@ -4,21 +4,26 @@ from __future__ import unicode_literals, print_function
 from datetime import datetime
 from iso8601 import parse_date
 from celery import group
-from webhookdb import db
-from webhookdb.process import process_pull_request
+from webhookdb import db, known_ids
+from webhookdb.process import process_pull_request, bulk_process_pull_requests
+from webhookdb.process.bulk import bulk_load_available
+from webhookdb.process.save import resolve_conflicts
 from webhookdb.models import PullRequest, Repository, Mutex
 from webhookdb.exceptions import NotFound
 from sqlalchemy.exc import IntegrityError
 from webhookdb.tasks import celery, logger
-from webhookdb.tasks.fetch import fetch_url_from_github
+from webhookdb.tasks.scheduler import dispatch_pending_tasks
+from webhookdb.tasks.fetch import (
+    fetch_url_from_github, fetch_pages_from_github, page_chunks
+)
 from webhookdb.tasks.pull_request_file import spawn_page_tasks_for_pull_request_files
 from urlobject import URLObject
 
 LOCK_TEMPLATE = "Repository|{owner}/{repo}|pulls"
 
 
-@celery.task(bind=True)
-def sync_pull_request(self, owner, repo, number,
+@celery.task()
+def sync_pull_request(owner, repo, number,
                       children=False, requestor_id=None):
     pr_url = "/repos/{owner}/{repo}/pulls/{number}".format(
         owner=owner, repo=repo, number=number,
@@ -37,12 +42,9 @@ def sync_pull_request(self, owner, repo, number,
             "number": number,
         })
     pr_data = resp.json()
-    try:
-        pr = process_pull_request(
-            pr_data, via="api", fetched_at=datetime.now(), commit=True,
-        )
-    except IntegrityError as exc:
-        self.retry(exc=exc)
+    pr = resolve_conflicts(
+        process_pull_request, pr_data, via="api", fetched_at=datetime.now(),
+    )
 
     if children:
         spawn_page_tasks_for_pull_request_files.delay(
@@ -52,9 +54,15 @@ def sync_pull_request(self, owner, repo, number,
     return pr.id
 
 
-@celery.task(bind=True)
-def sync_page_of_pull_requests(self, owner, repo, state="all", children=False,
-                               requestor_id=None, per_page=100, page=1):
+@celery.task()
+def sync_page_of_pull_requests(owner, repo, state="all", children=False,
+                               requestor_id=None, per_page=100, page=1,
+                               pages=1, bulk=False):
+    """
+    Sync some pages of a repository's pull requests. If ``bulk`` is set, the
+    pull requests are inserted with
+    :func:`~webhookdb.process.bulk_process_pull_requests`.
+    """
     pr_page_url = (
         "/repos/{owner}/{repo}/pulls?"
         "state={state}&per_page={per_page}&page={page}"
@@ -62,24 +70,47 @@ def sync_page_of_pull_requests(self, owner, repo, state="all", children=False,
         owner=owner, repo=repo,
         state=state, per_page=per_page, page=page
     )
-    resp = fetch_url_from_github(pr_page_url, requestor_id=requestor_id)
-    fetched_at = datetime.now()
-    pr_data_list = resp.json()
-    results = []
-    for pr_data in pr_data_list:
+    responses = fetch_pages_from_github(
+        pr_page_url, pages=pages, requestor_id=requestor_id,
+    )
+    if bulk:
+        fetched_at = datetime.now()
+        prs_data = [pr_data for resp in responses for pr_data in resp.json()]
         try:
-            pr = process_pull_request(
-                pr_data, via="api", fetched_at=fetched_at, commit=True,
-            )
-            results.append(pr.id)
-        except IntegrityError as exc:
-            self.retry(exc=exc)
-
-        if children:
-            spawn_page_tasks_for_pull_request_files.delay(
-                owner, repo, pr.number, children=children,
-                requestor_id=requestor_id,
+            numbers = bulk_process_pull_requests(
+                prs_data, via="api", fetched_at=fetched_at,
             )
+        except IntegrityError:
+            # someone else is loading this repository too: go one by one,
+            # with the pages we already have
+            db.session.rollback()
+        else:
+            if children:
+                for number in numbers:
+                    spawn_page_tasks_for_pull_request_files.delay(
+                        owner, repo, number, children=children,
+                        requestor_id=requestor_id,
+                    )
+            return [pr_data["id"] for pr_data in prs_data]
+        pages_data = [(fetched_at, prs_data)]
+    else:
+        pages_data = ((datetime.now(), resp.json()) for resp in responses)
+
+    results = []
+    with known_ids.skip_lookups():
+        for fetched_at, page_data in pages_data:
+            for pr_data in page_data:
+                pr = resolve_conflicts(
+                    process_pull_request, pr_data,
+                    via="api", fetched_at=fetched_at,
+                )
+                results.append(pr.id)
+
+                if children:
+                    spawn_page_tasks_for_pull_request_files.delay(
+                        owner, repo, pr.number, children=children,
+                        requestor_id=requestor_id,
+                    )
     return results
 
 
@@ -110,6 +141,8 @@ def pull_requests_scanned(owner, repo, requestor_id=None):
     logger.info("Lock {name} deleted".format(name=lock_name))
 
     db.session.commit()
+    # this requestor has room for more work now
+    dispatch_pending_tasks.delay()
 
 
 @celery.task()
@@ -143,12 +176,21 @@ def spawn_page_tasks_for_pull_requests(owner, repo, state="all", children=False,
     )
     last_page_url = URLObject(resp.links.get('last', {}).get('url', ""))
     last_page_num = int(last_page_url.query.dict.get('page', 1))
+    chunks = list(page_chunks(last_page_num))
+    # record how much work this scan queued, for webhookdb.tasks.scheduler
+    lock.page_tasks = len(chunks)
+    db.session.commit()
+    # the first scan of a repository can insert everything at once
+    repo_obj = Repository.get(owner, repo)
+    bulk = bool(repo_obj and bulk_load_available(
+        PullRequest.query.filter_by(base_repo_id=repo_obj.id)
+    ))
     g = group(
         sync_page_of_pull_requests.s(
             owner=owner, repo=repo, state=state,
             children=children, requestor_id=requestor_id,
-            per_page=per_page, page=page
-        ) for page in xrange(1, last_page_num+1)
+            per_page=per_page, page=page, pages=pages, bulk=bulk,
+        ) for page, pages in chunks
     )
     finisher = pull_requests_scanned.si(
         owner=owner, repo=repo, requestor_id=requestor_id,
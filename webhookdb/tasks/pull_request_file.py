@@ -2,83 +2,117 @@
 from __future__ import unicode_literals, print_function
 
 from datetime import datetime
-from celery import group
+from flask import current_app
 from webhookdb import db
-from webhookdb.process import process_pull_request_file
-from webhookdb.models import PullRequestFile, PullRequest, Mutex
-from webhookdb.exceptions import (
-    NotFound, NothingToDo, DatabaseError
-)
+from webhookdb.process import process_pull_request_files
+from webhookdb.models import PullRequest, Mutex
+from webhookdb.exceptions import StaleData
 from sqlalchemy.exc import IntegrityError
+from celery.exceptions import Retry
 from webhookdb.tasks import celery
-from webhookdb.tasks.fetch import fetch_url_from_github
+from webhookdb.tasks.scheduler import dispatch_pending_tasks
+from webhookdb.tasks.fetch import fetch_url_from_github, fetch_pages_from_github
 from urlobject import URLObject
 
 LOCK_TEMPLATE = "PullRequest|{owner}/{repo}#{number}|files"
 
 
-@celery.task(bind=True)
-def sync_page_of_pull_request_files(self, owner, repo, number, pull_request_id=None,
-                                    children=False, requestor_id=None,
-                                    per_page=100, page=1):
-    if not pull_request_id:
-        pull_request_id = PullRequest.get(owner, repo, number).id
-
-    prf_page_url = (
-        "/repos/{owner}/{repo}/pulls/{number}/files?"
-        "per_page={per_page}&page={page}"
-    ).format(
-        owner=owner, repo=repo, number=number,
-        per_page=per_page, page=page,
-    )
-    resp = fetch_url_from_github(prf_page_url, requestor_id=requestor_id)
-    fetched_at = datetime.now()
-    prf_data_list = resp.json()
-    results = []
-    for prf_data in prf_data_list:
-        try:
-            prf = process_pull_request_file(
-                prf_data, via="api", fetched_at=fetched_at, commit=True,
-                pull_request_id=pull_request_id,
-            )
-            results.append(prf.sha)
-        except IntegrityError as exc:
-            self.retry(exc=exc)
-        except NothingToDo:
-            pass
-    return results
+def fetch_all_pages(url, pages=1, requestor_id=None):
+    """
+    Fetch the items on every page of a listing, starting with the ``pages``
+    pages we expect there to be. If there turn out to be more, follow the
+    ``next`` links from the last of them, so that nothing is left out.
+    """
+    responses = list(fetch_pages_from_github(
+        url, pages=pages, requestor_id=requestor_id,
+    ))
+    items = []
+    for resp in responses:
+        items.extend(resp.json())
+    # pages may arrive out of order
+    resp = max(responses, key=lambda resp: int(
+        URLObject(resp.url).query.dict.get("page", 1)
+    ))
+    next_url = resp.links.get("next", {}).get("url")
+    while next_url:
+        resp = fetch_url_from_github(next_url, requestor_id=requestor_id)
+        items.extend(resp.json())
+        next_url = resp.links.get("next", {}).get("url")
+    return items
 
 
-@celery.task()
-def pull_request_files_scanned(owner, repo, number, requestor_id=None):
+@celery.task(bind=True)
+def sync_pages_of_pull_request_files(self, owner, repo, number,
+                                     pull_request_id=None, children=False,
+                                     requestor_id=None, per_page=100, pages=1):
     """
-    Update the timestamp on the pull request object,
-    and delete old pull request files that weren't updated.
+    Fetch every page of a pull request's files, and update the database to
+    match them in a single transaction (see
+    :func:`~webhookdb.process.process_pull_request_files`). This also
+    releases the lock taken by :func:`spawn_page_tasks_for_pull_request_files`.
+    A pull request has at most 3000 files, so even the largest fits in
+    a single task. ``pages`` is how many pages we expect, but the listing
+    is followed to its end, since files that aren't fetched are deleted.
     """
-    pr = PullRequest.get(owner, repo, number)
-    prev_scan_at = pr.files_last_scanned_at
-    pr.files_last_scanned_at = datetime.now()
-    db.session.add(pr)
-
-    if prev_scan_at:
-        # delete any files that were not updated since the previous scan --
-        # they have been removed from Github
-        query = (
-            PullRequestFile.query.filter_by(pull_request_id=pr.id)
-            .filter(PullRequestFile.last_replicated_at < prev_scan_at)
+    lock_name = LOCK_TEMPLATE.format(owner=owner, repo=repo, number=number)
+    try:
+        if not pull_request_id:
+            pull_request_id = PullRequest.get(owner, repo, number).id
+
+        prf_page_url = (
+            "/repos/{owner}/{repo}/pulls/{number}/files?"
+            "per_page={per_page}&page=1"
+        ).format(
+            owner=owner, repo=repo, number=number, per_page=per_page,
+        )
+        files_data = fetch_all_pages(
+            prf_page_url, pages=pages, requestor_id=requestor_id,
         )
-        query.delete()
+        fetched_at = datetime.now()
 
-    # delete the mutex
-    lock_name = LOCK_TEMPLATE.format(owner=owner, repo=repo, number=number)
-    Mutex.query.filter_by(name=lock_name).delete()
+        def save_files():
+            try:
+                counts = process_pull_request_files(
+                    files_data, via="api", fetched_at=fetched_at, commit=False,
+                    pull_request_id=pull_request_id,
+                )
+            except StaleData:
+                # a more recent scan has already updated these files
+                counts = 0, 0
+            pr = PullRequest.query.get(pull_request_id)
+            pr.files_last_scanned_at = datetime.now()
+            db.session.add(pr)
+
+            # delete the mutex
+            Mutex.query.filter_by(name=lock_name).delete()
+            db.session.commit()
+            return counts
 
-    db.session.commit()
+        try:
+            saved, removed = save_files()
+        except IntegrityError:
+            # Another scan stored one of the same patches first. Now that
+            # it's committed, saving again will use it.
+            db.session.rollback()
+            saved, removed = save_files()
+    except Retry:
+        # the retry will release the lock
+        raise
+    except Exception:
+        # don't leave the lock held until it expires
+        db.session.rollback()
+        Mutex.query.filter_by(name=lock_name).delete()
+        db.session.commit()
+        raise
+    # this requestor has room for more work now
+    dispatch_pending_tasks.delay()
+    return {"saved": saved, "removed": removed}
 
 
 @celery.task()
 def spawn_page_tasks_for_pull_request_files(owner, repo, number, children=False,
-                                            requestor_id=None, per_page=100):
+                                            requestor_id=None, per_page=100,
+                                            last_page_num=None):
     # acquire lock or fail (we're already in a transaction)
     lock_name = LOCK_TEMPLATE.format(owner=owner, repo=repo, number=number)
     existing = Mutex.query.get(lock_name)
@@ -100,20 +134,48 @@ def spawn_page_tasks_for_pull_request_files(owner, repo, number, children=False,
         owner=owner, repo=repo, number=number,
         per_page=per_page,
     )
-    resp = fetch_url_from_github(
-        prf_list_url, method="HEAD", requestor_id=requestor_id,
-    )
-    last_page_url = URLObject(resp.links.get('last', {}).get('url', ""))
-    last_page_num = int(last_page_url.query.dict.get('page', 1))
-
-    g = group(
-        sync_page_of_pull_request_files.s(
-            owner=owner, repo=repo, number=number, pull_request_id=pr.id,
-            children=children, requestor_id=requestor_id,
-            per_page=per_page, page=page,
-        ) for page in xrange(1, last_page_num+1)
+    if not last_page_num:
+        resp = fetch_url_from_github(
+            prf_list_url, method="HEAD", requestor_id=requestor_id,
+        )
+        last_page_url = URLObject(resp.links.get('last', {}).get('url', ""))
+        last_page_num = int(last_page_url.query.dict.get('page', 1))
+
+    return sync_pages_of_pull_request_files.delay(
+        owner=owner, repo=repo, number=number, pull_request_id=pr.id,
+        children=children, requestor_id=requestor_id,
+        per_page=per_page, pages=last_page_num,
     )
-    finisher = pull_request_files_scanned.si(
-        owner=owner, repo=repo, number=number, requestor_id=requestor_id,
+
+
+@celery.task(bind=True)
+def sync_pull_request_files_for_head(self, owner, repo, number, head_sha,
+                                     requestor_id=None, per_page=100):
+    """
+    Rescan the files of a pull request whose head commit has changed.
+
+    Webhooks schedule this task with a countdown of
+    ``PULL_REQUEST_FILES_DEBOUNCE_SECONDS``, once for each new head commit.
+    If the pull request has moved on to another commit by the time the task
+    runs, the task for that commit will do the scan instead, so a flurry of
+    pushes only fetches the files once.
+    """
+    pr = PullRequest.get(owner, repo, number)
+    if not pr or pr.head_sha != head_sha:
+        return False
+
+    # the pull request tells us how many files it has, so we don't need
+    # to ask Github how many pages there are
+    last_page_num = None
+    if pr.changed_files is not None:
+        last_page_num = max(1, (pr.changed_files + per_page - 1) // per_page)
+    result = spawn_page_tasks_for_pull_request_files(
+        owner, repo, number, requestor_id=requestor_id, per_page=per_page,
+        last_page_num=last_page_num,
     )
-    return (g | finisher).delay()
+    if result is False:
+        # a scan is already running, but it may have started before this
+        # commit was pushed: try again once it's done
+        countdown = current_app.config.get("PULL_REQUEST_FILES_DEBOUNCE_SECONDS", 30)
+        self.retry(countdown=countdown)
+    return result
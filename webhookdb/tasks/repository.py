@@ -4,26 +4,64 @@ from __future__ import unicode_literals, print_function
 from datetime import datetime
 from iso8601 import parse_date
 from celery import group
+from flask import current_app
 from webhookdb import db
-from webhookdb.process import process_repository
-from webhookdb.models import Repository, User, UserRepoAssociation, Mutex
+from webhookdb.process import process_repository, process_user
+from webhookdb.process.repository import (
+    permissions_for_level, process_repository_permissions
+)
+from webhookdb.process.save import resolve_conflicts
+from webhookdb.models import Repository, User, UserRepoAssociation, Mutex, OAuth
 from webhookdb.exceptions import NotFound, StaleData, MissingData
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from webhookdb.tasks import celery, logger
-from webhookdb.tasks.fetch import fetch_url_from_github
+from webhookdb.tasks.scheduler import enqueue, dispatch_pending_tasks
+from webhookdb.tasks.fetch import (
+    fetch_url_from_github, fetch_pages_from_github, page_chunks
+)
 from webhookdb.tasks.issue import spawn_page_tasks_for_issues
 from webhookdb.tasks.label import spawn_page_tasks_for_labels
 from webhookdb.tasks.milestone import spawn_page_tasks_for_milestones
 from webhookdb.tasks.pull_request import spawn_page_tasks_for_pull_requests
 from webhookdb.tasks.repository_hook import spawn_page_tasks_for_repository_hooks
+from webhookdb.tasks.graphql import graphql_sync_repository
 from urlobject import URLObject
 
 LOCK_TEMPLATE = "User|{username}|repos"
 
 
+def enqueue_children(owner, repo, children=False, requestor_id=None,
+                     hooks=True):
+    """
+    Queue scans of a repository's issues, labels, milestones, pull requests,
+    and (if ``hooks`` is true) hooks with the scheduler. Depending on the
+    ``FETCH_BACKEND`` config variable, that's one REST scan per collection,
+    or one GraphQL scan for everything but the hooks. Remember to call
+    :func:`~webhookdb.tasks.scheduler.dispatch_pending_tasks` afterwards.
+    """
+    if current_app.config.get("FETCH_BACKEND") == "graphql":
+        enqueue(
+            graphql_sync_repository, owner, repo, children=children,
+            requestor_id=requestor_id, dispatch=False,
+        )
+        spawns = []
+    else:
+        spawns = [
+            spawn_page_tasks_for_issues, spawn_page_tasks_for_labels,
+            spawn_page_tasks_for_milestones,
+            spawn_page_tasks_for_pull_requests,
+        ]
+    if hooks:
+        spawns.append(spawn_page_tasks_for_repository_hooks)
+    for spawn in spawns:
+        enqueue(
+            spawn, owner, repo, children=children,
+            requestor_id=requestor_id, dispatch=False,
+        )
 
-@celery.task(bind=True)
-def sync_repository(self, owner, repo, children=False, requestor_id=None):
+
+@celery.task()
+def sync_repository(owner, repo, children=False, requestor_id=None):
     repo_url = "/repos/{owner}/{repo}".format(owner=owner, repo=repo)
     try:
         resp = fetch_url_from_github(repo_url, requestor_id=requestor_id)
@@ -36,38 +74,24 @@ def sync_repository(self, owner, repo, children=False, requestor_id=None):
             "repo": repo,
         })
     repo_data = resp.json()
-    try:
-        repo = process_repository(
-            repo_data, via="api", fetched_at=datetime.now(), commit=True,
-            requestor_id=requestor_id,
-        )
-    except IntegrityError as exc:
-        self.retry(exc=exc)
+    repo = resolve_conflicts(
+        process_repository, repo_data, via="api", fetched_at=datetime.now(),
+        requestor_id=requestor_id,
+    )
 
     if children:
-        spawn_page_tasks_for_issues.delay(
-            owner, repo, children=children, requestor_id=requestor_id,
-        )
-        spawn_page_tasks_for_labels.delay(
-            owner, repo, children=children, requestor_id=requestor_id,
-        )
-        spawn_page_tasks_for_milestones.delay(
-            owner, repo, children=children, requestor_id=requestor_id,
-        )
-        spawn_page_tasks_for_pull_requests.delay(
-            owner, repo, children=children, requestor_id=requestor_id,
-        )
-        spawn_page_tasks_for_repository_hooks.delay(
-            owner, repo, children=children, requestor_id=requestor_id,
+        enqueue_children(
+            owner, repo.name, children=children, requestor_id=requestor_id,
         )
+        dispatch_pending_tasks.delay()
 
     return repo.id
 
 
-@celery.task(bind=True)
-def sync_page_of_repositories_for_user(self, username, type="all",
+@celery.task()
+def sync_page_of_repositories_for_user(username, type="all",
                                        children=False, requestor_id=None,
-                                       per_page=100, page=1):
+                                       per_page=100, page=1, pages=1):
     repo_page_url = (
         "/users/{username}/repos?type={type}&per_page={per_page}&page={page}"
     ).format(
@@ -85,44 +109,31 @@ def sync_page_of_repositories_for_user(self, username, type="all",
                 type=type, per_page=per_page, page=page
             )
 
-    resp = fetch_url_from_github(
-        repo_page_url, requestor_id=requestor_id,
+    responses = fetch_pages_from_github(
+        repo_page_url, pages=pages, requestor_id=requestor_id,
         headers={"Accept": "application/vnd.github.moondragon+json"},
     )
-    fetched_at = datetime.now()
-    repo_data_list = resp.json()
     results = []
-    for repo_data in repo_data_list:
-        try:
-            repo = process_repository(
-                repo_data, via="api", fetched_at=fetched_at, commit=True,
+    for resp in responses:
+        fetched_at = datetime.now()
+        for repo_data in resp.json():
+            repo = resolve_conflicts(
+                process_repository, repo_data, via="api", fetched_at=fetched_at,
                 requestor_id=requestor_id,
             )
             results.append(repo.id)
-        except IntegrityError as exc:
-            self.retry(exc=exc)
 
-        if children:
-            owner = repo.owner_login
-            spawn_page_tasks_for_issues.delay(
-                owner, repo.name, children=children, requestor_id=requestor_id,
-            )
-            spawn_page_tasks_for_labels.delay(
-                owner, repo.name, children=children, requestor_id=requestor_id,
-            )
-            spawn_page_tasks_for_milestones.delay(
-                owner, repo.name, children=children, requestor_id=requestor_id,
-            )
-            spawn_page_tasks_for_pull_requests.delay(
-                owner, repo.name, children=children, requestor_id=requestor_id,
-            )
-            # only try to get repo hooks if the requestor is an admin on this repo
-            assoc = UserRepoAssociation.query.get((requestor_id, repo.id))
-            if assoc and assoc.can_admin:
-                spawn_page_tasks_for_repository_hooks.delay(
-                    owner, repo.name, children=children, requestor_id=requestor_id,
+            if children:
+                # only try to get repo hooks if the requestor is an admin on this repo
+                assoc = UserRepoAssociation.query.get((requestor_id, repo.id))
+                enqueue_children(
+                    repo.owner_login, repo.name, children=children,
+                    requestor_id=requestor_id,
+                    hooks=bool(assoc and assoc.can_admin),
                 )
 
+    if children:
+        dispatch_pending_tasks.delay()
     return results
 
 
@@ -153,6 +164,8 @@ def user_repositories_scanned(username, requestor_id=None):
     logger.info("Lock {name} deleted".format(name=lock_name))
 
     db.session.commit()
+    # this requestor has room for more work now
+    dispatch_pending_tasks.delay()
 
 
 @celery.task()
@@ -198,14 +211,115 @@ def spawn_page_tasks_for_user_repositories(
     )
     last_page_url = URLObject(resp.links.get('last', {}).get('url', ""))
     last_page_num = int(last_page_url.query.dict.get('page', 1))
+    chunks = list(page_chunks(last_page_num))
+    # record how much work this scan queued, for webhookdb.tasks.scheduler
+    lock.page_tasks = len(chunks)
+    db.session.commit()
     g = group(
         sync_page_of_repositories_for_user.s(
             username=username, type=type,
             children=children, requestor_id=requestor_id,
-            per_page=per_page, page=page,
-        ) for page in xrange(1, last_page_num+1)
+            per_page=per_page, page=page, pages=pages,
+        ) for page, pages in chunks
     )
     finisher = user_repositories_scanned.si(
         username=username, requestor_id=requestor_id,
     )
     return (g | finisher).delay()
+
+
+def admin_requestor_id(repo_id):
+    "The ID of one of a repository's admins that we have a token for, or None."
+    return (
+        db.session.query(UserRepoAssociation.user_id)
+        .join(OAuth, OAuth.user_id == UserRepoAssociation.user_id)
+        .filter(UserRepoAssociation.repo_id == repo_id)
+        .filter(UserRepoAssociation.can_admin == True)
+        .limit(1).scalar()
+    )
+
+
+@celery.task(bind=True)
+def sync_team_repository_permissions(self, team_id, owner, repo, permission,
+                                     requestor_id=None):
+    """
+    Give every member of a team the team's permission on a repository, after
+    the team was given access to it (a ``team_add`` webhook event).
+    Permissions that members already have aren't taken away. Listing a team's
+    members takes a token that can see the organization, so if there's no
+    ``requestor_id``, one of the repository's admins is used.
+    """
+    repo_name = repo
+    repo = Repository.get(owner, repo_name)
+    if not repo:
+        msg = "Repo {owner}/{repo} not loaded in webhookdb".format(
+            owner=owner, repo=repo_name,
+        )
+        raise NotFound(msg, {"type": "repo", "owner": owner, "repo": repo_name})
+    requestor_id = requestor_id or admin_requestor_id(repo.id)
+
+    permissions = permissions_for_level(permission)
+    url = "/teams/{team_id}/members?per_page=100".format(team_id=team_id)
+    member_ids = []
+    while url:
+        resp = fetch_url_from_github(url, requestor_id=requestor_id)
+        fetched_at = datetime.now()
+        for user_data in resp.json():
+            try:
+                process_user(
+                    user_data, via="api", fetched_at=fetched_at, commit=False,
+                )
+            except StaleData:
+                pass
+            process_repository_permissions(
+                user_data["id"], repo.id, permissions,
+                commit=False, upgrade_only=True,
+            )
+            member_ids.append(user_data["id"])
+        url = resp.links.get("next", {}).get("url")
+    try:
+        db.session.commit()
+    except IntegrityError as exc:
+        self.retry(exc=exc)
+    return member_ids
+
+
+@celery.task()
+def sync_user_repository_permissions(owner, repo, username, requestor_id=None):
+    """
+    Ask Github what a user can do with a repository, after they were removed
+    as a collaborator (a ``member`` webhook event): they may still have
+    access through a team or the organization. Only an admin can ask, so if
+    there's no ``requestor_id``, one of the repository's admins is used.
+    Returns the user's permission level.
+    """
+    repo_name = repo
+    repo = Repository.get(owner, repo_name)
+    if not repo:
+        msg = "Repo {owner}/{repo} not loaded in webhookdb".format(
+            owner=owner, repo=repo_name,
+        )
+        raise NotFound(msg, {"type": "repo", "owner": owner, "repo": repo_name})
+    requestor_id = requestor_id or admin_requestor_id(repo.id)
+
+    url = "/repos/{owner}/{repo}/collaborators/{username}/permission".format(
+        owner=owner, repo=repo_name, username=username,
+    )
+    data = fetch_url_from_github(url, requestor_id=requestor_id).json()
+    user_data = data.get("user")
+    if not user_data:
+        raise MissingData("no user in permission response", obj=data)
+    level = data.get("permission")
+    try:
+        process_user(
+            user_data, via="api", fetched_at=datetime.now(), commit=False,
+        )
+    except StaleData:
+        pass
+    process_repository_permissions(
+        user_data["id"], repo.id,
+        None if level == "none" else permissions_for_level(level),
+        commit=False,
+    )
+    db.session.commit()
+    return level
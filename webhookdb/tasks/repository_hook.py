@@ -6,18 +6,22 @@ from iso8601 import parse_date
 from celery import group
 from webhookdb import db
 from webhookdb.process import process_repository_hook
+from webhookdb.process.save import resolve_conflicts
 from webhookdb.models import RepositoryHook, Repository, Mutex
 from webhookdb.exceptions import NotFound
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from webhookdb.tasks import celery, logger
-from webhookdb.tasks.fetch import fetch_url_from_github
+from webhookdb.tasks.scheduler import dispatch_pending_tasks
+from webhookdb.tasks.fetch import (
+    fetch_url_from_github, fetch_pages_from_github, page_chunks
+)
 from urlobject import URLObject
 
 LOCK_TEMPLATE = "Repository|{owner}/{repo}|hooks"
 
 
-@celery.task(bind=True)
-def sync_repository_hook(self, owner, repo, hook_id,
+@celery.task()
+def sync_repository_hook(owner, repo, hook_id,
                          children=False, requestor_id=None):
     hook_url = "/repos/{owner}/{repo}/hooks/{hook_id}".format(
         owner=owner, repo=repo, hook_id=hook_id,
@@ -36,37 +40,34 @@ def sync_repository_hook(self, owner, repo, hook_id,
             "hook_id": hook_id,
         })
     hook_data = resp.json()
-    try:
-        hook = process_repository_hook(
-            hook_data, via="api", fetched_at=datetime.now(), commit=True,
-            requestor_id=requestor_id,
-        )
-    except IntegrityError as exc:
-        self.retry(exc=exc)
+    hook = resolve_conflicts(
+        process_repository_hook, hook_data,
+        via="api", fetched_at=datetime.now(), requestor_id=requestor_id,
+    )
     return hook.id
 
 
-@celery.task(bind=True)
-def sync_page_of_repository_hooks(self, owner, repo, children=False,
-                                  requestor_id=None, per_page=100, page=1):
+@celery.task()
+def sync_page_of_repository_hooks(owner, repo, children=False,
+                                  requestor_id=None, per_page=100, page=1,
+                                  pages=1):
     hook_page_url = (
         "/repos/{owner}/{repo}/hooks?per_page={per_page}&page={page}"
     ).format(
         owner=owner, repo=repo, per_page=per_page, page=page,
     )
-    resp = fetch_url_from_github(hook_page_url, requestor_id=requestor_id)
-    fetched_at = datetime.now()
-    hook_data_list = resp.json()
+    responses = fetch_pages_from_github(
+        hook_page_url, pages=pages, requestor_id=requestor_id,
+    )
     results = []
-    for hook_data in hook_data_list:
-        try:
-            hook = process_repository_hook(
-                hook_data, via="api", fetched_at=fetched_at, commit=True,
-                requestor_id=requestor_id,
+    for resp in responses:
+        fetched_at = datetime.now()
+        for hook_data in resp.json():
+            hook = resolve_conflicts(
+                process_repository_hook, hook_data,
+                via="api", fetched_at=fetched_at, requestor_id=requestor_id,
             )
             results.append(hook.id)
-        except IntegrityError as exc:
-            self.retry(exc=exc)
     return results
 
 
@@ -97,6 +98,8 @@ def hooks_scanned(owner, repo, requestor_id=None):
     logger.info("Lock {name} deleted".format(name=lock_name))
 
     db.session.commit()
+    # this requestor has room for more work now
+    dispatch_pending_tasks.delay()
 
 
 @celery.task()
@@ -129,12 +132,16 @@ def spawn_page_tasks_for_repository_hooks(
     )
     last_page_url = URLObject(resp.links.get('last', {}).get('url', ""))
     last_page_num = int(last_page_url.query.dict.get('page', 1))
+    chunks = list(page_chunks(last_page_num))
+    # record how much work this scan queued, for webhookdb.tasks.scheduler
+    lock.page_tasks = len(chunks)
+    db.session.commit()
     g = group(
         sync_page_of_repository_hooks.s(
             owner=owner, repo=repo,
             children=children, requestor_id=requestor_id,
-            per_page=per_page, page=page,
-        ) for page in xrange(1, last_page_num+1)
+            per_page=per_page, page=page, pages=pages,
+        ) for page, pages in chunks
     )
     finisher = hooks_scanned.si(
         owner=owner, repo=repo, requestor_id=requestor_id,
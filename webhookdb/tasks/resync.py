@@ -0,0 +1,310 @@
+# coding=utf-8
+"""
+Keeping data fresh without webhooks.
+
+Every so often (see ``CELERYBEAT_SCHEDULE``), :func:`resync_stale_repositories`
+looks for collections that have been scanned before, but have probably changed
+on Github since then: a repository's issues, pull requests, labels,
+milestones, or hooks. To tell, it first fetches each repository, with the
+ETag of the previous fetch, so that an unchanged repository costs nothing;
+its ``pushed_at`` and ``updated_at`` show whether anything has happened.
+A changed repository costs one call, which comes out of the same rate limit
+budget as the scans. Collections that haven't been scanned for
+``RESYNC_MAX_AGE_SECONDS`` are rescanned either way, since not all activity
+shows up in those timestamps.
+
+Each candidate scan is scored by how long its data has been stale, divided
+by how many API calls the scan should take, and the best scans are queued
+until the rate limit budget for this run is spent. That way, a large
+repository that changed a little while ago doesn't crowd out a dozen small
+repositories that changed a long time ago.
+
+Issue scans are incremental: they only ask Github for issues updated since
+the previous scan. Pull requests, labels, milestones and hooks can't be
+filtered like that, so rescanning them costs one call per page.
+"""
+from __future__ import unicode_literals, print_function
+
+import math
+from datetime import datetime, timedelta
+from collections import namedtuple
+from flask import current_app
+from sqlalchemy import func
+from webhookdb import db
+from webhookdb.process import process_repository
+from webhookdb.models import (
+    Repository, RepositoryHook, UserRepoAssociation, OAuth, Milestone,
+    PullRequest, IssueLabel,
+)
+from webhookdb.exceptions import RateLimited, NotFound, StaleData
+from webhookdb.tasks import celery, logger
+from webhookdb.tasks.fetch import fetch_url_from_github
+from webhookdb.tasks.scheduler import enqueue, dispatch_pending_tasks
+from webhookdb.tasks.issue import spawn_page_tasks_for_issues
+from webhookdb.tasks.label import spawn_page_tasks_for_labels
+from webhookdb.tasks.milestone import spawn_page_tasks_for_milestones
+from webhookdb.tasks.pull_request import spawn_page_tasks_for_pull_requests
+from webhookdb.tasks.repository_hook import spawn_page_tasks_for_repository_hooks
+
+
+Candidate = namedtuple("Candidate", "repo kind requestor_id cost score")
+
+# For each kind of collection: the timestamp of the last scan, the timestamps
+# that show activity on Github, the column to count existing rows by (to
+# estimate how many pages a rescan will take), and the task that scans it.
+KINDS = {
+    "issues": (
+        "issues_last_scanned_at", ("pushed_at", "updated_at"),
+        None, spawn_page_tasks_for_issues,
+    ),
+    "pull_requests": (
+        "pull_requests_last_scanned_at", ("pushed_at", "updated_at"),
+        PullRequest.base_repo_id, spawn_page_tasks_for_pull_requests,
+    ),
+    "labels": (
+        "labels_last_scanned_at", ("updated_at",),
+        IssueLabel.repo_id, spawn_page_tasks_for_labels,
+    ),
+    "milestones": (
+        "milestones_last_scanned_at", ("updated_at",),
+        Milestone.repo_id, spawn_page_tasks_for_milestones,
+    ),
+    "hooks": (
+        "hooks_last_scanned_at", ("updated_at",),
+        RepositoryHook.repo_id, spawn_page_tasks_for_repository_hooks,
+    ),
+}
+# webhooks keep these up to date for repos that have our hook installed,
+# and so does webhookdb.tasks.events for the others
+HOOKED_KINDS = ("issues", "pull_requests")
+# incremental scans usually fit in one page: one HEAD request, one GET
+INCREMENTAL_COST = 2
+
+
+def estimate_cost(row_count, per_page=100):
+    "How many API calls a full scan of a collection should take."
+    return 1 + max(1, int(math.ceil(float(row_count or 0) / per_page)))
+
+
+def rate_budget(requestor_id):
+    """
+    How many API calls we're willing to spend for this requestor in this
+    run. Asking Github for the current rate limit doesn't count against it.
+    Some of the remaining calls are held back for interactive use.
+    """
+    config = current_app.config
+    try:
+        resp = fetch_url_from_github("/rate_limit", requestor_id=requestor_id)
+    except RateLimited:
+        return 0
+    core = resp.json().get("resources", {}).get("core", {})
+    limit = core.get("limit", 0)
+    remaining = core.get("remaining", 0)
+    reserve = int(limit * config.get("RESYNC_RATE_RESERVE", 0.5))
+    return max(0, min(
+        remaining - reserve,
+        config.get("RESYNC_MAX_CALLS_PER_RUN", 1000),
+    ))
+
+
+def hooked_repo_ids():
+    "IDs of repositories that have an active webhook pointing at WebhookDB."
+    query = (
+        db.session.query(RepositoryHook.repo_id)
+        .filter(RepositoryHook.active == True)
+        .filter(RepositoryHook.url.like("%/replication%"))
+    )
+    return set(repo_id for (repo_id,) in query)
+
+
+def row_counts(repo_id_column):
+    "Number of rows in a table for each repository ID."
+    query = (
+        db.session.query(repo_id_column, func.count())
+        .group_by(repo_id_column)
+    )
+    return dict(query)
+
+
+def requestors_by_repo(admin=False):
+    """
+    For each repository, a user who can see it (or administer it, if
+    ``admin`` is true) and has an OAuth token we can use to rescan it.
+    """
+    permission = UserRepoAssociation.can_admin if admin else UserRepoAssociation.can_pull
+    query = (
+        db.session.query(
+            UserRepoAssociation.repo_id, func.min(UserRepoAssociation.user_id),
+        )
+        .join(OAuth, OAuth.user_id == UserRepoAssociation.user_id)
+        .filter(permission == True)
+        .group_by(UserRepoAssociation.repo_id)
+    )
+    return dict(query)
+
+
+def scanned_repositories(repo_ids):
+    "Repositories with at least one collection that's been scanned before."
+    scanned_attrs = [KINDS[kind][0] for kind in KINDS]
+    return (
+        Repository.query.filter(Repository.id.in_(repo_ids))
+        .filter(db.or_(*[
+            getattr(Repository, attr) != None for attr in scanned_attrs
+        ]))
+    )
+
+
+def refresh_repository(repo, requestor_id):
+    """
+    Fetch a repository from Github, if it has changed since the last time,
+    so that its ``pushed_at`` and ``updated_at`` are current. Returns True
+    if it changed, False if it's gone, or None if it wasn't modified: Github
+    doesn't count a "304 Not Modified" response against the rate limit.
+    """
+    url = "/repos/{owner}/{repo}".format(owner=repo.owner_login, repo=repo.name)
+    headers = {}
+    if repo.etag:
+        headers["If-None-Match"] = repo.etag
+    try:
+        resp = fetch_url_from_github(url, requestor_id=requestor_id, headers=headers)
+    except NotFound:
+        return False
+    if resp.status_code == 304:
+        return None
+    repo_id = repo.id
+    try:
+        process_repository(
+            resp.json(), via="api", fetched_at=datetime.now(),
+            requestor_id=requestor_id, commit=False,
+        )
+    except StaleData:
+        pass
+    Repository.query.get(repo_id).etag = resp.headers.get("ETag")
+    db.session.commit()
+    return True
+
+
+def refresh_repositories(budgets):
+    """
+    Refresh every repository that we might resync. ``budgets`` maps
+    requestor IDs to how many API calls they have left in this run (see
+    :func:`rate_budget`); each fetch that counts against the rate limit is
+    charged to it, and repositories whose requestor has nothing left aren't
+    refreshed. Stops early if we run out of API calls. Returns how many
+    repositories had changed.
+    """
+    requestors = requestors_by_repo()
+    if not requestors:
+        return 0
+    changed = 0
+    for repo in scanned_repositories(requestors.keys()).all():
+        requestor_id = requestors[repo.id]
+        if requestor_id not in budgets:
+            budgets[requestor_id] = rate_budget(requestor_id)
+        if budgets[requestor_id] < 1:
+            continue
+        try:
+            refreshed = refresh_repository(repo, requestor_id)
+        except RateLimited:
+            db.session.rollback()
+            break
+        if refreshed is not None:
+            budgets[requestor_id] -= 1
+        changed += bool(refreshed)
+    return changed
+
+
+def find_candidates(now=None):
+    """
+    Score every collection that's been scanned before and has seen activity
+    on Github since, or hasn't been scanned for ``RESYNC_MAX_AGE_SECONDS``.
+    Returns a list of :class:`Candidate`, best first.
+    """
+    now = now or datetime.now()
+    hooked = hooked_repo_ids()
+    requestors = requestors_by_repo()
+    # only admins can see a repository's hooks
+    admins = requestors_by_repo(admin=True)
+    if not requestors:
+        return []
+    counts = {}
+    candidates = []
+    repos = scanned_repositories(requestors.keys())
+    max_age = timedelta(
+        seconds=current_app.config.get("RESYNC_MAX_AGE_SECONDS", 86400)
+    )
+    polled_since = now - timedelta(
+        seconds=current_app.config.get("RESYNC_INTERVAL_SECONDS", 900)
+    )
+    for repo in repos:
+        # polling the events API also keeps these up to date
+        polled = (
+            repo.events_last_id is not None and
+            repo.events_last_polled_at and
+            repo.events_last_polled_at > polled_since
+        )
+        for kind, (scanned_attr, activity_attrs, column, _) in KINDS.items():
+            if kind in HOOKED_KINDS and (repo.id in hooked or polled):
+                continue
+            requestor_id = admins.get(repo.id) if kind == "hooks" else requestors[repo.id]
+            if not requestor_id:
+                continue
+            scanned_at = getattr(repo, scanned_attr)
+            if not scanned_at:
+                # never loaded, so there's nothing to keep fresh
+                continue
+            activity = [getattr(repo, attr) for attr in activity_attrs]
+            activity_at = max([a for a in activity if a] or [None])
+            too_old = now - scanned_at > max_age
+            if not too_old and (not activity_at or activity_at <= scanned_at):
+                continue
+            if column is None:
+                cost = INCREMENTAL_COST
+            else:
+                if kind not in counts:
+                    counts[kind] = row_counts(column)
+                cost = estimate_cost(counts[kind].get(repo.id))
+            stale_seconds = (now - scanned_at).total_seconds()
+            candidates.append(Candidate(
+                repo=repo, kind=kind, requestor_id=requestor_id,
+                cost=cost, score=stale_seconds / cost,
+            ))
+    candidates.sort(key=lambda c: c.score, reverse=True)
+    return candidates
+
+
+@celery.task()
+def resync_stale_repositories():
+    """
+    Queue rescans of the collections that have been stale the longest for
+    the fewest API calls, until each requestor's rate budget is used up.
+    The scans go through :mod:`webhookdb.tasks.scheduler`, so they take
+    turns with scans that people asked for.
+    """
+    overlap = timedelta(
+        seconds=current_app.config.get("RESYNC_SINCE_OVERLAP_SECONDS", 3600)
+    )
+    budgets = {}
+    refresh_repositories(budgets)
+    queued = 0
+    for candidate in find_candidates():
+        requestor_id = candidate.requestor_id
+        if requestor_id not in budgets:
+            budgets[requestor_id] = rate_budget(requestor_id)
+        if budgets[requestor_id] < candidate.cost:
+            continue
+        budgets[requestor_id] -= candidate.cost
+
+        repo = candidate.repo
+        scanned_attr, _, _, spawn = KINDS[candidate.kind]
+        kwargs = {"requestor_id": requestor_id, "dispatch": False}
+        if candidate.kind == "issues":
+            since = getattr(repo, scanned_attr) - overlap
+            kwargs["since"] = since.strftime("%Y-%m-%dT%H:%M:%SZ")
+        enqueue(spawn, repo.owner_login, repo.name, **kwargs)
+        queued += 1
+
+    if queued:
+        dispatch_pending_tasks.delay()
+    logger.info("Queued {num} resync scans".format(num=queued))
+    return queued
@@ -0,0 +1,63 @@
+# coding=utf-8
+"""
+Celery task routing. WebhookDB uses three queues, so that backfilling
+a huge organization can't delay replication of webhook events:
+
+``webhook``
+    Follow-up work for webhook notifications from Github, such as
+    rescanning the files of a pull request that was just updated.
+``interactive``
+    Loading individual objects on request. This is the default queue.
+``bulk``
+    Scans of whole collections: the "spawn page tasks", "sync page",
+    and "scanned" tasks, and the GraphQL scans.
+
+Each queue should be consumed by its own workers; see the
+``WORKER_QUEUE_CONCURRENCY`` config variable and ``manage.py worker``.
+"""
+from __future__ import unicode_literals, print_function
+
+from celery import current_task
+
+WEBHOOK_QUEUE = "webhook"
+INTERACTIVE_QUEUE = "interactive"
+BULK_QUEUE = "bulk"
+QUEUES = (WEBHOOK_QUEUE, INTERACTIVE_QUEUE, BULK_QUEUE)
+
+BULK_TASK_PREFIXES = (
+    "spawn_page_tasks_for_", "sync_page_of_", "sync_pages_of_", "graphql_sync_",
+)
+BULK_TASK_SUFFIXES = ("_scanned",)
+
+
+def current_queue():
+    """
+    The queue that the currently-executing task was delivered from, or
+    ``None`` if we're not in a task that came off of one of our queues
+    (for example, in a web request, or in an eager task).
+    """
+    task = current_task
+    if not task:
+        return None
+    delivery_info = getattr(task.request, "delivery_info", None) or {}
+    queue = delivery_info.get("routing_key")
+    return queue if queue in QUEUES else None
+
+
+class TaskRouter(object):
+    """
+    Decides which queue a task goes on, unless the caller passed
+    a ``queue`` option explicitly.
+
+    Tasks queued by a task that is running on the webhook queue stay on the
+    webhook queue, so that every step of replicating a webhook event keeps
+    its priority. Otherwise, the tasks that scan whole collections go on the
+    bulk queue, and everything else goes on the default (interactive) queue.
+    """
+    def route_for_task(self, task, args=None, kwargs=None):
+        if current_queue() == WEBHOOK_QUEUE:
+            return {"queue": WEBHOOK_QUEUE}
+        name = task.rsplit(".", 1)[-1]
+        if name.startswith(BULK_TASK_PREFIXES) or name.endswith(BULK_TASK_SUFFIXES):
+            return {"queue": BULK_QUEUE}
+        return None
@@ -0,0 +1,171 @@
+# coding=utf-8
+"""
+Fair scheduling of scans between requestors.
+
+When someone asks WebhookDB to load every repository in a large organization,
+with all of their children, that creates thousands of scans. Rather than
+putting all of them on the task queue at once (where everyone else's work
+would wait behind them), those scans are stored as
+:class:`~webhookdb.models.PendingTask` rows, and
+:func:`dispatch_pending_tasks` hands them out a few at a time, taking turns
+between requestors.
+
+Work in flight is measured with the :class:`~webhookdb.models.Mutex` rows
+that every scan holds until it finishes: each one records the requestor
+and how many "sync page" tasks the scan queued. A requestor (and the OAuth
+token they use) can only have so many page tasks in flight; once their
+scans finish and release their locks, more of their pending scans are
+dispatched.
+"""
+from __future__ import unicode_literals, print_function
+
+from datetime import datetime, timedelta
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import func
+from webhookdb import db
+from webhookdb.models import Mutex, PendingTask, OAuth
+from webhookdb.tasks import celery, logger
+
+
+def enqueue(task, *args, **kwargs):
+    """
+    Store a scan task to be dispatched when its requestor has room.
+    Accepts the same arguments as the task itself; ``requestor_id`` is
+    read from the keyword arguments. Pass ``dispatch=False`` to skip
+    queueing :func:`dispatch_pending_tasks` -- useful when enqueueing many
+    tasks in a row, as long as you dispatch afterwards.
+    """
+    dispatch = kwargs.pop("dispatch", True)
+    requestor_id = kwargs.get("requestor_id")
+    if requestor_id:
+        requestor_id = int(requestor_id)
+    token_id = None
+    if requestor_id:
+        token_id = (
+            db.session.query(OAuth.id)
+            .filter(OAuth.user_id == requestor_id)
+            .scalar()
+        )
+    pending = PendingTask(
+        task_name=task.name, args=list(args), kwargs=kwargs,
+        requestor_id=requestor_id, token_id=token_id,
+    )
+    db.session.add(pending)
+    db.session.commit()
+    if dispatch:
+        dispatch_pending_tasks.delay()
+    return pending
+
+
+def in_flight():
+    """
+    Return two dicts: the number of page tasks in flight for each requestor,
+    and for each OAuth token. Scans that were dispatched recently but
+    haven't acquired their lock yet count as one page task each.
+    """
+    config = current_app.config
+    grace = timedelta(seconds=config.get("SCHEDULER_DISPATCH_GRACE_SECONDS", 60))
+    by_requestor = defaultdict(int)
+    by_token = defaultdict(int)
+
+    held = (
+        db.session.query(
+            Mutex.user_id, OAuth.id,
+            func.sum(func.coalesce(Mutex.page_tasks, 1)),
+        )
+        .outerjoin(OAuth, OAuth.user_id == Mutex.user_id)
+        .group_by(Mutex.user_id, OAuth.id)
+    )
+    for requestor_id, token_id, count in held:
+        by_requestor[requestor_id] += count
+        if token_id:
+            by_token[token_id] += count
+
+    recent = (
+        db.session.query(
+            PendingTask.requestor_id, PendingTask.token_id, func.count(),
+        )
+        .filter(PendingTask.dispatched_at > datetime.utcnow() - grace)
+        .group_by(PendingTask.requestor_id, PendingTask.token_id)
+    )
+    for requestor_id, token_id, count in recent:
+        by_requestor[requestor_id] += count
+        if token_id:
+            by_token[token_id] += count
+
+    return by_requestor, by_token
+
+
+@celery.task()
+def dispatch_pending_tasks():
+    """
+    Dispatch pending scans, round-robin between requestors, without letting
+    any requestor or token go over its limit of page tasks in flight.
+    The least busy requestors go first in each round.
+    """
+    config = current_app.config
+    max_per_requestor = config.get("SCHEDULER_MAX_PAGE_TASKS_PER_REQUESTOR", 50)
+    max_per_token = config.get("SCHEDULER_MAX_PAGE_TASKS_PER_TOKEN", 50)
+    max_dispatch = config.get("SCHEDULER_MAX_DISPATCH", 100)
+    grace = timedelta(seconds=config.get("SCHEDULER_DISPATCH_GRACE_SECONDS", 60))
+
+    # forget about tasks dispatched long enough ago that their locks count
+    PendingTask.query.filter(
+        PendingTask.dispatched_at < datetime.utcnow() - grace
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+    by_requestor, by_token = in_flight()
+    waiting = [
+        requestor_id for (requestor_id,) in
+        db.session.query(PendingTask.requestor_id)
+        .filter(PendingTask.dispatched_at == None)
+        .distinct()
+    ]
+
+    dispatched = 0
+    while waiting and dispatched < max_dispatch:
+        waiting.sort(key=lambda requestor_id: by_requestor[requestor_id])
+        still_waiting = []
+        for requestor_id in waiting:
+            if dispatched >= max_dispatch:
+                break
+            if by_requestor[requestor_id] >= max_per_requestor:
+                continue
+            pending = (
+                PendingTask.query
+                .filter_by(requestor_id=requestor_id, dispatched_at=None)
+                .order_by(PendingTask.id)
+                .first()
+            )
+            if not pending:
+                continue
+            if pending.token_id and by_token[pending.token_id] >= max_per_token:
+                continue
+            # claim the task, so that a concurrent dispatcher doesn't
+            # also send it
+            claimed = (
+                PendingTask.query
+                .filter_by(id=pending.id, dispatched_at=None)
+                .update(
+                    {"dispatched_at": datetime.utcnow()},
+                    synchronize_session=False,
+                )
+            )
+            db.session.commit()
+            if not claimed:
+                still_waiting.append(requestor_id)
+                continue
+            task = celery.tasks[pending.task_name]
+            task.apply_async(args=pending.args, kwargs=pending.kwargs)
+            by_requestor[requestor_id] += 1
+            if pending.token_id:
+                by_token[pending.token_id] += 1
+            dispatched += 1
+            still_waiting.append(requestor_id)
+        waiting = still_waiting
+
+    if dispatched:
+        logger.info("Dispatched {num} pending tasks".format(num=dispatched))
+    return dispatched
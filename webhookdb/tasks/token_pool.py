@@ -0,0 +1,115 @@
+# coding=utf-8
+"""
+Sharing rate limit budget between users, for public data.
+
+Every Github user gets their own rate limit, so a scan that only uses its
+requestor's token can't go faster than one user's budget allows, even when
+it's scanning a public repository that any token could read. Users can opt
+in to the token pool (see ``OAuth.pool_consent``); when the
+``TOKEN_POOL_ENABLED`` config variable is set, requests for public
+repositories are made with whichever pooled token has the most calls left.
+Anything else -- private repositories, hooks, or repositories we don't know
+about yet -- still uses the requestor's own token.
+
+How many calls each token has left is tracked from the ``X-RateLimit-*``
+headers of every response this process sees.
+"""
+from __future__ import unicode_literals, print_function
+
+import time
+import threading
+from flask import current_app
+from urlobject import URLObject
+from webhookdb.models import OAuth, Repository
+
+# assumed for tokens we haven't seen a response for since their reset
+DEFAULT_RATE_LIMIT = 5000
+# URLs under /repos/{owner}/{repo}/ that need the requestor's permissions
+PRIVILEGED_SEGMENTS = ("hooks", "collaborators", "keys")
+
+_lock = threading.Lock()
+# user ID -> (remaining calls, reset time as a Unix timestamp)
+_rate_state = {}
+_members = {"user_ids": [], "loaded_at": 0}
+# (owner, repo) -> (is public, looked up at)
+_public_repos = {}
+
+
+def enabled():
+    return bool(current_app.config.get("TOKEN_POOL_ENABLED"))
+
+
+def record_response(user_id, resp):
+    "Remember how many calls this user's token has left, from a response."
+    try:
+        remaining = int(resp.headers["X-RateLimit-Remaining"])
+        reset = int(resp.headers["X-RateLimit-Reset"])
+    except (KeyError, TypeError, ValueError):
+        return
+    with _lock:
+        _rate_state[user_id] = (remaining, reset)
+
+
+def estimated_remaining(user_id, now=None):
+    now = now or time.time()
+    remaining, reset = _rate_state.get(user_id, (DEFAULT_RATE_LIMIT, 0))
+    if reset <= now:
+        return DEFAULT_RATE_LIMIT
+    return remaining
+
+
+def member_ids():
+    "The IDs of users who have agreed to share their token."
+    ttl = current_app.config.get("TOKEN_POOL_REFRESH_SECONDS", 300)
+    now = time.time()
+    if now - _members["loaded_at"] > ttl:
+        query = (
+            OAuth.query.filter(OAuth.pool_consent == True)
+            .filter(OAuth.user_id != None)
+            .with_entities(OAuth.user_id)
+        )
+        _members["user_ids"] = [user_id for (user_id,) in query]
+        _members["loaded_at"] = now
+    return _members["user_ids"]
+
+
+def is_public(url):
+    """
+    Is this a URL for data in a repository that we know is public, and that
+    doesn't depend on who is asking? The repository itself doesn't count:
+    its ``permissions`` describe the user whose token fetched it.
+    """
+    segments = URLObject(url).path.segments
+    if len(segments) < 4 or segments[0] != "repos":
+        return False
+    if len(segments) > 3 and segments[3] in PRIVILEGED_SEGMENTS:
+        return False
+    key = (segments[1].lower(), segments[2].lower())
+    ttl = current_app.config.get("TOKEN_POOL_REFRESH_SECONDS", 300)
+    now = time.time()
+    cached = _public_repos.get(key)
+    if cached and now - cached[1] < ttl:
+        return cached[0]
+    repo = Repository.get(segments[1], segments[2])
+    public = bool(repo and repo.private == False)
+    _public_repos[key] = (public, now)
+    return public
+
+
+def choose_user_id(requestor_id=None):
+    """
+    Pick the user whose token has the most calls left: one of the pool's
+    members, or the requestor.
+    """
+    requestor_id = int(requestor_id) if requestor_id else None
+    candidates = set(member_ids())
+    if requestor_id:
+        candidates.add(requestor_id)
+    if not candidates:
+        return requestor_id
+    now = time.time()
+    return max(candidates, key=lambda user_id: (
+        estimated_remaining(user_id, now),
+        # on a tie, prefer the requestor's own token
+        user_id == requestor_id,
+    ))
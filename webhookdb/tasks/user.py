@@ -5,15 +5,15 @@ from datetime import datetime
 from iso8601 import parse_date
 from webhookdb import db, celery
 from webhookdb.process import process_user
+from webhookdb.process.save import resolve_conflicts
 from webhookdb.models import User
 from webhookdb.exceptions import NotFound, StaleData, MissingData
-from sqlalchemy.exc import IntegrityError
 from webhookdb.tasks.fetch import fetch_url_from_github
 from webhookdb.tasks.repository import spawn_page_tasks_for_user_repositories
 
 
-@celery.task(bind=True)
-def sync_user(self, username, children=False, requestor_id=None):
+@celery.task()
+def sync_user(username, children=False, requestor_id=None):
     user_url = "/users/{username}".format(username=username)
 
     if requestor_id:
@@ -33,13 +33,9 @@ def sync_user(self, username, children=False, requestor_id=None):
             "username": username,
         })
     user_data = resp.json()
-    try:
-        user = process_user(
-            user_data, via="api", fetched_at=datetime.now(), commit=True,
-        )
-    except IntegrityError as exc:
-        # multiple workers tried to insert the same user simulataneously. Retry!
-        self.retry(exc=exc)
+    user = resolve_conflicts(
+        process_user, user_data, via="api", fetched_at=datetime.now(),
+    )
 
     if children:
         spawn_page_tasks_for_user_repositories.delay(
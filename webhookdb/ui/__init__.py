@@ -8,7 +8,7 @@ from flask_login import current_user
 from flask_dance.contrib.github import github
 from sqlalchemy.sql import func, cast
 from webhookdb import db
-from webhookdb.models import Repository, RepositoryHook, UserRepoAssociation
+from webhookdb.models import Repository, RepositoryHook, UserRepoAssociation, OAuth
 from webhookdb.tasks.repository_hook import process_repository_hook
 import bugsnag
 
@@ -66,7 +66,11 @@ def install():
     )
     body = {
         "name": "web",
-        "events": ["pull_request", "issue"],
+        "events": [
+            "issues", "pull_request", "repository", "label", "milestone",
+            "member", "team_add", "issue_comment",
+            "pull_request_review_comment",
+        ],
         "config": {
             "url": url_for("replication.main", _external=True),
             "content_type": "json",
@@ -140,3 +144,21 @@ def uninstall():
         return jsonify({"message": "deleted", "ids": deleted_ids})
     else:
         return jsonify({"message": "no hooks deleted", "ids": []})
+
+
+@ui.route("/token-pool", methods=("POST",))
+def token_pool():
+    """
+    Opt in to (or out of) sharing your Github API rate limit: if you agree,
+    your token may be used to load data from public repositories for other
+    people's scans. It is never used for private data.
+
+    :query consent: ``true`` to opt in, ``false`` to opt out
+    """
+    if current_user.is_anonymous():
+        return jsonify({"error": "not logged in"}), 401
+    consent = request.values.get("consent", "").lower() in ("true", "1", "on")
+    query = OAuth.query.filter_by(provider="github", user_id=current_user.id)
+    query.update({"pool_consent": consent}, synchronize_session=False)
+    db.session.commit()
+    return jsonify({"message": "success", "consent": consent})
@@ -0,0 +1,113 @@
+# coding=utf-8
+"""
+One-off steps for upgrading an existing database. Tables are created with
+``manage.py dbcreate``, which doesn't change tables that already exist, so
+a change that moves data or changes a key comes with a step here.
+"""
+from __future__ import unicode_literals, print_function
+
+from flask import current_app
+from sqlalchemy import inspect, and_, or_
+from webhookdb import db
+from webhookdb.models import PullRequestFile, PullRequestPatch
+
+
+def add_filename_to_file_key():
+    """
+    Rebuild the primary key of pull request files, which used to be the
+    pull request and the SHA, so that it includes the filename too: files
+    with the same contents have the same SHA. Returns False if the key
+    already includes the filename.
+    """
+    table = PullRequestFile.__table__
+    primary_key = inspect(db.engine).get_pk_constraint(table.name)
+    if "filename" in primary_key["constrained_columns"]:
+        return False
+    db.session.execute(
+        "ALTER TABLE {table} DROP CONSTRAINT {name}".format(
+            table=table.name,
+            name=primary_key.get("name") or "{}_pkey".format(table.name),
+        )
+    )
+    db.session.execute(
+        "ALTER TABLE {table} ADD PRIMARY KEY ({columns})".format(
+            table=table.name,
+            columns=", ".join(column.name for column in table.primary_key),
+        )
+    )
+    db.session.commit()
+    return True
+
+
+def move_patches_out_of_line(batch_size=500, drop=False):
+    """
+    Move the patches in the old ``patch`` column of pull request files into
+    :class:`~webhookdb.models.PullRequestPatch`, adding the ``patch_hash``
+    column if it's missing. Patches longer than
+    ``PULL_REQUEST_PATCH_MAX_SIZE`` are left out, as they would be now. With
+    ``drop``, the old column is dropped once every patch has been moved.
+    Commits after each batch, so it can be stopped and run again. Returns
+    the number of patches moved.
+    """
+    table = PullRequestFile.__table__
+    columns = set(
+        column["name"] for column in inspect(db.engine).get_columns(table.name)
+    )
+    if "patch" not in columns:
+        return 0
+    if "patch_hash" not in columns:
+        db.session.execute(
+            "ALTER TABLE {table} ADD COLUMN patch_hash VARCHAR(40)".format(
+                table=table.name,
+            )
+        )
+        db.session.execute(
+            "CREATE INDEX ix_{table}_patch_hash ON {table} (patch_hash)".format(
+                table=table.name,
+            )
+        )
+        db.session.commit()
+
+    max_size = current_app.config.get("PULL_REQUEST_PATCH_MAX_SIZE")
+    old_patch = db.column("patch", db.Text)
+    pr_id_column, sha_column = table.c.pull_request_id, table.c.sha
+    last_key = None
+    moved = 0
+    while True:
+        query = (
+            db.select([pr_id_column, sha_column, old_patch])
+            .select_from(table)
+            .where(old_patch != None)
+            .where(table.c.patch_hash == None)
+            .order_by(pr_id_column, sha_column)
+            .limit(batch_size)
+        )
+        if last_key:
+            query = query.where(or_(
+                pr_id_column > last_key[0],
+                and_(pr_id_column == last_key[0], sha_column > last_key[1]),
+            ))
+        rows = db.session.execute(query).fetchall()
+        if not rows:
+            break
+        for pr_id, sha, text in rows:
+            last_key = (pr_id, sha)
+            if max_size and len(text) > max_size:
+                continue
+            patch = PullRequestPatch.for_text(text)
+            db.session.add(patch)
+            db.session.execute(
+                table.update()
+                .where(pr_id_column == pr_id)
+                .where(sha_column == sha)
+                .values(patch_hash=patch.hash)
+            )
+            moved += 1
+        db.session.commit()
+
+    if drop:
+        db.session.execute(
+            "ALTER TABLE {table} DROP COLUMN patch".format(table=table.name)
+        )
+        db.session.commit()
+    return moved